@@ -1,45 +1,107 @@
 import argparse
 from os.path import join, dirname
-from audio_tools.audio_converter import create_audio_files_from_segments_list, create_segments_list
+from audio_tools.audio_converter import create_audio_files_from_segments_list, create_segments_list, parse_targets
 from audio_tools.download_mp3_files import get_links_dict, download_mp3_from_dict
+from audio_tools.mel_features import parse_mel_config
+from audio_tools.streaming_pipeline import execution_streaming_conversion, create_planned_segments_list
 from utils.utils import remove_mp3_files
-from utils.download_dataset import download_language_dataset, extract_segment_files
+from utils.artifact_cache import get_artifact_cache
+from utils.download_dataset import download_language_dataset, extract_segment_files, get_split_members, get_archive_members
+from utils.sharding import ShardSource, get_shard_books, get_shard_name, write_shard_marker
 
 
-def execution_audio_convertion_pipeline(language, sampling_rate=22050, audio_format='wav', audio_quality=64, delete_files=False, force_download=False, force_write=False):
+def execution_audio_convertion_pipeline(language, sampling_rate=22050, audio_format='wav', audio_quality=64, delete_files=False, force_download=False, force_write=False, jobs=1, backend='auto', seek_threshold=4, compression_level=5, encoder_threads=2, dry_run=False, targets_text=None, streaming=False, queue_size=2, connections=2, requests_per_second=0.5, verify_checksums=False, archive_path=None, cache_dir=None, cache_size_gb=None, shard_index=0, num_shards=1, mel_config_text=None):
     '''
     Execute convertion pipeline.
+    targets_text defines several outputs written from one decode, like "22050:wav:audio,44100:flac:audio_44100" (dirs relative to each split folder).
+    With streaming, each source is converted as soon as it is downloaded, with at most queue_size downloaded sources waiting.
+    mp3 files are downloaded with at most "connections" connections and requests_per_second requests per host.
+    Downloaded mp3 files are checked by size against the download manifest of each split, and by md5 with verify_checksums.
+    With archive_path, the segments files are read straight from that MLS tar.gz, without downloading or extracting it.
+    With cache_dir (or the MLS_CACHE_DIR environment variable), the archive and the mp3 files are downloaded once to that shared
+    cache, limited to cache_size_gb, and linked to the working folders.
+    With num_shards > 1, only the books of shard shard_index are converted (see utils/sharding.py), with manifests of their own,
+    so each shard can run on another machine. The outputs of the shards are combined with "python -m utils.sharding".
+    With mel_config_text ("default" or parameters like "n_mels=80,hop_length=256"), the mel spectrograms of the segments are
+    computed from the decoded audio and stored in <split>/features (see audio_tools/mel_features.py). Not done with streaming.
     '''
-    print('Downloading {} dataset tar.gz file...'.format(language))
-    tar_filename = download_language_dataset(lang=language)
-    if not tar_filename:
-        return False
+    shard = get_shard_name(shard_index, num_shards) if num_shards > 1 else None
+    mel_config = parse_mel_config(mel_config_text) if mel_config_text else None
+    if mel_config is not None and streaming:
+        print('Mel features are not computed with streaming, run the conversion again without it to compute them.')
+    artifact_cache = get_artifact_cache(cache_dir, cache_size_gb)
+    if archive_path:
+        # Outputs are written to the same folders as with extracted files
+        segments_files = get_split_members(archive_path, 'segments.txt')
+        segments_sources = get_archive_members(archive_path, 'segments.txt')
+    else:
+        print('Downloading {} dataset tar.gz file...'.format(language))
+        tar_filename = download_language_dataset(lang=language, artifact_cache=artifact_cache)
+        if not tar_filename:
+            return False
 
-    print('Extracting {} file...'.format(tar_filename))
-    segments_files = extract_segment_files(tar_filename)
+        print('Extracting {} file...'.format(tar_filename))
+        segments_files = extract_segment_files(tar_filename)
+        if not segments_files:
+            return False
+        segments_sources = segments_files
 
     # Iterates over [dev, test, train] files
-    for segment_filepath in segments_files:
+    for segment_filepath, segments_source in zip(segments_files, segments_sources):
+        books = None
+        if shard is not None:
+            books, total_segments = get_shard_books(segments_source, shard_index, num_shards)
+            print('Shard {} of {}: {} books, {} segments of {}.'.format(shard_index, num_shards, len(books), total_segments, segment_filepath))
+            segments_source = ShardSource(segments_source, books, shard)
+
+        if streaming and not dry_run:
+            output_dir = join(dirname(segment_filepath), 'audio')
+            targets = parse_targets(targets_text, dirname(segment_filepath)) if targets_text else [(sampling_rate, audio_format, output_dir)]
+            print('Downloading and converting mp3 files from {}...'.format(segments_source))
+            if not execution_streaming_conversion(segments_source, targets, audio_quality, output_dir, force_download, force_write, delete_files, jobs, queue_size, backend, seek_threshold, compression_level, encoder_threads, connections, requests_per_second, verify_checksums, artifact_cache, shard):
+                print('Some source files of {} were not converted.'.format(segment_filepath))
+            elif shard is not None:
+                write_shard_marker(dirname(segment_filepath), 'audio', shard_index, num_shards, books, total_segments, [output_dir] + [target[2] for target in targets])
+            continue
+
         # Get links from segments file
-        links_dict = get_links_dict(segment_filepath, audio_quality)
+        links_dict = get_links_dict(segments_source, audio_quality)
         # Define the output path
         output_dir = join( dirname(segment_filepath), 'audio')
-        print('Downloading mp3 files from {}...'.format(segment_filepath))
-        # Download mp3 files from links_dict
-        r = download_mp3_from_dict(links_dict, audio_quality, output_dir, force_download)
-        if not r:
-            print('Error downloading files.')
-            return False
+        if dry_run:
+            print('Dry run: skipping the download of {} mp3 files.'.format(len(links_dict)))
+        else:
+            print('Downloading mp3 files from {}...'.format(segments_source))
+            # Download mp3 files from links_dict
+            r = download_mp3_from_dict(links_dict, audio_quality, output_dir, force_download, connections, requests_per_second, verify_checksums, artifact_cache, shard)
+            if not r:
+                print('Error downloading files.')
+                return False
+
+        targets = parse_targets(targets_text, dirname(segment_filepath)) if targets_text else None
+        # Sources are kept if they can be used by at least one target
+        min_sampling_rate = min(target[0] for target in targets) if targets else sampling_rate
 
         print('Creating segments list...')
-        segments_list, total_files = create_segments_list(segment_filepath, sampling_rate, audio_format, audio_quality, output_dir)
+        if dry_run:
+            # Every source is planned, downloaded or not (their sample rates are not checked)
+            segments_list, _ = create_planned_segments_list(segments_source, audio_format, audio_quality, output_dir)
+            total_files = len(segments_list)
+        else:
+            segments_list, total_files = create_segments_list(segments_source, min_sampling_rate, audio_format, audio_quality, output_dir, shard=shard)
 
         print('Creating audio segments...')
-        if not create_audio_files_from_segments_list(segments_list, total_files, sampling_rate, audio_format, force_write):
-            return False
+        converted = create_audio_files_from_segments_list(segments_list, total_files, sampling_rate, audio_format, force_write, jobs, backend, seek_threshold, compression_level, encoder_threads, dry_run, targets, shard,
+                                                          mel_config, join(dirname(segment_filepath), 'features'))
+        if not converted:
+            # Failed sources are reported, the other ones were converted
+            print('Some source files of {} were not converted.'.format(segment_filepath))
+
+        if delete_files and not dry_run:
+            remove_mp3_files(segment_filepath, books)
 
-        if delete_files:
-            remove_mp3_files(segment_filepath)
+        if converted and shard is not None and not dry_run:
+            write_shard_marker(dirname(segment_filepath), 'audio', shard_index, num_shards, books, total_segments, [output_dir] + [target[2] for target in targets or []])
 
     print("Finished audio conversion.")
     return True
@@ -54,9 +116,27 @@ def main():
     parser.add_argument('-w', '--force_write', action='store_true', default=False)
     parser.add_argument('-d', '--delete_files', action='store_true', default=False)
     parser.add_argument('-q', '--audio_quality', default=64, help='64 if sr=22050 or 128 if sr=44100')
+    parser.add_argument('-j', '--jobs', default=1, help='Number of processes converting source files')
+    parser.add_argument('-b', '--backend', default='auto', help='Options: decode (decode each source once with pydub), numpy (decode and resample each source once with NumPy), seek (ffmpeg seeking per segment) or auto')
+    parser.add_argument('-t', '--seek_threshold', default=4, help='With --backend=auto, sources with at most this number of missing segments use seek')
+    parser.add_argument('-c', '--compression_level', default=5, help='FLAC compression level (0-8)')
+    parser.add_argument('-e', '--encoder_threads', default=2, help='Threads encoding flac files in each process')
+    parser.add_argument('-g', '--targets', default=None, help='Several outputs from one decode, ignoring -s and -f. Example: 22050:wav:audio,44100:flac:audio_44100')
+    parser.add_argument('-p', '--streaming', action='store_true', default=False, help='Convert each source as soon as it is downloaded. With --delete_files, each mp3 file is removed after conversion')
+    parser.add_argument('-u', '--queue_size', default=2, help='With --streaming, number of downloaded sources waiting for conversion')
+    parser.add_argument('-k', '--connections', default=2, help='Concurrent connections per host downloading mp3 files')
+    parser.add_argument('-m', '--requests_per_second', default=0.5, help='Maximum download requests per second per host')
+    parser.add_argument('-v', '--verify_checksums', action='store_true', default=False, help='Verify the md5 of the downloaded mp3 files, not only their size')
+    parser.add_argument('-a', '--archive', default=None, help='MLS tar.gz already downloaded, read without extracting it')
+    parser.add_argument('-o', '--cache_dir', default=None, help='Shared cache of downloaded archives and mp3 files (default: MLS_CACHE_DIR environment variable)')
+    parser.add_argument('-z', '--cache_size', default=None, help='Maximum size of the cache in GB, least recently used files are removed')
+    parser.add_argument('-y', '--shard_index', '--shard-index', default=0, help='Shard converted by this run, from 0 to num_shards - 1')
+    parser.add_argument('-x', '--num_shards', '--num-shards', default=1, help='Number of shards (machines) sharing the books of the language')
+    parser.add_argument('-i', '--mel_features', default=None, help='Compute mel spectrograms in <split>/features: "default" or parameters like n_mels=80,hop_length=256,fmax=8000')
+    parser.add_argument('-r', '--dry_run', '--dry-run', action='store_true', default=False, help='Only print how many sources would be decoded and the size of the outputs')
     args = parser.parse_args()
 
-    execution_audio_convertion_pipeline(args.language, int(args.sampling_rate), args.audio_format, int(args.audio_quality), args.delete_files, args.force_download, args.force_write)
+    execution_audio_convertion_pipeline(args.language, int(args.sampling_rate), args.audio_format, int(args.audio_quality), args.delete_files, args.force_download, args.force_write, int(args.jobs), args.backend, int(args.seek_threshold), int(args.compression_level), int(args.encoder_threads), args.dry_run, args.targets, args.streaming, int(args.queue_size), int(args.connections), float(args.requests_per_second), args.verify_checksums, args.archive, args.cache_dir, float(args.cache_size) if args.cache_size else None, int(args.shard_index), int(args.num_shards), args.mel_features)
 
 if __name__ == "__main__":
     main()
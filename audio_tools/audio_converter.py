@@ -5,130 +5,272 @@
 # Released under GNU Public License (GPL)
 # Adapted from https://gist.github.com/keithito/771cfc1a1ab69d1957914e377e65b6bd from Keith Ito: kito@kito.us
 import argparse
-from os.path import exists, join
+import collections
+from multiprocessing import Pool
+from os import makedirs
+from os.path import exists, join, dirname
 from pydub import AudioSegment
-from pydub.utils import mediainfo
 from tqdm import tqdm
 from utils.utils import get_filepath_from_link, get_better_quality_link
+from utils.mls_reader import iter_segments
+from audio_tools.probe_cache import ProbeCache
+from audio_tools.segment_table import SegmentTableBuilder
+from audio_tools.conversion_plan import plan_conversion, get_manifest_filepath, get_target_key, append_completed_source
+from audio_tools.ffmpeg_extractor import extract_segment
+from audio_tools.numpy_audio import decode_to_mono, resample_to_int16, get_segment_slice, write_wav
+from audio_tools.flac_encoder import encode_flac_batch
+from audio_tools.mel_features import FeatureStore, compute_segment_mels, load_stored_names, plan_features
+from utils.sharding import get_shard_filepath
 
 
-class Segment:
+def get_source_filepath(link, output_path, audio_quality=64):
     '''
-    Linked segments Class
+    Get the downloaded mp3 filepath of a link, preferring the 128 quality file. Returns None if it was not downloaded.
     '''
-    def __init__(self, begin, end, filesource, filepath):
-        self.begin = begin
-        self.end = end
-        self.next = None
-        self.filesource = filesource
-        self.filepath = filepath
-        self.gap = 0 # gap between segments (current and next)
+    link128 = get_better_quality_link(link)
+    if int(audio_quality) == 128:
+        # Change link 64 to 128
+        link = link128
 
-    def set_next(self, next):
-        self.next = next
-        self.gap = next.begin - self.end
+    # Verify if a better quality 128 mp3 file exists
+    mp3_filepath128 = get_filepath_from_link(link128, output_path)
+    if not exists(mp3_filepath128) and int(audio_quality) == 64:
+        # Verify if 64 mp3 exists
+        mp3_filepath = get_filepath_from_link(link, output_path)
+        if not exists(mp3_filepath):
+            return None
+        return mp3_filepath
+    # Uses 128 mp3 file
+    return mp3_filepath128
 
-    def set_filename_and_id(self, filename, id):
-        self.filename = filename
-        self.id = id
 
-    def merge_from(self, next):
-        # merge two segments (current and next)
-        self.next = next.next
-        self.gap = next.gap
-        self.end = next.end
+def create_segments_list(segments_filepath, sampling_rate = 22050, audio_format = 'wav', audio_quality = 64, output_dir = './', probe_workers = 8, shard=None):
+    '''
+    Creates a segment table from a file. With shard, probe results are saved in the probe cache of the shard.
+    '''
+    extension_file = get_extension(audio_format)
+
+    # First pass: find each source file once (link => mp3 filepath)
+    source_filepaths = {}
+    for filename, link, begin, end in iter_segments(segments_filepath):
+        if link not in source_filepaths:
+            folder1, folder2, fileid = filename.split('_')
+            source_filepaths[link] = get_source_filepath(link, join(output_dir, folder1, folder2), audio_quality)
+
+    # Probe each source file once, using the cache of previous runs
+    probe_cache = ProbeCache(get_shard_filepath(join(output_dir, 'probe_cache.json'), shard))
+    if shard is not None:
+        probe_cache.load(join(output_dir, 'probe_cache.json'))
+    sources_info = probe_cache.probe_all([filepath for filepath in source_filepaths.values() if filepath is not None], probe_workers)
+
+    builder = SegmentTableBuilder()
+    total_files = 0
+    for filename, link, begin, end in tqdm(iter_segments(segments_filepath)):
+        total_files += 1
+        mp3_filepath = source_filepaths[link]
+        if mp3_filepath is None:
+            continue
+
+        # Verify sample rate
+        info = sources_info[mp3_filepath]
+        if not info['sample_rate'] or int(info['sample_rate']) < int(sampling_rate):
+            print('Ignoring {} sr = {}'.format(mp3_filepath, info['sample_rate']))
+            continue;
+
+        # Creating segment (milliseconds)
+        builder.add(mp3_filepath, filename, float(begin)*1000, float(end)*1000)
 
-    def duration(self, sample_rate):
-        return (self.end - self.start - 1) / sample_rate
+    segments_table = builder.build(output_dir, extension_file)
+    segments_table.source_rates = [int(sources_info[source]['sample_rate']) for source in segments_table.sources]
+    return segments_table, total_files
 
 
-def create_segments_list(segments_filepath, sampling_rate = 22050, audio_format = 'wav', audio_quality = 64, output_dir = './'):
+def parse_targets(targets_text, base_dir='./'):
     '''
-    Creates a linked segment list from a file.
+    Get output targets (sampling_rate, audio_format, output_dir) from a text like "22050:wav:audio,44100:flac:audio_44100".
+    Output dirs are relative to base_dir.
     '''
-    extension_file = '.wav' if audio_format == 'wav' else '.flac'
-    head = None
-    with open(segments_filepath) as f :
-        content_data = f.readlines()
+    targets = []
+    for target in targets_text.split(','):
+        sampling_rate, audio_format, output_dir = target.strip().split(':')
+        targets.append((int(sampling_rate), audio_format, join(base_dir, output_dir)))
+    return targets
 
-        for line in tqdm(content_data):
 
-            filename, link, begin, end = line.strip().split("\t")
-            # Get files path
-            folder1, folder2, fileid = filename.split('_')
-            output_path = join(output_dir, folder1, folder2)
-
-            link128 = get_better_quality_link(link)
-            if int(audio_quality) == 128:
-                # Change link 64 to 128
-                link = link128
-
-            # Verify if a better quality 128 mp3 file exists
-            mp3_filepath128 = get_filepath_from_link(link128, output_path)
-            if not exists(mp3_filepath128) and int(audio_quality) == 64:
-                # Verify if 64 mp3 exists
-                mp3_filepath = get_filepath_from_link(link, output_path)
-                if not exists(mp3_filepath):
-                    continue
-            else:
-                # Uses 128 mp3 file
-                mp3_filepath = mp3_filepath128
+def get_extension(audio_format):
+    return '.wav' if audio_format == 'wav' else '.flac'
 
-            output_filepath = join(output_path, filename + extension_file)
 
-            # Verify sample rate
-            info = mediainfo(mp3_filepath)
-            if int(info['sample_rate']) < int(sampling_rate):
-                print('Ignoring {} sr = {}'.format(mp3_filepath, info['sample_rate']))
-                continue;
+def write_segments(samples, segments, sampling_rate, audio_format, compression_level=5, encoder_threads=2):
+    '''
+    Writes segments from one int16 array at sampling_rate. Returns the first error, or None.
+    '''
+    if audio_format == 'wav':
+        # Segments are views of the same array
+        for begin, end, filepath in segments:
+            try:
+                write_wav(filepath, get_segment_slice(samples, begin, end, sampling_rate), sampling_rate)
+            except Exception as e:
+                print("Error: Writing audio segment {} problem: {}".format(filepath, e))
+                return str(e)
+        return None
 
-            # Creating segment
-            begin = float(begin)*1000
-            end = float(end)*1000
+    # All the flac clips of the source are encoded in one batch
+    clips = [(filepath, get_segment_slice(samples, begin, end, sampling_rate)) for begin, end, filepath in segments]
+    errors = [(filepath, error) for filepath, error in encode_flac_batch(clips, sampling_rate, compression_level, encoder_threads) if error]
+    for filepath, error in errors:
+        print("Error: Writing audio segment {} problem: {}".format(filepath, error))
+    return errors[0][1] if errors else None
 
-            # Build a segment list
-            segment = Segment(begin, end, mp3_filepath, output_filepath)
-            if head is None:
-                head = segment
+
+def convert_source(audio_file, targets_segments, backend='auto', seek_threshold=4, compression_level=5, encoder_threads=2, features=None):
+    '''
+    Creates the audio segments of one source file for each output target.
+    targets_segments is a list of (sampling_rate, audio_format, segments), segments are (begin, end, filepath) tuples to be written.
+    features is (mel config, (begin, end, name) segments) to compute mel spectrograms of, from the same decode.
+    Returns (audio_file, number of segments, errors, mels), with one error (or None) for each target, and [(name, mel)]
+    (None if no features were asked or they failed).
+    Backends: "decode" decodes the source once with pydub, "numpy" decodes the source once and resamples it with NumPy
+    for each target, writing wav files directly and flac files through the batch encoder, "seek" runs ffmpeg with input
+    seeking for each segment, and "auto" uses "seek" when at most seek_threshold segments are missing, otherwise "numpy".
+    '''
+    total_segments = sum(len(segments) for _, _, segments in targets_segments)
+    if backend == 'auto':
+        # Features need the whole source decoded anyway
+        backend = 'seek' if total_segments <= seek_threshold and features is None else 'numpy'
+
+    errors = []
+    sound = None
+    feature_samples = None
+    for sampling_rate, audio_format, segments in targets_segments:
+        error = None
+        try:
+            if backend == 'seek':
+                for begin, end, filepath in segments:
+                    extract_segment(audio_file, begin, end, filepath, sampling_rate, audio_format)
+            elif backend == 'numpy':
+                # Decodes the source once for all the targets
+                if sound is None:
+                    sound = decode_to_mono(audio_file)
+                samples = resample_to_int16(sound[0], sound[1], sampling_rate)
+                error = write_segments(samples, segments, sampling_rate, audio_format, compression_level, encoder_threads)
+                if features is not None and int(sampling_rate) == int(features[0]['sampling_rate']):
+                    # Same samples as the written files
+                    feature_samples = samples
+                del samples
             else:
-                prev.set_next(segment)
-            prev = segment
+                # Decodes the source once for all the targets
+                if sound is None:
+                    sound = AudioSegment.from_file(audio_file).set_channels(1)
+                target_sound = sound.set_frame_rate(int(sampling_rate))
+                for begin, end, filepath in segments:
+                    #print("Exporting {}".format(filepath))
+                    target_sound[begin:end].export(filepath, format = "wav" if audio_format == "wav" else "flac")
+        except Exception as e:
+            # A bad source does not stop the other ones
+            print("Error: Converting {} problem: {}".format(audio_file, e))
+            error = str(e)
+        errors.append(error)
+
+    mels = None
+    if features is not None:
+        mel_config, feature_segments = features
+        try:
+            if feature_samples is None:
+                mono, source_rate = sound if backend == 'numpy' and sound is not None else decode_to_mono(audio_file)
+                feature_samples = resample_to_int16(mono, source_rate, mel_config['sampling_rate'])
+            mels = compute_segment_mels(feature_samples, feature_segments, mel_config)
+        except Exception as e:
+            print("Error: Computing mel features of {} problem: {}".format(audio_file, e))
+    return audio_file, total_segments, errors, mels
 
-    return head, len(content_data)
 
+def convert_source_task(args):
+    return convert_source(*args)
 
-def create_audio_files_from_segments_list(head_list, total_files, sampling_rate=22050, audio_format='wav', force_write=False):
+
+def create_audio_files_from_segments_list(segments_table, total_files, sampling_rate=22050, audio_format='wav', force_write=False, jobs=1, backend='auto', seek_threshold=4, compression_level=5, encoder_threads=2, dry_run=False, targets=None, shard=None, mel_config=None, features_dir=None):
     '''
-    Creates audio segments from a linked segment list.
+    Creates audio segments from a segment table. Each source file is decoded once, and sources are distributed over "jobs" processes.
+    targets is a list of (sampling_rate, audio_format, output_dir), all of them written from the same decode. By default,
+    the only target is sampling_rate and audio_format in the output dir of the table.
+    Only sources with missing or invalid outputs are scheduled. With dry_run, only prints the plans.
+    With shard, completed sources are recorded in the manifests of the shard.
+    With mel_config (see audio_tools/mel_features.py), the mel spectrograms of the segments missing in the feature store of
+    features_dir are computed in the same processes, from the decoded samples, and appended to the store.
     '''
-    curr = head_list
-    pbar = tqdm(total=total_files)
-    while curr is not None:
-        audio_file = curr.filesource
-        begin = curr.begin
-        end = curr.end
-        filepath = curr.filepath
-        sound = AudioSegment.from_file(audio_file, frame_rate=sampling_rate, channels=1)
-        audio_segment = sound[begin:end]
-        #print("Exporting {}".format(filepath))
-        try:
-            if audio_format == 'wav':
-                if not exists(filepath) or force_write:
-                    audio_segment.export(filepath, format = "wav")
-                else:
-                    print('Segment {} already exists!'.format(filepath))
-            else:
-                if not exists(filepath) or force_write:
-                    audio_segment.export(filepath, format = "flac")
-                else:
-                    print('Segment {} already exists!'.format(filepath))
-
-        except IOError:
-          print("Error: Writing audio segment {} problem.".format(filepath))
-          return False
+    if targets is None:
+        targets = [(sampling_rate, audio_format, segments_table.output_dir)]
+
+    # Sources to decode => [(target index, pending segments)]
+    sources_targets = collections.OrderedDict()
+    for index, (target_rate, target_format, target_dir) in enumerate(targets):
+        print('Target {} Hz {} at {}:'.format(target_rate, target_format, target_dir))
+        plan = plan_conversion(segments_table, target_rate, force_write, output_dir=target_dir, extension=get_extension(target_format), shard=shard)
+        plan.print_summary()
+        if dry_run:
+            continue
+        manifest_filepath = get_shard_filepath(get_manifest_filepath(target_dir), shard)
+        for source, total_segments in plan.verified_sources:
+            append_completed_source(manifest_filepath, get_target_key(target_rate, get_extension(target_format)), source, total_segments)
+        for source, segments in plan.tasks:
+            sources_targets.setdefault(source, []).append((index, segments))
+
+    # Sources => (begin, end, name) segments without features
+    sources_features = {}
+    if mel_config is not None:
+        if dry_run:
+            # The store is only read
+            done_names = set() if force_write else load_stored_names(features_dir, mel_config, shard)
         else:
-            curr = curr.next
-        pbar.update(1)
+            feature_store = FeatureStore(features_dir, mel_config, shard, force_write)
+            done_names = feature_store.get_names()
+        sources_features = plan_features(segments_table, mel_config, done_names)
+        print('Mel features: {} segments of {} sources to compute in {}.'.format(sum(len(segments) for segments in sources_features.values()), len(sources_features), features_dir))
+        for source in sources_features:
+            sources_targets.setdefault(source, [])
+    if dry_run:
+        return True
+
+    # Creates each output directory once
+    for directory in sorted(set(dirname(segment[2]) for targets_segments in sources_targets.values() for _, segments in targets_segments for segment in segments)):
+        makedirs(directory, exist_ok=True)
+
+    tasks = [
+        (audio_file, [(targets[index][0], targets[index][1], segments) for index, segments in targets_segments], backend, seek_threshold, compression_level, encoder_threads,
+         (mel_config, sources_features[audio_file]) if audio_file in sources_features else None)
+        for audio_file, targets_segments in sources_targets.items()
+    ]
 
+    failed_sources = []
+    pbar = tqdm(total=sum(len(segments) for task in tasks for _, _, segments in task[1]))
+    if int(jobs) > 1:
+        pool = Pool(int(jobs))
+        # imap keeps the results in the order of the sources
+        results = pool.imap(convert_source_task, tasks)
+    else:
+        pool = None
+        results = map(convert_source_task, tasks)
+
+    for audio_file, total_segments, errors, mels in results:
+        for (index, segments), error in zip(sources_targets[audio_file], errors):
+            target_rate, target_format, target_dir = targets[index]
+            if error is None:
+                append_completed_source(get_shard_filepath(get_manifest_filepath(target_dir), shard), get_target_key(target_rate, get_extension(target_format)), audio_file, len(segments))
+        if mels is not None:
+            feature_store.append(mels)
+        if any(error is not None for error in errors) or (audio_file in sources_features and mels is None):
+            failed_sources.append(audio_file)
+        pbar.update(total_segments)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
     pbar.close()
+
+    if failed_sources:
+        print('Error: {} of {} source files failed:'.format(len(failed_sources), len(tasks)))
+        for audio_file in failed_sources:
+            print(audio_file)
+        return False
     return True
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Plans the audio conversion before decoding anything: only sources with missing or invalid outputs are scheduled.
+#
+import json
+from os import scandir
+from os.path import dirname, isfile, join
+from utils.sharding import get_shard_filepath
+
+# Smaller files only have a header (or less)
+MIN_OUTPUT_BYTES = {'.wav': 44, '.flac': 42}
+# Approximate size of flac compared to 16 bits PCM
+FLAC_RATIO = 0.6
+
+
+def get_manifest_filepath(output_dir):
+    return join(output_dir, 'conversion_manifest.jsonl')
+
+
+def get_target_key(sampling_rate, extension):
+    return '{}{}'.format(sampling_rate, extension)
+
+
+def load_completed_sources(manifest_filepath, target_key):
+    '''
+    Get the sources already converted for a target from the completion manifest.
+    '''
+    completed = set()
+    if not isfile(manifest_filepath):
+        return completed
+    with open(manifest_filepath) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Line partially written by an interrupted run
+                continue
+            if entry['target'] == target_key:
+                completed.add(entry['source'])
+    return completed
+
+
+def append_completed_source(manifest_filepath, target_key, source, total_segments):
+    with open(manifest_filepath, 'a') as f:
+        f.write(json.dumps({'target': target_key, 'source': source, 'segments': total_segments}) + '\n')
+
+
+def scan_output_sizes(directories):
+    '''
+    Lists each output directory once. Returns filepath => size.
+    '''
+    sizes = {}
+    for directory in directories:
+        try:
+            with scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        sizes[join(directory, entry.name)] = entry.stat().st_size
+        except FileNotFoundError:
+            continue
+    return sizes
+
+
+def estimate_output_bytes(duration, sampling_rate, extension):
+    pcm_bytes = int(duration * int(sampling_rate) / 1000) * 2
+    if extension == '.flac':
+        return int(pcm_bytes * FLAC_RATIO) + MIN_OUTPUT_BYTES['.flac']
+    return pcm_bytes + MIN_OUTPUT_BYTES['.wav']
+
+
+class ConversionPlan:
+    '''
+    Sources to decode, each one with its pending (begin, end, filepath) segments.
+    '''
+    def __init__(self):
+        self.tasks = []
+        self.verified_sources = [] # (source, number of segments) found complete, but not in the manifest yet
+        self.total_sources = 0
+        self.total_segments = 0
+        self.pending_segments = 0
+        self.output_bytes = 0
+
+    def print_summary(self):
+        print('Sources: {} total, {} to decode.'.format(self.total_sources, len(self.tasks)))
+        print('Segments: {} total, {} to write.'.format(self.total_segments, self.pending_segments))
+        print('Estimated output: {:.1f} MB.'.format(self.output_bytes / 1024 ** 2))
+
+
+def plan_conversion(segments_table, sampling_rate=22050, force_write=False, use_manifest=True, output_dir=None, extension=None, shard=None):
+    '''
+    Computes which sources still have missing or invalid outputs, for one target (sampling_rate, output_dir and extension,
+    by default the ones of the table). Sources with a sample rate lower than sampling_rate are ignored.
+    Sources listed in the completion manifest are trusted, the other outputs are checked by listing their directories once.
+    With shard, the manifest of the shard is read too.
+    '''
+    output_dir = segments_table.output_dir if output_dir is None else output_dir
+    extension = segments_table.extension if extension is None else extension
+    target_key = get_target_key(sampling_rate, extension)
+    completed_sources = set()
+    if use_manifest and not force_write:
+        completed_sources = load_completed_sources(get_manifest_filepath(output_dir), target_key)
+        if shard is not None:
+            completed_sources |= load_completed_sources(get_shard_filepath(get_manifest_filepath(output_dir), shard), target_key)
+
+    if segments_table.source_rates is not None:
+        source_mask = [rate >= int(sampling_rate) for rate in segments_table.source_rates]
+        for source, valid in zip(segments_table.sources, source_mask):
+            if not valid:
+                print('Ignoring {} for {} Hz.'.format(source, sampling_rate))
+        segments_table = segments_table.filter_by_sources(source_mask)
+
+    plan = ConversionPlan()
+    sources = list(segments_table.group_by_source())
+    output_sizes = {}
+    if not force_write:
+        directories = set()
+        for source, segments in sources:
+            if source not in completed_sources:
+                directories.update(dirname(segments_table.get_output_filepath(row, output_dir, extension)) for row in segments)
+        output_sizes = scan_output_sizes(sorted(directories))
+
+    min_bytes = MIN_OUTPUT_BYTES.get(extension, 0)
+    for source, segments in sources:
+        plan.total_sources += 1
+        plan.total_segments += len(segments)
+        if source in completed_sources:
+            continue
+        pending = []
+        for row in segments:
+            filepath = segments_table.get_output_filepath(row, output_dir, extension)
+            if output_sizes.get(filepath, 0) > min_bytes:
+                continue
+            pending.append((float(row['begin']), float(row['end']), filepath))
+            plan.output_bytes += estimate_output_bytes(row['end'] - row['begin'], sampling_rate, extension)
+        if pending:
+            plan.tasks.append((source, pending))
+            plan.pending_segments += len(pending)
+        else:
+            plan.verified_sources.append((source, len(segments)))
+    return plan
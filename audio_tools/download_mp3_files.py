@@ -1,24 +1,21 @@
 from utils.utils import get_filepath_from_link, get_better_quality_link
-import urllib.request
-import urllib.error
+from utils.mls_reader import iter_segments
+from utils.download_manager import DownloadManager, DownloadError
+from utils.download_manifest import DownloadManifest, get_download_manifest_filepath
+from utils.sharding import get_shard_filepath
 from os.path import join, isfile
-from os import makedirs
+from os import makedirs, remove
 from tqdm import tqdm
-from random import randrange
+from concurrent.futures import ThreadPoolExecutor
 import collections
-import time
 
 
 def get_links_dict(segments_filepath, audio_quality):
     '''
     Get the links from segments filepath
     '''
-    with open(segments_filepath) as f :
-        content_data = f.readlines()
-
     links_dict = {}
-    for i, line in enumerate(tqdm(content_data)):
-        filename, link, _, _ = line.strip().split("\t")
+    for filename, link, _, _ in tqdm(iter_segments(segments_filepath)):
         # Get output folder to download file from link
         speakerid, bookid, fileid = filename.split('_')
         output_folder = join(speakerid, bookid)
@@ -36,49 +33,95 @@ def get_links_dict(segments_filepath, audio_quality):
     return ordered_links_dict
 
 
-def download_mp3_from_dict(links_dict='', audio_quality=64, output_dir='./', force_download=False):
+def is_downloaded(mp3_filepath, download_manifest=None):
     '''
-    Given a list of links, downloads mp3 files at 64kbs.
+    Verify if mp3 file exists. Files whose size (or checksum) does not match the download manifest are removed.
+    Files missing from the manifest were downloaded by older versions and are kept.
     '''
-    for i, (link, folder) in enumerate(tqdm(links_dict.items())):
-        # Getting complete filepath
-        output_path = join(output_dir, folder)
-        makedirs(output_path, exist_ok=True)
-
-        # Verify if a better quality 128 mp3 file exists
-        link128 = get_better_quality_link(link)
-        mp3_filepath128 = get_filepath_from_link(link128, output_path)
-        if isfile(mp3_filepath128) and not force_download:
-            print('File {} already downloaded.'.format(mp3_filepath128))
-            continue
-
-        # Defining audio quality on link
-        if int(audio_quality) == 128:
-            # Change link 64 to 128
-            link = link128
-
-        mp3_filepath = get_filepath_from_link(link, output_path)
-
-        # Print status
-        #print('Download {} / {} file: {}'.format(i, total, mp3_filename))
-
-        # Verify if mp3 file exists
-        if not isfile(mp3_filepath):
-            # if site is down wait
-            while True:
-                try:
-                    if urllib.request.urlopen("http://archive.org/").getcode() == 200:
-                        break
-                except:
-                    time.sleep(10)
-            try:
-                urllib.request.urlretrieve(link, mp3_filepath)
-            except:
-                print("Conection problem to acess {}... ".format(link))
-                continue
+    if not isfile(mp3_filepath):
+        return False
+    if download_manifest is not None and download_manifest.check(mp3_filepath) is False:
+        print('File {} is corrupt, downloading again.'.format(mp3_filepath))
+        remove(mp3_filepath)
+        return False
+    return True
+
+
+def download_mp3(link, folder, audio_quality=64, output_dir='./', force_download=False, download_manager=None, download_manifest=None, artifact_cache=None):
+    '''
+    Downloads one mp3 file. Returns (mp3 filepath, downloaded), or (None, False) on connection problems.
+    If a better quality 128 mp3 file exists, it is used instead.
+    Interrupted downloads are resumed from their .part file. Completed downloads are recorded in download_manifest.
+    With artifact_cache, files are linked from the cache, where missing files are downloaded first.
+    '''
+    # Getting complete filepath
+    output_path = join(output_dir, folder)
+    makedirs(output_path, exist_ok=True)
+
+    # Verify if a better quality 128 mp3 file exists
+    link128 = get_better_quality_link(link)
+    mp3_filepath128 = get_filepath_from_link(link128, output_path)
+    if not force_download and is_downloaded(mp3_filepath128, download_manifest):
+        print('File {} already downloaded.'.format(mp3_filepath128))
+        return mp3_filepath128, False
+
+    # Defining audio quality on link
+    if int(audio_quality) == 128:
+        # Change link 64 to 128
+        link = link128
+
+    mp3_filepath = get_filepath_from_link(link, output_path)
+
+    # Verify if mp3 file exists
+    if is_downloaded(mp3_filepath, download_manifest):
+        print('File {} already downloaded.'.format(mp3_filepath))
+        return mp3_filepath, False
+
+    if download_manager is None:
+        download_manager = DownloadManager()
+    try:
+        if artifact_cache is None:
+            info = download_manager.download(link, mp3_filepath)
         else:
-            print('File {} already downloaded.'.format(mp3_filepath))
-            continue
-        # Wait to avoid ip blocking
-        time.sleep(randrange(15,30))
-    return True
\ No newline at end of file
+            # mp3 files of LibriVox do not change, the cached ones are used without asking the server
+            entry = None if force_download else artifact_cache.lookup(link128)
+            if entry is not None:
+                artifact_cache.materialize(entry, mp3_filepath128)
+                mp3_filepath, link, info = mp3_filepath128, link128, entry
+            else:
+                info = artifact_cache.fetch(link, mp3_filepath, download_manager.download, force=force_download)
+    except DownloadError as e:
+        print("Conection problem to acess {}: {}".format(link, e))
+        return None, False
+    if download_manifest is not None:
+        download_manifest.add(mp3_filepath, link, info)
+    return mp3_filepath, True
+
+
+def download_mp3_from_dict(links_dict='', audio_quality=64, output_dir='./', force_download=False, connections=2, requests_per_second=0.5, verify_checksums=False, artifact_cache=None, shard=None):
+    '''
+    Given a list of links, downloads mp3 files at 64kbs.
+    Files are downloaded with at most "connections" connections and requests_per_second requests per host.
+    Downloaded files are checked against the download manifest of output_dir, by size (and md5 with verify_checksums).
+    With artifact_cache, files already downloaded by other splits, runs or machines are linked from the cache.
+    With shard, downloads are recorded in the download manifest of the shard.
+    '''
+    download_manager = DownloadManager(connections_per_host=connections, requests_per_second=requests_per_second)
+    makedirs(output_dir, exist_ok=True)
+    download_manifest = DownloadManifest(get_shard_filepath(get_download_manifest_filepath(output_dir), shard), verify_checksums)
+
+    def download(item):
+        link, folder = item
+        return download_mp3(link, folder, audio_quality, output_dir, force_download, download_manager, download_manifest, artifact_cache)
+
+    with ThreadPoolExecutor(connections) as executor:
+        results = list(tqdm(executor.map(download, links_dict.items()), total=len(links_dict)))
+    download_manager.close()
+    download_manager.print_stats()
+    if artifact_cache is not None:
+        artifact_cache.evict()
+
+    failed_links = [link for link, (mp3_filepath, _) in zip(links_dict.keys(), results) if mp3_filepath is None]
+    if failed_links:
+        print('{} of {} files could not be downloaded.'.format(len(failed_links), len(links_dict)))
+    return True
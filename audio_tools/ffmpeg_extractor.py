@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Segment extraction with ffmpeg input seeking, without decoding the whole source file.
+#
+import subprocess
+from os import replace, remove
+from os.path import isfile
+
+
+def extract_segment(audio_file, begin, end, filepath, sampling_rate=22050, audio_format='wav'):
+    '''
+    Extracts one segment (begin and end in milliseconds) with ffmpeg seeking (-ss/-t) on the input.
+    The output is written to a temporary file and renamed when complete.
+    '''
+    output_format = 'wav' if audio_format == 'wav' else 'flac'
+    tmp_filepath = filepath + '.tmp'
+    command = [
+        'ffmpeg', '-nostdin', '-v', 'error', '-y',
+        '-ss', '{:.3f}'.format(begin / 1000),
+        '-t', '{:.3f}'.format((end - begin) / 1000),
+        '-i', audio_file,
+        '-ac', '1', '-ar', str(sampling_rate),
+        '-f', output_format, tmp_filepath
+    ]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        if isfile(tmp_filepath):
+            remove(tmp_filepath)
+        raise IOError('ffmpeg failed on {}: {}'.format(audio_file, result.stderr.decode('utf-8', 'replace').strip()))
+    replace(tmp_filepath, filepath)
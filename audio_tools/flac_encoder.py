@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Batch FLAC encoding of in-memory clips.
+#
+import argparse
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import replace, remove
+from os.path import join, isfile
+import numpy as np
+
+try:
+    # Native libFLAC encoder (optional)
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+def get_flac_backend():
+    return 'soundfile' if soundfile is not None else 'ffmpeg'
+
+
+def encode_flac_soundfile(filepath, samples, sampling_rate, compression_level):
+    # soundfile expects a compression level between 0 and 1, libFLAC levels go from 0 to 8
+    with soundfile.SoundFile(filepath, 'w', int(sampling_rate), 1, 'PCM_16', format='FLAC', compression_level=compression_level / 8) as f:
+        f.write(samples)
+
+
+def encode_flac_ffmpeg(filepath, samples, sampling_rate, compression_level):
+    # PCM is fed through a pipe, without temporary wav files
+    command = [
+        'ffmpeg', '-nostdin', '-v', 'error', '-y',
+        '-f', 's16le', '-ar', str(sampling_rate), '-ac', '1', '-i', '-',
+        '-compression_level', str(compression_level), '-f', 'flac', filepath
+    ]
+    result = subprocess.run(command, input=memoryview(np.ascontiguousarray(samples, dtype='<i2')).cast('B'), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise IOError('ffmpeg failed on {}: {}'.format(filepath, result.stderr.decode('utf-8', 'replace').strip()))
+
+
+def encode_flac(filepath, samples, sampling_rate, compression_level=5):
+    '''
+    Encodes int16 mono samples to a flac file. The file is renamed when complete.
+    '''
+    tmp_filepath = filepath + '.tmp'
+    try:
+        if soundfile is not None:
+            encode_flac_soundfile(tmp_filepath, samples, sampling_rate, compression_level)
+        else:
+            encode_flac_ffmpeg(tmp_filepath, samples, sampling_rate, compression_level)
+        replace(tmp_filepath, filepath)
+    finally:
+        if isfile(tmp_filepath):
+            remove(tmp_filepath)
+
+
+def encode_flac_batch(clips, sampling_rate, compression_level=5, threads=2):
+    '''
+    Encodes many (filepath, samples) clips. Returns a list of (filepath, error), error is None on success.
+    libFLAC and ffmpeg both release the GIL, so clips are encoded in a thread pool.
+    '''
+    def encode(clip):
+        filepath, samples = clip
+        try:
+            encode_flac(filepath, samples, sampling_rate, compression_level)
+        except Exception as e:
+            return filepath, str(e)
+        return filepath, None
+
+    if int(threads) > 1:
+        with ThreadPoolExecutor(int(threads)) as executor:
+            return list(executor.map(encode, clips))
+    return [encode(clip) for clip in clips]
+
+
+def benchmark(total_clips=200, duration=8.0, sampling_rate=22050, compression_level=5, threads=4):
+    '''
+    Compares the batch encoder with pydub export (one ffmpeg per clip, from a temporary wav file).
+    '''
+    from pydub import AudioSegment
+
+    rng = np.random.RandomState(0)
+    t = np.arange(int(duration * sampling_rate)) / sampling_rate
+    clips_samples = [((np.sin(2 * np.pi * (200 + i) * t) * 8000) + rng.normal(0, 500, len(t))).astype('<i2') for i in range(total_clips)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.time()
+        for i, samples in enumerate(clips_samples):
+            sound = AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=sampling_rate, channels=1)
+            sound.export(join(tmp_dir, 'pydub_{}.flac'.format(i)), format='flac')
+        pydub_time = time.time() - start
+
+        start = time.time()
+        clips = [(join(tmp_dir, 'batch_{}.flac'.format(i)), samples) for i, samples in enumerate(clips_samples)]
+        errors = [error for _, error in encode_flac_batch(clips, sampling_rate, compression_level, threads) if error]
+        batch_time = time.time() - start
+
+    audio_seconds = total_clips * duration
+    print('pydub export: {:.2f}s ({:.1f}x realtime)'.format(pydub_time, audio_seconds / pydub_time))
+    print('batch encoder ({}, {} threads): {:.2f}s ({:.1f}x realtime)'.format(get_flac_backend(), threads, batch_time, audio_seconds / batch_time))
+    if errors:
+        print('Errors: {}'.format(errors[:5]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--total_clips', default=200)
+    parser.add_argument('-d', '--duration', default=8.0, help='Duration of each clip (seconds)')
+    parser.add_argument('-s', '--sampling_rate', default=22050)
+    parser.add_argument('-c', '--compression_level', default=5, help='FLAC compression level (0-8)')
+    parser.add_argument('-t', '--threads', default=4)
+    args = parser.parse_args()
+
+    benchmark(int(args.total_clips), float(args.duration), int(args.sampling_rate), int(args.compression_level), int(args.threads))
+
+
+if __name__ == "__main__":
+    main()
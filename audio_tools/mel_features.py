@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Log mel spectrograms computed with NumPy from decoded samples, and a memory-mapped float16 store of them.
+#
+import json
+from functools import lru_cache
+from glob import glob
+from os import makedirs, remove, replace, stat, truncate
+from os.path import basename, isfile, join
+import numpy as np
+from utils.sharding import get_shard_filepath
+from audio_tools.segment_table import NAME_DTYPE, encode_name
+
+# Parameters of the features, recorded in the store. batch_frames only bounds the memory used while computing them.
+DEFAULT_MEL_CONFIG = {'sampling_rate': 22050, 'n_fft': 1024, 'hop_length': 256, 'win_length': 1024, 'n_mels': 80,
+                      'fmin': 0.0, 'fmax': 8000.0, 'log_floor': 1e-5}
+BATCH_FRAMES = 4096
+# offset and frames are rows of the data array
+FEATURE_INDEX_DTYPE = np.dtype([('name', NAME_DTYPE), ('offset', '<i8'), ('frames', '<i4')])
+STORE_NAME = 'mels'
+
+
+def parse_mel_config(config_text=None):
+    '''
+    Get the mel parameters from a text like "n_mels=80,hop_length=256,fmax=8000" (missing ones get the default values).
+    '''
+    config = dict(DEFAULT_MEL_CONFIG)
+    if not config_text or config_text == 'default':
+        return config
+    for item in config_text.split(','):
+        key, value = item.strip().split('=')
+        if key not in config:
+            raise ValueError('Unknown mel parameter {}, options: {}'.format(key, ', '.join(sorted(config))))
+        config[key] = type(config[key])(value)
+    return config
+
+
+def hz_to_mel(frequencies):
+    '''
+    Slaney mel scale: linear below 1 kHz, logarithmic above.
+    '''
+    frequencies = np.asanyarray(frequencies, dtype=np.float64)
+    mels = frequencies / (200.0 / 3)
+    log_region = frequencies >= 1000.0
+    mels = np.where(log_region, 15.0 + np.log(np.maximum(frequencies, 1000.0) / 1000.0) / (np.log(6.4) / 27.0), mels)
+    return mels
+
+
+def mel_to_hz(mels):
+    mels = np.asanyarray(mels, dtype=np.float64)
+    frequencies = mels * (200.0 / 3)
+    return np.where(mels >= 15.0, 1000.0 * np.exp((np.log(6.4) / 27.0) * (mels - 15.0)), frequencies)
+
+
+@lru_cache(maxsize=8)
+def get_mel_filterbank(sampling_rate, n_fft, n_mels, fmin, fmax):
+    '''
+    Triangular mel filters with area normalization, shape (n_fft // 2 + 1, n_mels).
+    '''
+    fft_frequencies = np.linspace(0, sampling_rate / 2.0, n_fft // 2 + 1)
+    mel_frequencies = mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), n_mels + 2))
+    lower = fft_frequencies[:, None] - mel_frequencies[None, :-2]
+    upper = mel_frequencies[None, 2:] - fft_frequencies[:, None]
+    widths = np.diff(mel_frequencies)
+    filters = np.maximum(0, np.minimum(lower / widths[None, :-1], upper / widths[None, 1:]))
+    filters *= 2.0 / (mel_frequencies[2:] - mel_frequencies[:-2])[None, :]
+    return filters.astype(np.float32)
+
+
+@lru_cache(maxsize=8)
+def get_window(n_fft, win_length):
+    '''
+    Hann window of win_length, centered in n_fft.
+    '''
+    window = np.zeros(n_fft, dtype=np.float32)
+    start = (n_fft - win_length) // 2
+    window[start:start + win_length] = np.hanning(win_length + 1)[:-1]
+    return window
+
+
+def get_frames(samples, n_fft, hop_length):
+    '''
+    Get the centered frames of a signal (padded by reflection) as a strided view, shape (frames, n_fft).
+    '''
+    pad = n_fft // 2
+    mode = 'reflect' if len(samples) > pad else 'constant'
+    padded = np.pad(samples, pad, mode=mode)
+    total_frames = 1 + (len(padded) - n_fft) // hop_length
+    return np.lib.stride_tricks.as_strided(padded, shape=(total_frames, n_fft), strides=(padded.strides[0] * hop_length, padded.strides[0]), writeable=False)
+
+
+def compute_mels(clips, config, batch_frames=BATCH_FRAMES):
+    '''
+    Get the log mel spectrogram (float16, shape (frames, n_mels)) of each clip of float32 samples in [-1, 1].
+    The frames of consecutive clips are transformed together, in batches of about batch_frames frames.
+    '''
+    n_fft, hop_length = int(config['n_fft']), int(config['hop_length'])
+    filterbank = get_mel_filterbank(int(config['sampling_rate']), n_fft, int(config['n_mels']), float(config['fmin']), float(config['fmax']))
+    window = get_window(n_fft, int(config['win_length']))
+
+    mels = []
+    batch = []
+    batch_size = 0
+    def flush():
+        spectrum = np.abs(np.fft.rfft(np.concatenate(batch) * window, axis=1)).astype(np.float32)
+        mel = np.log(np.maximum(spectrum @ filterbank, config['log_floor'])).astype(np.float16)
+        start = 0
+        for frames in batch:
+            mels.append(mel[start:start + len(frames)])
+            start += len(frames)
+        del batch[:]
+
+    for clip in clips:
+        frames = get_frames(clip, n_fft, hop_length)
+        batch.append(frames)
+        batch_size += len(frames)
+        if batch_size >= batch_frames:
+            flush()
+            batch_size = 0
+    if batch:
+        flush()
+    return mels
+
+
+def compute_segment_mels(samples, segments, config):
+    '''
+    Get [(name, mel)] of the (begin, end, name) segments (milliseconds) of int16 samples at the sampling rate of config.
+    The samples are scaled like 16 bits wav files read for training.
+    '''
+    sampling_rate = int(config['sampling_rate'])
+    clips = []
+    for begin, end, _ in segments:
+        first = max(int(round(begin * sampling_rate / 1000)), 0)
+        last = max(int(round(end * sampling_rate / 1000)), first + 1)
+        clips.append(samples[first:last].astype(np.float32) / 32768.0)
+    return [(name, mel) for (_, _, name), mel in zip(segments, compute_mels(clips, config))]
+
+
+def plan_features(segments_table, config, done_names):
+    '''
+    Get source => (begin, end, name) segments of a segment table whose features are not in done_names.
+    Sources with a sample rate lower than the one of the features are ignored.
+    '''
+    if segments_table.source_rates is not None:
+        segments_table = segments_table.filter_by_sources([rate >= int(config['sampling_rate']) for rate in segments_table.source_rates])
+    sources_features = {}
+    for source, segments in segments_table.group_by_source():
+        pending = [(float(row['begin']), float(row['end']), row['name'].decode('ascii')) for row in segments if row['name'].decode('ascii') not in done_names]
+        if pending:
+            sources_features[source] = pending
+    return sources_features
+
+
+def get_store_filepaths(folder, shard=None):
+    '''
+    Get the (parameters, data, index) files of a store.
+    '''
+    root = get_shard_filepath(join(folder, STORE_NAME + '.json'), shard)[:-len('.json')]
+    return root + '.json', root + '.f16', root + '.index'
+
+
+def read_index(index_filepath):
+    '''
+    Get the rows of an index file, ignoring a partially written last row.
+    '''
+    with open(index_filepath, 'rb') as f:
+        data = f.read()
+    return np.frombuffer(data, dtype=FEATURE_INDEX_DTYPE, count=len(data) // FEATURE_INDEX_DTYPE.itemsize)
+
+
+def load_stored_names(folder, config, shard=None):
+    '''
+    Get the names of the segments in the store of folder, reading it without changing anything (for dry runs).
+    Returns an empty set if there is no store, or if it has other parameters and would be created again.
+    '''
+    config_filepath, _, index_filepath = get_store_filepaths(folder, shard)
+    if not isfile(config_filepath) or not isfile(index_filepath):
+        return set()
+    with open(config_filepath) as f:
+        stored_config = json.load(f)
+    if stored_config != config:
+        print('Feature store {} has other parameters, all the features would be computed again.'.format(index_filepath))
+        return set()
+    return set(name.decode('ascii') for name in read_index(index_filepath)['name'])
+
+
+class FeatureStore:
+    '''
+    Append-only store of the features of a folder: one float16 array of shape (total frames, n_mels) in mels.f16, the
+    (name, first row, number of rows) of each segment in mels.index and the parameters in mels.json. Data is written
+    before its index rows, so a store interrupted while writing is cut back to its last indexed segment when opened.
+    A store with other parameters is recreated. With shard, the files of the shard (mels.shard-0-of-4.*) are written.
+    Written by one process, read with load_feature_store.
+    '''
+    def __init__(self, folder, config, shard=None, force_write=False):
+        self.folder = folder
+        self.config = config
+        self.n_mels = int(config['n_mels'])
+        self.config_filepath, self.data_filepath, self.index_filepath = get_store_filepaths(folder, shard)
+        makedirs(folder, exist_ok=True)
+        stored_config = None
+        if isfile(self.config_filepath):
+            with open(self.config_filepath) as f:
+                stored_config = json.load(f)
+        if stored_config != config or force_write:
+            if stored_config is not None and stored_config != config:
+                print('Feature store {} has other parameters, it is created again.'.format(self.data_filepath))
+            for filepath in (self.data_filepath, self.index_filepath):
+                if isfile(filepath):
+                    remove(filepath)
+            with open(self.config_filepath + '.tmp', 'w') as f:
+                json.dump(config, f, indent=1)
+            replace(self.config_filepath + '.tmp', self.config_filepath)
+        self.total_frames = self.recover()
+
+    def recover(self):
+        '''
+        Cuts a partially written index row and the data without index rows. Returns the number of rows of the data.
+        '''
+        for filepath in (self.data_filepath, self.index_filepath):
+            open(filepath, 'ab').close()
+        index_size = stat(self.index_filepath).st_size
+        if index_size % FEATURE_INDEX_DTYPE.itemsize:
+            truncate(self.index_filepath, index_size - index_size % FEATURE_INDEX_DTYPE.itemsize)
+        index = np.fromfile(self.index_filepath, dtype=FEATURE_INDEX_DTYPE)
+        total_frames = int((index['offset'] + index['frames']).max()) if len(index) else 0
+        if stat(self.data_filepath).st_size != total_frames * self.n_mels * 2:
+            truncate(self.data_filepath, total_frames * self.n_mels * 2)
+        return total_frames
+
+    def get_names(self):
+        return set(name.decode('ascii') for name in np.fromfile(self.index_filepath, dtype=FEATURE_INDEX_DTYPE)['name'])
+
+    def append(self, features):
+        '''
+        Appends [(name, float16 array of shape (frames, n_mels))]. Raises ValueError before writing if a name is too long.
+        '''
+        names = [encode_name(name) for name, _ in features]
+        rows = np.zeros(len(features), dtype=FEATURE_INDEX_DTYPE)
+        with open(self.data_filepath, 'ab') as f:
+            for i, (name, mel) in enumerate(zip(names, (mel for _, mel in features))):
+                f.write(memoryview(np.ascontiguousarray(mel, dtype='<f2')).cast('B'))
+                rows[i] = (name, self.total_frames, len(mel))
+                self.total_frames += len(mel)
+        with open(self.index_filepath, 'ab') as f:
+            f.write(rows.tobytes())
+
+
+class FeatureReader:
+    '''
+    Reads the features of a folder (the store and the stores of its shards) from memory-mapped files, without decoding audio.
+    mel(name or position) returns a float16 view of shape (frames, n_mels). The parameters are in config.
+    '''
+    def __init__(self, folder):
+        self.config = None
+        self.arrays = []
+        indexes = []
+        for config_filepath in sorted(glob(join(folder, STORE_NAME + '*.json'))):
+            with open(config_filepath) as f:
+                config = json.load(f)
+            if self.config is not None and config != self.config:
+                raise ValueError('{} has other parameters than the other feature stores of {}.'.format(basename(config_filepath), folder))
+            self.config = config
+            data_filepath, index_filepath = config_filepath[:-len('.json')] + '.f16', config_filepath[:-len('.json')] + '.index'
+            if not isfile(index_filepath):
+                continue
+            # Only the indexed rows are mapped: data is written before its index rows, so a store being written
+            # (or interrupted) can have more data
+            index = read_index(index_filepath)
+            if len(index) == 0:
+                continue
+            total_frames = int((index['offset'] + index['frames']).max())
+            self.arrays.append(np.memmap(data_filepath, dtype='<f2', mode='r', shape=(total_frames, int(config['n_mels']))))
+            indexes.append((index, np.full(len(index), len(self.arrays) - 1, dtype='<i4')))
+        if self.config is None:
+            raise ValueError('No feature store in {}.'.format(folder))
+
+        index = np.concatenate([index for index, _ in indexes]) if indexes else np.zeros(0, dtype=FEATURE_INDEX_DTYPE)
+        stores = np.concatenate([stores for _, stores in indexes]) if indexes else np.zeros(0, dtype='<i4')
+        # Sorted by name, the last row of a repeated name is kept
+        order = np.argsort(index['name'], kind='stable')
+        keep = np.ones(len(order), dtype=bool)
+        keep[:-1] = index['name'][order][1:] != index['name'][order][:-1]
+        self.index = index[order][keep]
+        self.stores = stores[order][keep]
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return [name.decode('ascii') for name in self.index['name']]
+
+    def get_position(self, key):
+        if not isinstance(key, str):
+            return int(key)
+        name = key.encode('ascii')
+        position = int(np.searchsorted(self.index['name'], name))
+        if position == len(self.index) or self.index['name'][position] != name:
+            raise KeyError(key)
+        return position
+
+    def mel(self, key):
+        position = self.get_position(key)
+        row = self.index[position]
+        return self.arrays[self.stores[position]][row['offset']:row['offset'] + row['frames']]
+
+
+def load_feature_store(folder):
+    return FeatureReader(folder)
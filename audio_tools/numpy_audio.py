@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# In-process decoding to NumPy, polyphase resampling and WAV writing.
+#
+import struct
+import subprocess
+from math import gcd, ceil
+from os import replace
+import numpy as np
+
+
+def parse_wav_stream(data):
+    '''
+    Get (samples, sample_rate) from a 16 bits PCM wav stream. The sizes of streamed headers are ignored.
+    '''
+    if data[0:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise IOError('Invalid wav stream.')
+    position = 12
+    channels = sample_rate = None
+    while position + 8 <= len(data):
+        chunk_id = data[position:position + 4]
+        chunk_size = struct.unpack('<I', data[position + 4:position + 8])[0]
+        position += 8
+        if chunk_id == b'fmt ':
+            audio_format, channels, sample_rate = struct.unpack('<HHI', data[position:position + 8])
+            bits = struct.unpack('<H', data[position + 14:position + 16])[0]
+            if bits != 16:
+                raise IOError('Only 16 bits PCM is supported.')
+        elif chunk_id == b'data':
+            # Streamed wav files have an unknown (0xFFFFFFFF) data size
+            end = len(data) if chunk_size == 0xFFFFFFFF else min(len(data), position + chunk_size)
+            end -= (end - position) % (2 * channels)
+            samples = np.frombuffer(data, dtype='<i2', offset=position, count=(end - position) // 2)
+            return samples.reshape(-1, channels), sample_rate
+        position += chunk_size + (chunk_size % 2)
+    raise IOError('Wav stream without data.')
+
+
+def decode_to_array(audio_file):
+    '''
+    Decodes an audio file with ffmpeg through a pipe. Returns (samples with shape (frames, channels), sample_rate).
+    '''
+    command = ['ffmpeg', '-nostdin', '-v', 'error', '-i', audio_file, '-f', 'wav', '-acodec', 'pcm_s16le', '-']
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise IOError('ffmpeg failed on {}: {}'.format(audio_file, result.stderr.decode('utf-8', 'replace').strip()))
+    return parse_wav_stream(result.stdout)
+
+
+def to_mono(samples):
+    '''
+    Downmix (frames, channels) int16 samples to float32 mono.
+    '''
+    if samples.shape[1] == 1:
+        return samples[:, 0].astype(np.float32)
+    return samples.sum(axis=1, dtype=np.float32) / samples.shape[1]
+
+
+def design_lowpass(up, down, half_width=10, beta=5.0):
+    '''
+    Kaiser windowed sinc lowpass filter for resampling by up/down.
+    '''
+    max_rate = max(up, down)
+    cutoff = 1.0 / max_rate
+    half_length = half_width * max_rate
+    n = np.arange(-half_length, half_length + 1)
+    h = cutoff * np.sinc(cutoff * n) * np.kaiser(2 * half_length + 1, beta) * up
+    return h.astype(np.float32), half_length
+
+
+def resample_poly(x, up, down, half_width=10, beta=5.0):
+    '''
+    Polyphase resampling of a float32 signal by up/down.
+    Each output phase reads the input as a strided slice, so only (taps per phase) vector operations are done per phase.
+    '''
+    divisor = gcd(up, down)
+    up, down = up // divisor, down // divisor
+    if up == down:
+        return x.astype(np.float32)
+
+    h, center = design_lowpass(up, down, half_width, beta)
+    # Pads h so each phase has the same number of taps
+    taps = int(ceil(len(h) / up))
+    h = np.concatenate([h, np.zeros(taps * up - len(h), dtype=np.float32)])
+
+    n_out = int(ceil(len(x) * up / down))
+    front, back = taps, center // up + down + 2
+    x_padded = np.concatenate([np.zeros(front, dtype=np.float32), x.astype(np.float32), np.zeros(back, dtype=np.float32)])
+
+    y = np.zeros(n_out, dtype=np.float32)
+    for first in range(min(up, n_out)):
+        count = len(range(first, n_out, up))
+        phase = (first * down + center) % up
+        base = (first * down + center) // up + front
+        accumulator = np.zeros(count, dtype=np.float32)
+        for j, coefficient in enumerate(h[phase::up]):
+            if coefficient == 0:
+                continue
+            start = base - j
+            accumulator += coefficient * x_padded[start:start + down * (count - 1) + 1:down]
+        y[first::up] = accumulator
+    return y
+
+
+def to_int16(x):
+    return np.clip(np.rint(x), -32768, 32767).astype('<i2')
+
+
+def decode_to_mono(audio_file):
+    '''
+    Decodes a source file to one float32 mono array. Returns (samples, sample_rate).
+    '''
+    samples, source_rate = decode_to_array(audio_file)
+    return to_mono(samples), source_rate
+
+
+def resample_to_int16(mono, source_rate, sampling_rate):
+    return to_int16(resample_poly(mono, int(sampling_rate), int(source_rate)))
+
+
+def decode_and_resample(audio_file, sampling_rate):
+    '''
+    Decodes a source file to one int16 mono array at sampling_rate.
+    '''
+    mono, source_rate = decode_to_mono(audio_file)
+    return resample_to_int16(mono, source_rate, sampling_rate)
+
+
+def get_segment_slice(samples, begin, end, sampling_rate):
+    '''
+    Get the samples between begin and end (milliseconds) as a view, without copying.
+    '''
+    first = int(round(begin * sampling_rate / 1000))
+    last = int(round(end * sampling_rate / 1000))
+    return samples[max(first, 0):max(last, 0)]
+
+
+def write_wav(filepath, samples, sampling_rate):
+    '''
+    Writes int16 mono samples to a wav file: header and a memoryview of the buffer. The file is renamed when complete.
+    '''
+    data = memoryview(np.ascontiguousarray(samples, dtype='<i2')).cast('B')
+    header = struct.pack('<4sI4s4sIHHIIHH4sI',
+                         b'RIFF', 36 + data.nbytes, b'WAVE',
+                         b'fmt ', 16, 1, 1, int(sampling_rate), int(sampling_rate) * 2, 2, 16,
+                         b'data', data.nbytes)
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        f.write(header)
+        f.write(data)
+    replace(tmp_filepath, filepath)
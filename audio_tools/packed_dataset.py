@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Packs the audio segments of a split and their punctuated transcripts in tar shards with an offset index, and reads them back.
+#
+import argparse
+import io
+import json
+import mmap
+import tarfile
+from glob import glob
+from os import makedirs, remove, replace, stat
+from os.path import basename, dirname, isfile, join, splitext
+import numpy as np
+from audio_tools.audio_converter import get_extension
+from audio_tools.numpy_audio import parse_wav_stream
+from audio_tools.segment_table import NAME_DTYPE, encode_name
+from utils.mls_reader import iter_lines, iter_sorted_transcripts
+from utils.download_dataset import get_language_dataset_url, SPLITS
+
+# Offsets of the data of the audio and text members of each segment in its tar shard, sorted by name
+INDEX_DTYPE = np.dtype([('name', NAME_DTYPE), ('shard', '<i4'), ('audio_offset', '<i8'), ('audio_size', '<i8'), ('text_offset', '<i8'), ('text_size', '<i4')])
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def get_shard_filename(name, shard_index):
+    return '{}-{:06d}.tar'.format(name, shard_index)
+
+
+def get_metadata_filepath(output_dir, name):
+    return join(output_dir, name + '.json')
+
+
+def get_index_filepath(output_dir, name):
+    return join(output_dir, name + '.index.npz')
+
+
+def get_transcripts_files(split_folder):
+    '''
+    Get the output_result.txt files of a split: the merged one of the split if there is one, otherwise the ones of each book,
+    in the folders of the books or in <split>/text (text_module with --use_index).
+    '''
+    split_result = join(split_folder, 'output_result.txt')
+    if isfile(split_result):
+        return [split_result]
+    return sorted(glob(join(split_folder, 'audio', '*', '*', 'output_result.txt')) + glob(join(split_folder, 'text', '*_output_result.txt')))
+
+
+def iter_result_lines(transcripts_files):
+    '''
+    Yields "name\ttext" lines from output_result.txt files ("filepath|punctuated text|book text" lines).
+    '''
+    for transcripts_file in transcripts_files:
+        for line in iter_lines(transcripts_file):
+            fields = line.rstrip('\n').split('|')
+            if len(fields) < 2:
+                continue
+            name = splitext(basename(fields[0]))[0]
+            yield '{}\t{}\n'.format(name, fields[1].replace('\t', ' ').strip())
+
+
+def add_member(tar, member_name, data, mtime=0):
+    '''
+    Adds bytes to a tar file. Returns the offset of the data in the tar file.
+    '''
+    info = tarfile.TarInfo(member_name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
+    # The data ends at the last block written, padded to BLOCK_SIZE
+    return tar.offset - ((len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+
+
+class ShardWriter:
+    '''
+    Writes segments to tar shards of about max_shard_size bytes (a shard is closed when it gets over it), with the members
+    <name><extension> and <name>.txt for each segment, and records their offsets. The tar files are standard ones, so they
+    can also be read sequentially by other tools.
+    '''
+    def __init__(self, output_dir, name, max_shard_size):
+        self.output_dir = output_dir
+        self.name = name
+        self.max_shard_size = max_shard_size
+        self.shards = []
+        self.rows = []
+        self.tar = None
+        makedirs(output_dir, exist_ok=True)
+
+    def open_shard(self):
+        shard_filepath = join(self.output_dir, get_shard_filename(self.name, len(self.shards)))
+        self.tar = tarfile.open(shard_filepath + '.tmp', 'w', format=tarfile.USTAR_FORMAT)
+        self.shards.append({'filename': basename(shard_filepath), 'segments': 0, 'size': 0})
+
+    def close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        shard_filepath = join(self.output_dir, self.shards[-1]['filename'])
+        replace(shard_filepath + '.tmp', shard_filepath)
+        self.shards[-1]['size'] = stat(shard_filepath).st_size
+        self.tar = None
+
+    def add(self, name, audio, extension, text):
+        encoded_name = encode_name(name)
+        if self.tar is not None and self.tar.offset >= self.max_shard_size:
+            self.close_shard()
+        if self.tar is None:
+            self.open_shard()
+        audio_offset = add_member(self.tar, name + extension, audio)
+        text_data = text.encode('utf-8')
+        text_offset = add_member(self.tar, name + '.txt', text_data)
+        self.rows.append((encoded_name, len(self.shards) - 1, audio_offset, len(audio), text_offset, len(text_data)))
+        self.shards[-1]['segments'] += 1
+
+    def close(self):
+        self.close_shard()
+        index = np.array(self.rows, dtype=INDEX_DTYPE)
+        return index[np.argsort(index['name'], kind='stable')]
+
+
+def pack_split(transcripts_files, audio_dir, output_dir, name, audio_format='wav', max_shard_size=1024 ** 3, max_lines_in_memory=1000000):
+    '''
+    Packs the segments of audio_dir (<speaker>/<book>/<name>.wav or .flac) that have a transcript in transcripts_files
+    (output_result.txt files) in tar shards of output_dir, sorted by name. Writes <name>.index.npz (offsets of the members
+    of each segment) and <name>.json (shards, audio format and counts), read with PackedDataset.
+    Segments without audio file are skipped. Returns the number of packed segments.
+    '''
+    extension = get_extension(audio_format)
+    writer = ShardWriter(output_dir, name, max_shard_size)
+    missing = 0
+    for segment_name, text in iter_sorted_transcripts(iter_result_lines(transcripts_files), max_lines_in_memory):
+        speaker, book, _ = segment_name.split('_')
+        audio_filepath = join(audio_dir, speaker, book, segment_name + extension)
+        if not isfile(audio_filepath):
+            missing += 1
+            continue
+        with open(audio_filepath, 'rb') as f:
+            writer.add(segment_name, f.read(), extension, text)
+    index = writer.close()
+
+    tmp_filepath = get_index_filepath(output_dir, name) + '.tmp.npz'
+    np.savez(tmp_filepath, index=index)
+    replace(tmp_filepath, get_index_filepath(output_dir, name))
+    metadata = {'name': name, 'audio_format': audio_format, 'extension': extension, 'audio_dir': audio_dir, 'segments': len(index),
+                'missing_audio': missing, 'max_shard_size': max_shard_size, 'shards': writer.shards}
+    with open(get_metadata_filepath(output_dir, name) + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=1)
+    replace(get_metadata_filepath(output_dir, name) + '.tmp', get_metadata_filepath(output_dir, name))
+
+    # Shards of a previous, bigger packing
+    shard_filenames = set(shard['filename'] for shard in writer.shards)
+    for shard_filepath in glob(join(output_dir, '{}-*.tar'.format(name))):
+        if basename(shard_filepath) not in shard_filenames:
+            remove(shard_filepath)
+
+    print('Packed {} segments of {} in {} shards at {} ({} transcripts without audio).'.format(len(index), audio_dir, len(writer.shards), output_dir, missing))
+    return len(index)
+
+
+class PackedDataset:
+    '''
+    Reads the segments packed by pack_split. Shards are memory-mapped when first read, so the reads do not copy the audio
+    (the returned memoryviews point to the mapped files), and each process of a data loader maps them on its own.
+    Segments are read by position or by name (binary search on the sorted index), or sequentially shard by shard.
+    '''
+    def __init__(self, metadata_filepath):
+        with open(metadata_filepath) as f:
+            self.metadata = json.load(f)
+        self.folder = dirname(metadata_filepath)
+        with np.load(get_index_filepath(self.folder, self.metadata['name'])) as data:
+            self.index = data['index']
+        self.extension = self.metadata['extension']
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_shard_map(self, shard_index):
+        if shard_index not in self.maps:
+            with open(join(self.folder, self.metadata['shards'][shard_index]['filename']), 'rb') as f:
+                # The mapping stays valid after the file is closed
+                shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard_index] = (shard_map, memoryview(shard_map))
+        return self.maps[shard_index][1]
+
+    def get_position(self, key):
+        '''
+        Get the position in the index of a segment name or position. Raises KeyError if there is no such segment.
+        '''
+        if not isinstance(key, str):
+            return int(key)
+        name = key.encode('ascii')
+        position = int(np.searchsorted(self.index['name'], name))
+        if position == len(self.index) or self.index['name'][position] != name:
+            raise KeyError(key)
+        return position
+
+    def get_row_audio(self, row):
+        return self.get_shard_map(int(row['shard']))[row['audio_offset']:row['audio_offset'] + row['audio_size']]
+
+    def get_row_text(self, row):
+        return bytes(self.get_shard_map(int(row['shard']))[row['text_offset']:row['text_offset'] + row['text_size']]).decode('utf-8')
+
+    def get_audio(self, key):
+        '''
+        Get the audio file of a segment as a memoryview of its shard.
+        '''
+        return self.get_row_audio(self.index[self.get_position(key)])
+
+    def get_text(self, key):
+        return self.get_row_text(self.index[self.get_position(key)])
+
+    def get_samples(self, key):
+        '''
+        Get (int16 samples with shape (frames, channels), sample_rate) of a wav segment, without copying them.
+        '''
+        if self.extension != '.wav':
+            raise ValueError('Only wav segments can be read as samples, decode {} segments from get_audio().'.format(self.extension))
+        return parse_wav_stream(self.get_audio(key))
+
+    def __getitem__(self, key):
+        '''
+        Get (name, audio, text) of a segment by position or name.
+        '''
+        row = self.index[self.get_position(key)]
+        return row['name'].decode('ascii'), self.get_row_audio(row), self.get_row_text(row)
+
+    def iter_shard(self, shard_index):
+        '''
+        Yields (name, audio, text) of the segments of a shard in the order they are stored, reading the shard sequentially.
+        '''
+        rows = self.index[self.index['shard'] == shard_index]
+        for row in rows[np.argsort(rows['audio_offset'], kind='stable')]:
+            yield row['name'].decode('ascii'), self.get_row_audio(row), self.get_row_text(row)
+
+    def __iter__(self):
+        for shard_index in range(len(self.metadata['shards'])):
+            for item in self.iter_shard(shard_index):
+                yield item
+
+    def close(self):
+        '''
+        Unmaps the shards. Shards with memoryviews still in use are unmapped when they are released.
+        '''
+        for shard_map, view in self.maps.values():
+            view.release()
+            try:
+                shard_map.close()
+            except BufferError:
+                pass
+        self.maps = {}
+
+
+def load_packed_dataset(output_dir, name):
+    return PackedDataset(get_metadata_filepath(output_dir, name))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--language', default='pt', help='Options: pt (portuguese), pl (polish), it (italian), sp (spanish), fr (french), du (dutch), ge (german), en (english)')
+    parser.add_argument('-d', '--dataset_dir', default=None, help='Folder of the splits (default: the folder of the language archive)')
+    parser.add_argument('-a', '--audio_dir', default='audio', help='Folder of the audio segments, relative to each split folder')
+    parser.add_argument('-f', '--audio_format', default='wav', help='wav or flac')
+    parser.add_argument('-o', '--output_dir', default='packed', help='Folder of the shards, relative to each split folder')
+    parser.add_argument('-s', '--shard_size', default=1024, help='Size of each shard in MB')
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset_dir or basename(get_language_dataset_url(args.language)).split('.')[0]
+    for split in SPLITS:
+        split_folder = join(dataset_dir, split)
+        transcripts_files = get_transcripts_files(split_folder)
+        if not transcripts_files:
+            print('No output_result.txt files in {}, run the text conversion first.'.format(split_folder))
+            continue
+        pack_split(transcripts_files, join(split_folder, args.audio_dir), join(split_folder, args.output_dir), split, args.audio_format, int(float(args.shard_size) * 1024 ** 2))
+
+
+if __name__ == "__main__":
+    main()
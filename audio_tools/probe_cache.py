@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Cache of mediainfo (ffprobe) results, keyed by path, size and mtime.
+#
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import replace, stat
+from os.path import isfile
+from pydub.utils import mediainfo
+from tqdm import tqdm
+
+PROBE_FIELDS = ['sample_rate', 'channels', 'duration', 'codec_name']
+
+
+class ProbeCache:
+    '''
+    Persists mediainfo results in a JSON sidecar, so each source file is probed only once.
+    '''
+    def __init__(self, cache_filepath):
+        self.cache_filepath = cache_filepath
+        self.entries = {}
+        self.load(cache_filepath)
+
+    def load(self, cache_filepath):
+        '''
+        Adds the entries of a cache file (like the cache of the whole split, for a shard).
+        '''
+        if isfile(cache_filepath):
+            try:
+                with open(cache_filepath) as f:
+                    self.entries.update(json.load(f))
+            except ValueError:
+                print('Ignoring invalid probe cache {}.'.format(cache_filepath))
+
+    def get(self, filepath):
+        '''
+        Get the cached info of a file, or None if it was not probed or it changed since.
+        '''
+        entry = self.entries.get(filepath)
+        if entry is None:
+            return None
+        file_stat = stat(filepath)
+        if entry['size'] != file_stat.st_size or entry['mtime'] != file_stat.st_mtime:
+            return None
+        return entry['info']
+
+    def probe(self, filepath):
+        file_stat = stat(filepath)
+        info = mediainfo(filepath)
+        self.entries[filepath] = {
+            'size': file_stat.st_size,
+            'mtime': file_stat.st_mtime,
+            'info': {field: info.get(field) for field in PROBE_FIELDS}
+        }
+        return self.entries[filepath]['info']
+
+    def probe_all(self, filepaths, max_workers=8):
+        '''
+        Probes every file missing from the cache, running at most max_workers ffprobe processes at once.
+        '''
+        missing = [filepath for filepath in sorted(set(filepaths)) if self.get(filepath) is None]
+        if missing:
+            print('Probing {} source files...'.format(len(missing)))
+            with ThreadPoolExecutor(max_workers) as executor:
+                list(tqdm(executor.map(self.probe, missing), total=len(missing)))
+            self.save()
+        return {filepath: self.get(filepath) for filepath in filepaths}
+
+    def save(self):
+        tmp_filepath = self.cache_filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(self.entries, f)
+        replace(tmp_filepath, self.cache_filepath)
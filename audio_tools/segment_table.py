@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Columnar table of audio segments.
+#
+from array import array
+from os import replace
+from os.path import join
+import numpy as np
+
+# Segment names ("speaker_book_id") are stored as fixed width ascii bytes
+NAME_WIDTH = 24
+NAME_DTYPE = 'S{}'.format(NAME_WIDTH)
+# begin and end in milliseconds, source is an index on SegmentTable.sources
+SEGMENT_DTYPE = np.dtype([('source', '<i4'), ('name', NAME_DTYPE), ('begin', '<i4'), ('end', '<i4')])
+
+
+def encode_name(name):
+    '''
+    Get a segment name as the bytes of a NAME_DTYPE field. Raises ValueError if it does not fit, instead of truncating it.
+    '''
+    encoded = name.encode('ascii')
+    if len(encoded) > NAME_WIDTH:
+        raise ValueError('Segment name {} is longer than {} characters.'.format(name, NAME_WIDTH))
+    return encoded
+
+
+class SegmentTableBuilder:
+    '''
+    Appends segments and builds a SegmentTable, interning the source filepaths.
+    '''
+    def __init__(self):
+        self.sources = []
+        self.source_ids = {}
+        self.source_column = array('i')
+        self.begin_column = array('i')
+        self.end_column = array('i')
+        self.names = []
+
+    def add(self, source, name, begin, end):
+        '''
+        Adds a segment, begin and end in milliseconds. Raises ValueError if the name is longer than NAME_WIDTH.
+        '''
+        encoded_name = encode_name(name)
+        source_id = self.source_ids.get(source)
+        if source_id is None:
+            source_id = self.source_ids[source] = len(self.sources)
+            self.sources.append(source)
+        self.source_column.append(source_id)
+        self.begin_column.append(int(round(begin)))
+        self.end_column.append(int(round(end)))
+        self.names.append(encoded_name)
+
+    def build(self, output_dir='./', extension='.wav'):
+        segments = np.zeros(len(self.names), dtype=SEGMENT_DTYPE)
+        segments['source'] = np.asarray(self.source_column, dtype='<i4')
+        segments['begin'] = np.asarray(self.begin_column, dtype='<i4')
+        segments['end'] = np.asarray(self.end_column, dtype='<i4')
+        segments['name'] = self.names
+        return SegmentTable(segments, self.sources, output_dir, extension)
+
+
+class SegmentTable:
+    '''
+    Segments stored in a NumPy structured array (SEGMENT_DTYPE), with the source filepaths interned in a list.
+    Output files are <output_dir>/<speaker>/<book>/<name><extension>.
+    '''
+    def __init__(self, segments, sources, output_dir='./', extension='.wav'):
+        self.segments = segments
+        self.sources = sources
+        self.output_dir = output_dir
+        self.extension = extension
+        self.source_rates = None # sample rate of each source, when probed
+
+    def __len__(self):
+        return len(self.segments)
+
+    def nbytes(self):
+        return self.segments.nbytes
+
+    def copy_with(self, segments):
+        table = SegmentTable(segments, self.sources, self.output_dir, self.extension)
+        table.source_rates = self.source_rates
+        return table
+
+    def select(self, rows):
+        '''
+        Get a new table with the selected rows (boolean mask or indexes), sharing the sources.
+        '''
+        return self.copy_with(self.segments[rows])
+
+    def durations(self):
+        return self.segments['end'] - self.segments['begin']
+
+    def filter_by_duration(self, min_duration=0, max_duration=None):
+        '''
+        Keeps segments with duration (milliseconds) between min_duration and max_duration.
+        '''
+        durations = self.durations()
+        mask = durations >= min_duration
+        if max_duration is not None:
+            mask &= durations <= max_duration
+        return self.select(mask)
+
+    def filter_by_sources(self, source_mask):
+        '''
+        Keeps segments whose source is True in source_mask (one boolean per source).
+        '''
+        return self.select(np.asarray(source_mask, dtype=bool)[self.segments['source']])
+
+    def sort_by_offset(self):
+        '''
+        Sorts segments by source and begin.
+        '''
+        return self.select(np.lexsort((self.segments['begin'], self.segments['source'])))
+
+    def get_output_filepath(self, row, output_dir=None, extension=None):
+        name = row['name'].decode('ascii')
+        speaker, book, _ = name.split('_')
+        return join(self.output_dir if output_dir is None else output_dir, speaker, book, name + (self.extension if extension is None else extension))
+
+    def group_by_source(self):
+        '''
+        Yields (source filepath, segments) for each source, in the order the sources were added.
+        '''
+        order = np.argsort(self.segments['source'], kind='stable')
+        segments = self.segments[order]
+        if len(segments) == 0:
+            return
+        boundaries = np.flatnonzero(np.diff(segments['source'])) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(segments)]])
+        for start, end in zip(starts, ends):
+            yield self.sources[segments['source'][start]], segments[start:end]
+
+    def merge_adjacent(self, max_gap=0):
+        '''
+        Merges consecutive segments of the same source whose gap (milliseconds) is at most max_gap.
+        The merged segment keeps the name of its first segment.
+        '''
+        if len(self) == 0:
+            return self
+        segments = self.sort_by_offset().segments
+        new_group = np.ones(len(segments), dtype=bool)
+        new_group[1:] = (segments['source'][1:] != segments['source'][:-1]) | (segments['begin'][1:] - segments['end'][:-1] > max_gap)
+        starts = np.flatnonzero(new_group)
+        merged = segments[starts].copy()
+        merged['end'] = np.maximum.reduceat(segments['end'], starts)
+        return self.copy_with(merged)
+
+    def save(self, filepath):
+        '''
+        Saves the table to a .npz file, read back with load_segment_table.
+        '''
+        tmp_filepath = filepath + '.tmp.npz'
+        np.savez(tmp_filepath, segments=self.segments, sources=np.array(self.sources, dtype=str),
+                 source_rates=np.array(self.source_rates if self.source_rates is not None else [], dtype='<i4'),
+                 output_dir=np.array(self.output_dir), extension=np.array(self.extension))
+        replace(tmp_filepath, filepath)
+
+    def partition(self, total_parts):
+        '''
+        Splits the table in total_parts tables, keeping each source in one part and balancing the number of segments.
+        '''
+        counts = np.bincount(self.segments['source'], minlength=len(self.sources))
+        loads = np.zeros(total_parts, dtype=np.int64)
+        assignment = np.zeros(len(self.sources), dtype=np.int64)
+        # Greedy: biggest sources first, each one to the least loaded part
+        for source_id in np.argsort(-counts, kind='stable'):
+            part = int(np.argmin(loads))
+            assignment[source_id] = part
+            loads[part] += counts[source_id]
+        return [self.filter_by_sources(assignment == part) for part in range(total_parts)]
+
+
+def load_segment_table(filepath):
+    with np.load(filepath) as data:
+        table = SegmentTable(data['segments'], data['sources'].tolist(), str(data['output_dir']), str(data['extension']))
+        if len(data['source_rates']) == len(table.sources) and len(table.sources):
+            table.source_rates = data['source_rates'].tolist()
+    return table
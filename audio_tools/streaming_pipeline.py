@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Overlapped download and conversion: each source is converted as soon as it is downloaded.
+#
+import collections
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from os import makedirs, remove
+from os.path import join, dirname, isfile
+from tqdm import tqdm
+from utils.utils import get_filepath_from_link, get_better_quality_link
+from utils.mls_reader import iter_segments
+from utils.download_manager import DownloadManager
+from utils.download_manifest import DownloadManifest, get_download_manifest_filepath
+from audio_tools.audio_converter import get_source_filepath, get_extension, convert_source
+from audio_tools.conversion_plan import plan_conversion, get_manifest_filepath, get_target_key, append_completed_source
+from audio_tools.download_mp3_files import download_mp3
+from audio_tools.probe_cache import ProbeCache
+from utils.sharding import get_shard_filepath
+from audio_tools.segment_table import SegmentTableBuilder
+
+
+def create_planned_segments_list(segments_filepath, audio_format='wav', audio_quality=64, output_dir='./'):
+    '''
+    Creates a segment table from a file without requiring the mp3 files. Sources are the downloaded mp3 filepaths,
+    or the filepaths they will be downloaded to. Returns (segments table, source filepath => (link, folder)).
+    '''
+    source_links = {}
+    link_sources = {}
+    builder = SegmentTableBuilder()
+    for filename, link, begin, end in tqdm(iter_segments(segments_filepath)):
+        mp3_filepath = link_sources.get(link)
+        if mp3_filepath is None:
+            speakerid, bookid, fileid = filename.split('_')
+            folder = join(speakerid, bookid)
+            output_path = join(output_dir, folder)
+            mp3_filepath = get_source_filepath(link, output_path, audio_quality)
+            if mp3_filepath is None:
+                mp3_filepath = get_filepath_from_link(get_better_quality_link(link) if int(audio_quality) == 128 else link, output_path)
+            link_sources[link] = mp3_filepath
+            source_links[mp3_filepath] = (link, folder)
+        # Creating segment (milliseconds)
+        builder.add(mp3_filepath, filename, float(begin)*1000, float(end)*1000)
+    return builder.build(output_dir, get_extension(audio_format)), source_links
+
+
+def download_sources(sources, source_links, sources_queue, audio_quality=64, output_dir='./', force_download=False, stop_event=None, download_manager=None, connections=2, download_manifest=None, artifact_cache=None):
+    '''
+    Producer: downloads the sources, "connections" at once, and puts (source, mp3 filepath) in sources_queue,
+    or (source, None) if the download failed. The queue is bounded, so the downloads wait while the converters are behind.
+    None marks the end.
+    '''
+    def download(source):
+        link, folder = source_links[source]
+        try:
+            mp3_filepath, _ = download_mp3(link, folder, audio_quality, output_dir, force_download, download_manager, download_manifest, artifact_cache)
+        except Exception as e:
+            # Any error (folders, links, cache) fails this source only, so the end of the queue still means all sources were put
+            print("Error: Downloading {} problem: {}".format(link, e))
+            mp3_filepath = None
+        return source, mp3_filepath
+
+    try:
+        with ThreadPoolExecutor(connections) as executor:
+            running = set()
+            for source in sources:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                while len(running) >= connections:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        sources_queue.put(future.result())
+                running.add(executor.submit(download, source))
+            for future in running:
+                sources_queue.put(future.result())
+    finally:
+        sources_queue.put(None)
+
+
+def execution_streaming_conversion(segments_filepath, targets, audio_quality=64, output_dir='./', force_download=False, force_write=False, delete_files=False, jobs=1, queue_size=2, backend='auto', seek_threshold=4, compression_level=5, encoder_threads=2, connections=2, requests_per_second=0.5, verify_checksums=False, artifact_cache=None, shard=None):
+    '''
+    Downloads and converts the sources of a segments file at the same time. targets is a list of (sampling_rate, audio_format, output_dir).
+    Only sources with missing or invalid outputs are downloaded. A downloaded source waits in a queue of queue_size sources
+    until one of the "jobs" converter processes is free. With delete_files, each mp3 file is removed once its segments are written,
+    so at most queue_size + jobs mp3 files (plus the ones being downloaded) are on disk at once.
+    With artifact_cache, mp3 files are linked from the cache (deleting them keeps the cached copy).
+    With shard, the manifests and the probe cache of the shard are written instead of the ones of the split.
+    Returns False if any source failed.
+    '''
+    print('Creating segments list...')
+    segments_table, source_links = create_planned_segments_list(segments_filepath, targets[0][1], audio_quality, output_dir)
+
+    # Sources to convert => [(target index, pending segments)]
+    sources_targets = collections.OrderedDict()
+    for index, (target_rate, target_format, target_dir) in enumerate(targets):
+        print('Target {} Hz {} at {}:'.format(target_rate, target_format, target_dir))
+        plan = plan_conversion(segments_table, target_rate, force_write, output_dir=target_dir, extension=get_extension(target_format), shard=shard)
+        plan.print_summary()
+        manifest_filepath = get_shard_filepath(get_manifest_filepath(target_dir), shard)
+        for source, total_segments in plan.verified_sources:
+            append_completed_source(manifest_filepath, get_target_key(target_rate, get_extension(target_format)), source, total_segments)
+        for source, segments in plan.tasks:
+            sources_targets.setdefault(source, []).append((index, segments))
+
+    # Creates each output directory once
+    for directory in sorted(set(dirname(segment[2]) for targets_segments in sources_targets.values() for _, segments in targets_segments for segment in segments)):
+        makedirs(directory, exist_ok=True)
+
+    sources_queue = queue.Queue(maxsize=max(int(queue_size), 1))
+    stop_event = threading.Event()
+    download_manager = DownloadManager(connections_per_host=connections, requests_per_second=requests_per_second)
+    makedirs(output_dir, exist_ok=True)
+    download_manifest = DownloadManifest(get_shard_filepath(get_download_manifest_filepath(output_dir), shard), verify_checksums)
+    producer = threading.Thread(target=download_sources, args=(list(sources_targets.keys()), source_links, sources_queue, audio_quality, output_dir, force_download, stop_event, download_manager, connections, download_manifest, artifact_cache), daemon=True)
+    producer.start()
+
+    probe_cache = ProbeCache(get_shard_filepath(join(output_dir, 'probe_cache.json'), shard))
+    if shard is not None:
+        probe_cache.load(join(output_dir, 'probe_cache.json'))
+    failed_sources = []
+    pending = {}
+    pbar = tqdm(total=sum(len(segments) for targets_segments in sources_targets.values() for _, segments in targets_segments))
+
+    def finish(future):
+        source, mp3_filepath, targets_indexes = pending.pop(future)
+        try:
+            _, total_segments, errors, _ = future.result()
+        except Exception as e:
+            print("Error: Converting {} problem: {}".format(mp3_filepath, e))
+            total_segments, errors = 0, [str(e)] * len(targets_indexes)
+        for (index, segments), error in zip(targets_indexes, errors):
+            target_rate, target_format, target_dir = targets[index]
+            if error is None:
+                append_completed_source(get_shard_filepath(get_manifest_filepath(target_dir), shard), get_target_key(target_rate, get_extension(target_format)), source, len(segments))
+        if any(error is not None for error in errors):
+            failed_sources.append(source)
+        elif delete_files and isfile(mp3_filepath):
+            remove(mp3_filepath)
+        pbar.update(total_segments)
+
+    executor = ProcessPoolExecutor(max(int(jobs), 1))
+    try:
+        while True:
+            item = sources_queue.get()
+            if item is None:
+                break
+            source, mp3_filepath = item
+            if mp3_filepath is None:
+                failed_sources.append(source)
+                pbar.update(sum(len(segments) for _, segments in sources_targets[source]))
+                continue
+
+            # Verify sample rate, targets above the rate of the source are ignored
+            info = probe_cache.get(mp3_filepath) or probe_cache.probe(mp3_filepath)
+            source_rate = int(info['sample_rate'] or 0)
+            targets_indexes = []
+            for index, segments in sources_targets[source]:
+                if source_rate < int(targets[index][0]):
+                    print('Ignoring {} sr = {} for {} Hz'.format(mp3_filepath, info['sample_rate'], targets[index][0]))
+                    pbar.update(len(segments))
+                    continue
+                targets_indexes.append((index, segments))
+            if not targets_indexes:
+                continue
+
+            # At most "jobs" sources are converted at once, the next ones wait in the queue
+            while len(pending) >= max(int(jobs), 1):
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+            targets_segments = [(targets[index][0], targets[index][1], segments) for index, segments in targets_indexes]
+            future = executor.submit(convert_source, mp3_filepath, targets_segments, backend, seek_threshold, compression_level, encoder_threads)
+            pending[future] = (source, mp3_filepath, targets_indexes)
+
+        for future in list(pending):
+            wait([future])
+            finish(future)
+    finally:
+        stop_event.set()
+        executor.shutdown()
+        download_manager.close()
+        download_manager.print_stats()
+        if artifact_cache is not None:
+            artifact_cache.evict()
+        probe_cache.save()
+        pbar.close()
+
+    if failed_sources:
+        print('Error: {} of {} source files failed:'.format(len(failed_sources), len(sources_targets)))
+        for source in failed_sources:
+            print(source)
+        return False
+    return True
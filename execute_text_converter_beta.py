@@ -7,7 +7,7 @@ from utils.download_dataset import  download_language_dataset, download_books_da
 from text_tools.text_normalization import customized_text_cleaning, portuguese_text_normalize, polish_text_normalize
 from text_tools.custom_tokenizer import infix_re
 from cleantext import clean
-import collections
+from utils.mls_reader import iter_sorted_transcripts
 from text_tools.search_substring_with_threads import execute_threads_search_substring_by_char, execute_threads_search_substring_by_word
 
 abbrev2language = {
@@ -64,16 +64,6 @@ def get_tokenizer(language_abbrev = 'pt'):
 
     return nlp
 
-def get_transcripts(transcripts_text):
-    transcripts_dict = {}
-    for line in transcripts_text:
-        filename, text = line.split('\t')
-        transcripts_dict[filename] = text.strip()
-    # Sorting dict by key (filename)
-    ordered_transcripts_dict = collections.OrderedDict(sorted(transcripts_dict.items()))
-    return ordered_transcripts_dict
-
-
 def execute(language_abbrev='pt', sequenced_text=False, similarity_metric='hamming', search_type='word', number_threads = 2):
     '''
     Execute convertion pipeline.
@@ -107,15 +97,12 @@ def execute(language_abbrev='pt', sequenced_text=False, similarity_metric='hammi
         output_filename = 'output_' + language + '_' + output_filename + '.csv'
         output_f = open(output_filename, "w")
 
-        with open(transcript_file) as f:
-            transcripts_text = f.readlines()
-
         start_position = 0
+        total_transcripts = 0
 
-        # Create ordered dict from trascripts list
-        transcripts_dict = get_transcripts(transcripts_text)
-        # Iterates over each transcription
-        for filename, text in tqdm(transcripts_dict.items()):
+        # Iterates over each transcription, sorted by filename
+        for filename, text in tqdm(iter_sorted_transcripts(transcript_file)):
+            total_transcripts += 1
             print('Processing {}'.format(filename))
 
             new_book_id = filename.split('_')[1]
@@ -150,7 +137,7 @@ def execute(language_abbrev='pt', sequenced_text=False, similarity_metric='hammi
             line = separator.join([filename.strip(), text.strip(), text_result.strip(), str(similarity) + '\n'])
             output_f.write(line)
 
-        print('Mean Similarity: {}'.format(total_similarity / len(transcripts_text)))
+        print('Mean Similarity: {}'.format(total_similarity / max(total_transcripts, 1)))
         output_f.close()
 
 def main():
@@ -0,0 +1,170 @@
+import argparse
+from functools import partial
+from glob import glob
+from os.path import join, dirname
+from audio_tools.audio_converter import create_audio_files_from_segments_list, create_segments_list, parse_targets, get_extension
+from audio_tools.download_mp3_files import get_links_dict, download_mp3_from_dict
+from audio_tools.mel_features import parse_mel_config
+from audio_tools.packed_dataset import pack_split
+from audio_tools.probe_cache import ProbeCache
+from audio_tools.segment_table import load_segment_table
+from text_tools.create_structure_folders import change_structure_folders
+from text_tools.insert_punctuation import insert_punctuation_on_substring
+from text_module import search_substring_with_punctuation
+from utils.artifact_cache import get_artifact_cache
+from utils.download_dataset import download_language_dataset, download_books_dataset, extract_split_files, extract_book_files, get_language_dataset_url, get_split_members, SPLITS
+from utils.stage_graph import Stage, StageGraph, expand_path
+from utils.utils import abbrev2language
+
+BOOKS_URL = 'https://dl.fbaipublicfiles.com/mls/lv_text.tar.gz'
+
+
+def run_search(language_abbrev, audio_folder, books_folder, search_type, threads_number):
+    '''
+    Substring search of each book folder of a split.
+    '''
+    language = abbrev2language[language_abbrev]
+    for transcript_file in sorted(glob(join(audio_folder, '*', '*', 'transcripts.txt'))):
+        output_filepath = join(dirname(transcript_file), 'output_search.txt')
+        complete_text_file = join(books_folder, language, transcript_file.split('/')[-2] + '.txt')
+        search_substring_with_punctuation(language_abbrev, transcript_file, complete_text_file, search_type, output_filepath, int(threads_number))
+
+
+def run_punctuation(language_abbrev, audio_folder):
+    '''
+    Punctuation of each book folder of a split.
+    '''
+    for metadata_search in sorted(glob(join(audio_folder, '*', '*', 'output_search.txt'))):
+        output_filepath = join(dirname(metadata_search), 'output_result.txt')
+        # Output result is recreated, since insertion appends to it
+        open(output_filepath, 'w').close()
+        insert_punctuation_on_substring(language_abbrev, metadata_search, output_filepath)
+
+
+def run_probe(audio_folder):
+    probe_cache = ProbeCache(join(audio_folder, 'probe_cache.json'))
+    probe_cache.probe_all(expand_path(join(audio_folder, '*', '*', '*.mp3')))
+    probe_cache.save()
+
+
+def run_segmentation(segments_file, sampling_rate, audio_format, audio_quality, audio_folder, table_filepath):
+    segments_table, _ = create_segments_list(segments_file, sampling_rate, audio_format, audio_quality, audio_folder)
+    segments_table.save(table_filepath)
+
+
+def run_encoding(table_filepath, targets, jobs, backend, seek_threshold, compression_level, encoder_threads, mel_config=None, features_dir=None):
+    segments_table = load_segment_table(table_filepath)
+    # Failed sources are reported, the stage runs again next time
+    return create_audio_files_from_segments_list(segments_table, len(segments_table), targets[0][0], targets[0][1], False, jobs, backend, seek_threshold,
+                                                 compression_level, encoder_threads, False, targets, mel_config=mel_config, features_dir=features_dir)
+
+
+def run_packing(audio_folder, target_dir, target_format, output_dir, split, pack_size_mb):
+    transcripts_files = expand_path(join(audio_folder, '*', '*', 'output_result.txt'))
+    pack_split(transcripts_files, target_dir, output_dir, split, target_format, int(pack_size_mb * 1024 ** 2))
+
+
+def create_pipeline(language, sampling_rate=22050, audio_format='wav', audio_quality=64, targets_text=None, search_type='word', threads_number=4,
+                    jobs=1, backend='auto', seek_threshold=4, compression_level=5, encoder_threads=2, connections=2, requests_per_second=0.5,
+                    verify_checksums=False, artifact_cache=None, stage_jobs=2, state_filepath='pipeline_state.json', pack_size_mb=None,
+                    mel_config=None):
+    '''
+    Declares the stages of the audio and text conversions of a language:
+    download -> extract -> (each split) restructure -> search -> punctuate (text branch)
+                        -> (each split) download_mp3 -> probe -> segment -> encode (audio branch)
+    With pack_size_mb, the segments of the first target and their transcripts are packed in tar shards of that size (pack stage,
+    after punctuate and encode). With mel_config, the encode stage also computes the mel spectrograms of the segments in
+    <split>/features. The dependencies follow from the inputs and outputs of the stages. Returns a StageGraph.
+    '''
+    url = get_language_dataset_url(language)
+    if url is None:
+        raise ValueError('Invalid language {}.'.format(language))
+    tar_filename = url.split('/')[-1]
+    books_tar_filename = BOOKS_URL.split('/')[-1]
+    books_folder = books_tar_filename.split('.')[0]
+    split_files = [member for filename in ('transcripts.txt', 'segments.txt') for member in get_split_members(tar_filename, filename)]
+
+    graph = StageGraph(state_filepath, stage_jobs)
+    graph.add(Stage('download', partial(download_language_dataset, language, artifact_cache=artifact_cache), outputs=[tar_filename], config={'url': url}))
+    graph.add(Stage('extract', partial(extract_split_files, tar_filename), inputs=[tar_filename], outputs=split_files))
+    graph.add(Stage('download_books', partial(download_books_dataset, language, artifact_cache=artifact_cache), outputs=[books_tar_filename], config={'url': BOOKS_URL}))
+    graph.add(Stage('extract_books', partial(extract_book_files, books_tar_filename), inputs=[books_tar_filename], outputs=[books_folder]))
+
+    for split, transcripts_file, segments_file in zip(SPLITS, get_split_members(tar_filename, 'transcripts.txt'), get_split_members(tar_filename, 'segments.txt')):
+        audio_folder = join(dirname(segments_file), 'audio')
+        book_files = join(audio_folder, '*', '*', '{}')
+
+        # Text branch
+        graph.add(Stage(split + '/restructure', partial(change_structure_folders, transcripts_file, audio_folder),
+                        inputs=[transcripts_file], outputs=[book_files.format('transcripts.txt')]))
+        graph.add(Stage(split + '/search', partial(run_search, language, audio_folder, books_folder, search_type, threads_number),
+                        inputs=[book_files.format('transcripts.txt'), join(books_folder, abbrev2language[language])],
+                        outputs=[book_files.format('output_search.txt')], config={'search_type': search_type}))
+        graph.add(Stage(split + '/punctuate', partial(run_punctuation, language, audio_folder),
+                        inputs=[book_files.format('output_search.txt')], outputs=[book_files.format('output_result.txt')]))
+
+        # Audio branch
+        targets = parse_targets(targets_text, dirname(segments_file)) if targets_text else [(sampling_rate, audio_format, audio_folder)]
+        # Sources are kept if they can be used by at least one target
+        min_sampling_rate = min(target[0] for target in targets)
+        table_filepath = join(audio_folder, 'segments_table.npz')
+        probe_filepath = join(audio_folder, 'probe_cache.json')
+        download_function = lambda segments_file=segments_file, audio_folder=audio_folder: download_mp3_from_dict(
+            get_links_dict(segments_file, audio_quality), audio_quality, audio_folder, False, connections, requests_per_second, verify_checksums, artifact_cache)
+        graph.add(Stage(split + '/download_mp3', download_function, inputs=[segments_file], outputs=[book_files.format('*.mp3')],
+                        config={'audio_quality': audio_quality}))
+        graph.add(Stage(split + '/probe', partial(run_probe, audio_folder), inputs=[book_files.format('*.mp3')], outputs=[probe_filepath]))
+        graph.add(Stage(split + '/segment', partial(run_segmentation, segments_file, min_sampling_rate, targets[0][1], audio_quality, audio_folder, table_filepath),
+                        inputs=[segments_file, probe_filepath], outputs=[table_filepath], config={'sampling_rate': min_sampling_rate, 'audio_quality': audio_quality}))
+        features_dir = join(dirname(segments_file), 'features')
+        encode_config = {'targets': targets, 'compression_level': compression_level}
+        if mel_config:
+            encode_config['mel_config'] = mel_config
+        graph.add(Stage(split + '/encode', partial(run_encoding, table_filepath, targets, jobs, backend, seek_threshold, compression_level, encoder_threads, mel_config, features_dir),
+                        inputs=[table_filepath, book_files.format('*.mp3')],
+                        outputs=[join(target_dir, '*', '*', '*' + get_extension(target_format)) for _, target_format, target_dir in targets] + ([features_dir] if mel_config else []),
+                        config=encode_config))
+
+        if pack_size_mb:
+            _, target_format, target_dir = targets[0]
+            packed_folder = join(dirname(segments_file), 'packed')
+            graph.add(Stage(split + '/pack', partial(run_packing, audio_folder, target_dir, target_format, packed_folder, split, pack_size_mb),
+                            inputs=[book_files.format('output_result.txt'), join(target_dir, '*', '*', '*' + get_extension(target_format))],
+                            outputs=[packed_folder], config={'pack_size_mb': pack_size_mb, 'target': targets[0]}))
+    return graph
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--language', default='pt', help='Options: pt (portuguese), pl (polish), it (italian), sp (spanish), fr (french), du (dutch), ge (german), en (english)')
+    parser.add_argument('-s', '--sampling_rate', default=22050, help='Sample rate of new dataset')
+    parser.add_argument('-f', '--audio_format', default='wav', help='wav or flac')
+    parser.add_argument('-q', '--audio_quality', default=64, help='64 if sr=22050 or 128 if sr=44100')
+    parser.add_argument('-g', '--targets', default=None, help='Several outputs from one decode, ignoring -s and -f. Example: 22050:wav:audio,44100:flac:audio_44100')
+    parser.add_argument('-t', '--search_type', default='word', help='Options: word or char')
+    parser.add_argument('-n', '--threads_number', default=4, help='Threads of the substring search')
+    parser.add_argument('-j', '--jobs', default=1, help='Number of processes converting source files')
+    parser.add_argument('-b', '--backend', default='auto', help='Options: decode, numpy, seek or auto')
+    parser.add_argument('-c', '--compression_level', default=5, help='FLAC compression level (0-8)')
+    parser.add_argument('-k', '--connections', default=2, help='Concurrent connections per host downloading mp3 files')
+    parser.add_argument('-m', '--requests_per_second', default=0.5, help='Maximum download requests per second per host')
+    parser.add_argument('-o', '--cache_dir', default=None, help='Shared cache of downloaded archives and mp3 files (default: MLS_CACHE_DIR environment variable)')
+    parser.add_argument('-z', '--cache_size', default=None, help='Maximum size of the cache in GB, least recently used files are removed')
+    parser.add_argument('-p', '--stage_jobs', default=2, help='Stages run at once (the audio and text branches are independent)')
+    parser.add_argument('-x', '--force', default='', help='Stages to run again even if up to date, like "encode" or "dev/search,download"')
+    parser.add_argument('-w', '--pack_size', default=None, help='Pack the segments and transcripts of each split in tar shards of this size in MB, in <split>/packed')
+    parser.add_argument('-i', '--mel_features', default=None, help='Compute mel spectrograms in <split>/features: "default" or parameters like n_mels=80,hop_length=256,fmax=8000')
+    parser.add_argument('-r', '--dry_run', '--dry-run', action='store_true', default=False, help='Only print the stages that would run')
+    args = parser.parse_args()
+
+    artifact_cache = get_artifact_cache(args.cache_dir, float(args.cache_size) if args.cache_size else None)
+    graph = create_pipeline(args.language, int(args.sampling_rate), args.audio_format, int(args.audio_quality), args.targets, args.search_type, int(args.threads_number),
+                            int(args.jobs), args.backend, compression_level=int(args.compression_level), connections=int(args.connections),
+                            requests_per_second=float(args.requests_per_second), artifact_cache=artifact_cache, stage_jobs=int(args.stage_jobs),
+                            pack_size_mb=float(args.pack_size) if args.pack_size else None,
+                            mel_config=parse_mel_config(args.mel_features) if args.mel_features else None)
+    graph.run(force=[name for name in args.force.split(',') if name], dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
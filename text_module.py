@@ -1,21 +1,27 @@
 import argparse
 from glob import glob
+from os import makedirs
 from os.path import join, dirname, isfile
 from tqdm import tqdm
-from text_tools.search_substring_with_threads import get_transcripts, text_cleaning, execute_threads_search_substring_by_char, execute_threads_search_substring_by_word
+from text_tools.search_substring_with_threads import text_cleaning, execute_threads_search_substring_by_char, execute_threads_search_substring_by_word
 from text_tools.create_structure_folders import change_structure_folders
 from text_tools.insert_punctuation import insert_punctuation_on_substring
-from utils.download_dataset import  download_language_dataset, download_books_dataset, extract_transcript_files, extract_book_files
+from text_tools.transcripts_index import load_transcripts_index, iter_books_from_index
+from utils.artifact_cache import get_artifact_cache
+from utils.download_dataset import  download_language_dataset, download_books_dataset, extract_transcript_files, extract_book_files, get_split_members, get_archive_members
 from utils.utils import abbrev2language
+from utils.mls_reader import iter_sorted_transcripts, iter_sorted_books
+from utils.sharding import ShardSource, get_shard_books, get_shard_name, write_shard_marker
 
 
-def search_substring_with_punctuation(language_abbrev, transcript_file, complete_text_file, search_type, output_file, number_threads):
+def search_substring_with_punctuation(language_abbrev, transcript_file, complete_text_file, search_type, output_file, number_threads, transcripts_text=None):
     '''
     Perform substring search only for files with low similarity.
     '''
 
-    with open(transcript_file) as f:
-        transcripts_text = f.readlines()
+    if transcripts_text is None:
+        # Streams the transcripts file
+        transcripts_text = transcript_file
 
     older_transcript_text = False
     if isfile (output_file):
@@ -34,11 +40,11 @@ def search_substring_with_punctuation(language_abbrev, transcript_file, complete
     separator = '|'
     total_similarity = 0
 
-    # Create ordered dict from transcripts list
-    transcripts_dict = get_transcripts(transcripts_text)
+    total_transcripts = 0
 
-    # Iterates over each transcription
-    for filename, text in tqdm(transcripts_dict.items()):
+    # Iterates over each transcription, sorted by filename
+    for filename, text in tqdm(iter_sorted_transcripts(transcripts_text)):
+        total_transcripts += 1
         print('Processing {}'.format(filename))
 
         # search for sentences already executed
@@ -76,36 +82,109 @@ def search_substring_with_punctuation(language_abbrev, transcript_file, complete
         line = separator.join([filename.strip(), text.strip(), text_result.strip(), str(similarity) + '\n'])
         output_f.write(line)
 
-    print('Mean Similarity: {}'.format(total_similarity / len(transcripts_text)))
+    print('Mean Similarity: {}'.format(total_similarity / max(total_transcripts, 1)))
 
     output_f.close()
 
 
-def execution_text_convertion_pipeline(language_abbrev, input_folder, books_folder, search_type, threads_number):
-
+def execution_indexed_text_convertion(language_abbrev, transcript_file, books_folder, search_type, threads_number, transcripts_source=None, shard_books=None):
+    '''
+    Search and punctuation of each book read straight from the transcripts index, without creating the folders structure.
+    With transcripts_source (like a member of the tar.gz), the books are read from it in one sorted pass instead of the index.
+    With shard_books, only these (speaker, book) are converted. Returns the output result files.
+    '''
     language = abbrev2language[language_abbrev]
-    print('Downloading {} dataset tar.gz file...'.format(language_abbrev))
-    transcripts_tar_filename = download_language_dataset(lang=language_abbrev)
-    if not transcripts_tar_filename:
-        return False
-
-    print('Extracting files {}...'.format(transcripts_tar_filename))
-    transcript_files_list = extract_transcript_files(transcripts_tar_filename)
+    if transcripts_source is not None:
+        books = iter_sorted_books(transcripts_source)
+    else:
+        books = iter_books_from_index(transcript_file, load_transcripts_index(transcript_file))
+    audio_folder = join(dirname(transcript_file), 'audio')
+    text_folder = join(dirname(transcript_file), 'text')
+    makedirs(text_folder, exist_ok=True)
+
+    output_result_files = []
+    for speaker, book, transcripts_text in books:
+        if shard_books is not None and (speaker, book) not in shard_books:
+            continue
+        book_key = speaker + '_' + book
+        output_search_filepath = join(text_folder, book_key + '_output_search.txt')
+        output_result_filepath = join(text_folder, book_key + '_output_result.txt')
+        complete_text_file = join(books_folder, language, book + '.txt')
+
+        search_substring_with_punctuation(language_abbrev, None, complete_text_file, search_type, output_search_filepath, int(threads_number), transcripts_text)
+        # Output result is recreated, since insertion appends to it
+        open(output_result_filepath, 'w').close()
+        insert_punctuation_on_substring(language_abbrev, output_search_filepath, output_result_filepath, audio_folder)
+        output_result_files.append(output_result_filepath)
+    return output_result_files
+
+
+def execution_text_convertion_pipeline(language_abbrev, input_folder, books_folder, search_type, threads_number, use_index=False, archive_path=None, cache_dir=None, cache_size_gb=None, shard_index=0, num_shards=1):
+    '''
+    Execute text convertion pipeline. With archive_path, the transcripts are read straight from that MLS tar.gz,
+    without downloading or extracting it. With cache_dir (or the MLS_CACHE_DIR environment variable), the archives are
+    downloaded once to that shared cache, limited to cache_size_gb, and linked to the working folder.
+    With num_shards > 1, only the books of shard shard_index are converted (see utils/sharding.py), so each shard can run
+    on another machine. The output_result.txt files of the shards are combined with "python -m utils.sharding".
+    '''
+    shard = get_shard_name(shard_index, num_shards) if num_shards > 1 else None
+    artifact_cache = get_artifact_cache(cache_dir, cache_size_gb)
+    language = abbrev2language[language_abbrev]
+    if archive_path:
+        # Outputs are written to the same folders as with extracted files
+        transcript_files_list = get_split_members(archive_path, 'transcripts.txt')
+        transcripts_sources = get_archive_members(archive_path, 'transcripts.txt')
+    else:
+        print('Downloading {} dataset tar.gz file...'.format(language_abbrev))
+        transcripts_tar_filename = download_language_dataset(lang=language_abbrev, artifact_cache=artifact_cache)
+        if not transcripts_tar_filename:
+            return False
+
+        print('Extracting files {}...'.format(transcripts_tar_filename))
+        transcript_files_list = extract_transcript_files(transcripts_tar_filename)
+        if not transcript_files_list:
+            return False
+        transcripts_sources = transcript_files_list
 
     print('Downloading {} books tar.gz file...'.format(language_abbrev))
-    books_tar_filename = download_books_dataset(lang=language_abbrev)
+    books_tar_filename = download_books_dataset(lang=language_abbrev, artifact_cache=artifact_cache)
 
     print('Extracting files {}...'.format(books_tar_filename))
     books_folder = extract_book_files(books_tar_filename)
 
+    # Books of the shard in each split => (books, number of transcripts)
+    shard_books = {}
+    if shard is not None:
+        for transcript_file, transcripts_source in zip(transcript_files_list, transcripts_sources):
+            shard_books[transcript_file] = get_shard_books(transcripts_source, shard_index, num_shards)
+            print('Shard {} of {}: {} books, {} transcripts of {}.'.format(shard_index, num_shards, len(shard_books[transcript_file][0]), shard_books[transcript_file][1], transcript_file))
+
+    if use_index:
+        for transcript_file, transcripts_source in zip(transcript_files_list, transcripts_sources):
+            print('Executing {} file'.format(transcripts_source))
+            books = shard_books[transcript_file][0] if shard is not None else None
+            # Extracted files are read through their index
+            output_result_files = execution_indexed_text_convertion(language_abbrev, transcript_file, books_folder, search_type, threads_number, transcripts_source if archive_path else None, books)
+            if shard is not None:
+                write_shard_marker(dirname(transcript_file), 'text', shard_index, num_shards, books, shard_books[transcript_file][1], results=output_result_files)
+        print("Finished text conversion.")
+        return
+
     # Run folder restructuring
-    for transcript_file in transcript_files_list:
-        print('Executing {} file'.format(transcript_file))
+    book_folders = set()
+    for transcript_file, transcripts_source in zip(transcript_files_list, transcripts_sources):
+        print('Executing {} file'.format(transcripts_source))
         output_folder = join(dirname(transcript_file), 'audio') # output_folder = dirname(transcript_file)
-        change_structure_folders(transcript_file, output_folder)
+        if shard is not None:
+            transcripts_source = ShardSource(transcripts_source, shard_books[transcript_file][0], shard)
+            book_folders.update(join(output_folder, speaker, book) for speaker, book in shard_books[transcript_file][0])
+        change_structure_folders(transcripts_source, output_folder)
 
     # Run substring search in books
     for transcript_file in glob(output_folder + '/**/**/transcripts.txt'):
+        if shard is not None and dirname(transcript_file) not in book_folders:
+            # Book of another shard
+            continue
         # Defining output filepath
         output_filepath = join(dirname(transcript_file), 'output_search.txt')
         # Defining text book filepath
@@ -129,11 +208,18 @@ def execution_text_convertion_pipeline(language_abbrev, input_folder, books_fold
 
     # Insert punctuation of the found substring in the transcript text
     for metadata_search in tqdm(glob(output_folder + '/**/**/output_search.txt' )):
+        if shard is not None and dirname(metadata_search) not in book_folders:
+            continue
         # Defining output filepath
         output_filepath = join(dirname(metadata_search), 'output_result.txt')
         # Run insertion
         insert_punctuation_on_substring(language_abbrev, metadata_search, output_filepath)
 
+    for transcript_file in shard_books:
+        books, total_transcripts = shard_books[transcript_file]
+        output_result_files = [join(dirname(transcript_file), 'audio', speaker, book, 'output_result.txt') for speaker, book in books]
+        write_shard_marker(dirname(transcript_file), 'text', shard_index, num_shards, books, total_transcripts, results=[filepath for filepath in output_result_files if isfile(filepath)])
+
     print("Finished text conversion.")
 
 
@@ -148,13 +234,19 @@ def main():
     parser.add_argument('-n', '--threads_number', default=4)
     parser.add_argument('-t', '--search_type', default='word', help='Options: word or char')
     parser.add_argument('-s', '--sequenced_text', action='store_true', default=False)
+    parser.add_argument('-x', '--use_index', action='store_true', default=False, help='Iterate books from a transcripts index instead of creating one folder per book')
+    parser.add_argument('-a', '--archive', default=None, help='MLS tar.gz already downloaded, transcripts are read without extracting it')
+    parser.add_argument('-o', '--cache_dir', default=None, help='Shared cache of downloaded archives (default: MLS_CACHE_DIR environment variable)')
+    parser.add_argument('-y', '--shard_index', '--shard-index', default=0, help='Shard converted by this run, from 0 to num_shards - 1')
+    parser.add_argument('-k', '--num_shards', '--num-shards', default=1, help='Number of shards (machines) sharing the books of the language')
+    parser.add_argument('-z', '--cache_size', default=None, help='Maximum size of the cache in GB, least recently used files are removed')
 
     args = parser.parse_args()
 
     input_folder = join(args.base_dir, args.input_folder)
     books_folder = join(args.base_dir, args.books_folder)
 
-    execution_text_convertion_pipeline(args.language, input_folder, books_folder, args.search_type, args.threads_number)
+    execution_text_convertion_pipeline(args.language, input_folder, books_folder, args.search_type, args.threads_number, args.use_index, args.archive, args.cache_dir, float(args.cache_size) if args.cache_size else None, int(args.shard_index), int(args.num_shards))
 
 
 if __name__ == "__main__":
@@ -1,48 +1,82 @@
 import argparse
 from tqdm import tqdm
 from os.path import join, dirname
-from os import makedirs
+from os import makedirs, replace
+from concurrent.futures import ThreadPoolExecutor
 import collections
+from utils.mls_reader import iter_sorted_transcripts
 
 
-def get_transcripts(transcripts_text):
+class GroupedTranscriptsWriter:
     '''
-    Creates a ordered dict with filename => text from trasncripts text
+    Buckets transcript lines per (speaker, book) in memory and writes each bucket at once.
+    Files are written to a temporary file and renamed at the end, so re-runs do not duplicate lines.
     '''
+    def __init__(self, output_folder, filename='transcripts.txt', max_buffer_bytes=64*1024*1024, io_threads=4):
+        self.output_folder = output_folder
+        self.filename = filename
+        self.max_buffer_bytes = max_buffer_bytes
+        self.io_threads = io_threads
+        self.buckets = collections.OrderedDict()
+        self.buffered_bytes = 0
+        self.started = set() # buckets whose temporary file was created in this run
 
-    transcripts_dict = {}
-    for line in transcripts_text:
-        filename, text = line.split('\t')
-        transcripts_dict[filename] = text.strip()
+    def get_filepath(self, key):
+        speaker, book = key
+        return join(self.output_folder, speaker, book, self.filename)
 
-    # Sorting dict by key (filename)
-    ordered_transcripts_dict = collections.OrderedDict(sorted(transcripts_dict.items()))
-    return ordered_transcripts_dict
+    def add(self, speaker, book, line):
+        key = (speaker, book)
+        self.buckets.setdefault(key, []).append(line)
+        self.buffered_bytes += len(line)
+        if self.buffered_bytes >= self.max_buffer_bytes:
+            self.flush()
 
+    def write_bucket(self, key, lines):
+        tmp_filepath = self.get_filepath(key) + '.tmp'
+        if key in self.started:
+            mode = 'a'
+        else:
+            # Each directory is created once
+            makedirs(dirname(tmp_filepath), exist_ok=True)
+            mode = 'w'
+        with open(tmp_filepath, mode) as output_f:
+            output_f.write(''.join(lines))
 
-def change_structure_folders(input_file, output_folder):
+    def run(self, function, items):
+        if self.io_threads > 1:
+            # Overlaps the latency of slow shared storage
+            with ThreadPoolExecutor(self.io_threads) as executor:
+                list(executor.map(function, items))
+        else:
+            for item in items:
+                function(item)
+
+    def flush(self):
+        buckets = list(self.buckets.items())
+        self.run(lambda bucket: self.write_bucket(*bucket), buckets)
+        self.started.update(key for key, _ in buckets)
+        self.buckets.clear()
+        self.buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        self.run(lambda key: replace(self.get_filepath(key) + '.tmp', self.get_filepath(key)), sorted(self.started))
+
+
+def change_structure_folders(input_file, output_folder, max_buffer_bytes=64*1024*1024, io_threads=4):
     '''
     Creates a new structure of text files from a transcripts file.
     '''
     #folder0 = input_file.split('/')[1] # train, test or dev
 
-    with open(input_file) as f:
-        input_text = f.readlines()
-
-    # Create ordered dict from transcripts list
-    transcripts_dict = get_transcripts(input_text)
-
+    writer = GroupedTranscriptsWriter(output_folder, max_buffer_bytes=max_buffer_bytes, io_threads=io_threads)
     # Iterates over each transcription
-    for filename, text in tqdm(transcripts_dict.items()):
+    for filename, text in tqdm(iter_sorted_transcripts(input_file)):
         folder1, folder2, fileid = filename.split('_')
-        # Get new folder path
-        output_filepath = join(output_folder, folder1, folder2, 'transcripts.txt')
-        makedirs(dirname(output_filepath), exist_ok=True)
-        # Write content to new file
-        output_f = open(output_filepath, "a")
         line = '\t'.join([filename, text + '\n'])
-        output_f.write(line)
-        output_f.close()
+        writer.add(folder1, folder2, line)
+    writer.close()
 
 
 def main():
@@ -50,6 +84,8 @@ def main():
     parser.add_argument('-b', '--base_dir', default='./')
     parser.add_argument('-i', '--input_file', default='./mls_portuguese_opus/dev/transcripts.txt')
     parser.add_argument('-o', '--output_folder', default='./input')
+    parser.add_argument('-m', '--max_buffer_mb', default=64, help='Memory budget of buffered lines (MB)')
+    parser.add_argument('-n', '--io_threads', default=4, help='Number of threads writing files')
     args = parser.parse_args()
 
     # get input filepath
@@ -57,7 +93,7 @@ def main():
     # get output folderpath
     output_folder = join(args.base_dir, args.output_folder)
 
-    change_structure_folders(input_file, output_folder)
+    change_structure_folders(input_file, output_folder, int(args.max_buffer_mb)*1024*1024, int(args.io_threads))
 
 
 if __name__ == "__main__":
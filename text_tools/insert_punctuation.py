@@ -70,11 +70,11 @@ def correct_punctuation(language_abbrev, text_clean, text_punc):
     return new_text[len(begin_token) -1 : - len(end_token)] # Removing begining and ending token
 
 
-def insert_punctuation_on_substring(language_abbrev, metadata_file, output_filepath):
+def insert_punctuation_on_substring(language_abbrev, metadata_file, output_filepath, audio_dir=None):
     with open(metadata_file) as f:
         content_file = f.readlines()
 
-    input_dir = dirname(metadata_file)
+    input_dir = dirname(metadata_file) if audio_dir is None else audio_dir
 
     separator = '|'
     out_file = open(output_filepath, 'a')
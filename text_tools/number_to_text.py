@@ -1,4 +1,5 @@
 import unicodedata
+from functools import lru_cache
 from math import ceil, floor
 import re
 
@@ -138,20 +139,74 @@ class Extenso:
                     extenso += f' {self.milhares[ternarios - n].singular}' # Se for 1, busca o singular
         return extenso.replace('um mil,', 'mil')
 
-def number_to_text(text): 
-    ex = Extenso()
+class NumberVerbalizer:
+    '''
+    Spells numbers and ordinals of a text in a single regex pass, caching the numbers already spelled.
+    '''
+    def __init__(self, spell_number, ordinals, cache_size=4096):
+        self.spell_number = lru_cache(maxsize=cache_size)(spell_number)
+        self.ordinals = ordinals
+        # Ordinals first (longest first), so "10º" is not taken as the number "10"
+        ordinals_pattern = '|'.join(re.escape(ordinal) for ordinal in sorted(ordinals, key=len, reverse=True))
+        tokens_pattern = ordinals_pattern + r'|\d+[ºª]|\d+' if ordinals_pattern else r'\d+[ºª]|\d+'
+        # Only whole tokens, delimited by blank spaces or punctuation
+        self.tokens_re = re.compile(r'(?<![^\s.,;!?])(?:{})(?![^\s.,;!?])'.format(tokens_pattern))
+
+    def replace_token(self, match):
+        word = match.group(0)
+        if word in self.ordinals:
+            return self.ordinals[word]
+        if word.isdigit():
+            return self.spell_number(int(word))
+        print('The ordinal number "'+ word +'" is not in ordinals_numbers list fix this!')
+        return word
 
-    words = re.split(r'([.,;!? ])', text)
-    for word in words:
-        if 'º' in word or 'ª' in word:
-            if word in ordinals_numbers.keys():
-                new_word = ordinals_numbers[word]
-                text = text.replace(word, new_word)
-            else:
-                #raise ValueError(' The ordinal number '+word+'is not in ordinals_numbers list fix this!')
-                print('The ordinal number "'+ word +'" is not in ordinals_numbers list fix this!')
+    def __call__(self, text):
+        return self.tokens_re.sub(self.replace_token, text)
 
-        if word.isdigit():
-            new_word = ex.escrever(int(word))
-            text = text.replace(word, new_word)
-    return text
+
+# Language abbrev => (function spelling an int, ordinals dict)
+number_backends = {
+    'pt': (Extenso().escrever, ordinals_numbers),
+}
+number_verbalizers = {}
+
+
+def register_number_backend(language_abbrev, spell_number, ordinals=None):
+    '''
+    Registers a number spelling backend for a language.
+    '''
+    if ordinals is None:
+        ordinals = {}
+    number_backends[language_abbrev] = (spell_number, ordinals)
+    number_verbalizers.pop(language_abbrev, None)
+
+
+def get_number_verbalizer(language_abbrev='pt'):
+    '''
+    Get the (cached) number verbalizer of a language.
+    '''
+    if language_abbrev not in number_verbalizers:
+        if language_abbrev not in number_backends:
+            print('Language {} has no number backend!'.format(language_abbrev))
+            return False
+        spell_number, ordinals = number_backends[language_abbrev]
+        number_verbalizers[language_abbrev] = NumberVerbalizer(spell_number, ordinals)
+    return number_verbalizers[language_abbrev]
+
+
+def number_to_text(text, language_abbrev='pt'):
+    verbalizer = get_number_verbalizer(language_abbrev)
+    if not verbalizer:
+        return text
+    return verbalizer(text)
+
+
+def numbers_to_text(sentences, language_abbrev='pt'):
+    '''
+    Batch version of number_to_text over many sentences.
+    '''
+    verbalizer = get_number_verbalizer(language_abbrev)
+    if not verbalizer:
+        return list(sentences)
+    return [verbalizer(sentence) for sentence in sentences]
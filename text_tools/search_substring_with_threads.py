@@ -10,7 +10,6 @@ import argparse
 import re
 import tqdm
 import textdistance
-import collections
 import multiprocessing
 from multiprocessing import Process, Queue
 import string
@@ -18,6 +17,7 @@ from cleantext import clean
 from text_tools.text_normalization import customized_text_cleaning
 from text_tools.language_tokenizer import get_language_tokenizer
 from os.path import join
+from utils.mls_reader import iter_sorted_transcripts
 
 PUNCTUATION = string.punctuation + '—'
 
@@ -408,16 +408,6 @@ def execute_threads_search_substring_by_word(language_abbrev, substring, complet
     return string_result, similarity, start_position
 
 
-def get_transcripts(transcripts_text):
-    transcripts_dict = {}
-    for line in transcripts_text:
-        filename, text = line.split('\t')
-        transcripts_dict[filename] = text.strip()
-    # Sorting dict by key (filename)
-    ordered_transcripts_dict = collections.OrderedDict(sorted(transcripts_dict.items()))
-    return ordered_transcripts_dict
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-b', '--base_dir', default='./')
@@ -436,9 +426,6 @@ def main():
 
     output_f = open(args.output_file, "w")
 
-    with open(transcript_file) as f:
-        transcripts_text = f.readlines()
-
     with open(complete_text_file) as f:
         book_text = f.read()
 
@@ -449,11 +436,11 @@ def main():
     separator = '|'
     total_similarity = 0
 
-    # Create ordered dict from trascripts list
-    transcripts_dict = get_transcripts(transcripts_text)
+    total_transcripts = 0
 
-    # Iterates over each transcription
-    for filename, text in tqdm.tqdm(transcripts_dict.items()):
+    # Iterates over each transcription, sorted by filename
+    for filename, text in tqdm.tqdm(iter_sorted_transcripts(transcript_file)):
+        total_transcripts += 1
         print('Processing {}'.format(filename))
 
         if args.search_type == 'char':
@@ -471,7 +458,7 @@ def main():
         line = separator.join([filename.strip(), text.strip(), text_result.strip(), str(similarity) + '\n'])
         output_f.write(line)
 
-    print('Similaridade Media: {}'.format(total_similarity / len(transcripts_text)))
+    print('Similaridade Media: {}'.format(total_similarity / max(total_transcripts, 1)))
     output_f.close()
 
 if __name__ == "__main__":
@@ -1,12 +1,22 @@
 import re
 import argparse
 import unicodedata
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from os import makedirs
+from os.path import join, basename
 from text_tools.number_to_text import number_to_text
 
 vocab="abcdefghijklmnopqrstuvwxyzçãàáâêéíóôõúû\-0123456789,.;:!?' —"
 vocab = vocab + vocab.upper()
 chars_map = {'ï': 'i', 'ù': 'ú', 'ö': 'o', 'î':'i', 'ñ':' n', 'ë':'e', 'ì':'í', 'ò': 'ó', 'ũ': 'u','ẽ':'e', 'ü':'u', 'è':'é', 'æ':'a', 'å': 'a', '«': '', '»' : '', '’': "'"}
 general_chars_map = {'«': '', '»' : '', '’': "'"}
+# Spaces where a text can be normalized in two parts
+safe_cut_pattern = re.compile("(?<=[{0}]) (?=[{0}])".format(''.join(c for c in vocab if c.isalpha())))
+special_words = [' mas ', ' porém ', ' todavia ', ' contudo ', ' entretanto ', ' no entanto ', ' pois ',' logo ', ' porque ', ' bem como ', ' por isso ', ' isto é ', ' visto que ', ' quando ', ' logo que ', ' desde que']
+# Longer words first, so " logo que " is preferred over " logo "
+special_words_re = re.compile('({})'.format('|'.join(sorted(special_words, key=len, reverse=True))))
+punctuation_re = re.compile(r'([.;!?])')
 
 def get_number_of_words(sentence):
         # counting number of words on sentence
@@ -37,18 +47,35 @@ def get_text_from_subtitle(input_file):
     return text
 
 def merge_sentences(sentences, min_words):
-    found_short_sentence = True
-    while(found_short_sentence):
-        found_short_sentence = False
-        for index, sentence in enumerate(sentences):
-            # Verify number of words on sentence
-            if (len(sentence.split()) < min_words):
-                found_short_sentence = True
-                # Merge sentences
-                sentences[index:index+2] = [' '.join(sentences[index:index+2])]
+    '''
+    Concatenates short sentences with the following ones in a single pass.
+    '''
+    merged_sentences = []
+    current = []
+    for sentence in sentences:
+        if not sentence:
+            continue
+        current.append(sentence)
+        # Verify number of words on merged sentence
+        if len(' '.join(current).split()) >= min_words:
+            merged_sentences.append(' '.join(current))
+            current = []
+    # Remaining short sentence is merged with the previous one
+    if current:
+        if merged_sentences:
+            merged_sentences[-1] = ' '.join([merged_sentences[-1]] + current)
+        else:
+            merged_sentences.append(' '.join(current))
+    return merged_sentences
+
+def join_delimiters(parts):
+    '''
+    Joins each text from re.split with the delimiter captured after it.
+    '''
+    # Result example: ['Esta é uma frase', '.', 'Esta é outra frase', ','] => ['Esta é uma frase.', 'Esta é outra frase,']
+    sentences = [''.join(parts[index:index+2]) for index in range(0, len(parts), 2)]
     # Removing blank itens from list
-    nonempty_sentences = list(filter(None, sentences))
-    return nonempty_sentences
+    return list(filter(None, sentences))
 
 def tokenize_sentences_on_blank_space(text):
      # tokenize on spaces
@@ -57,29 +84,11 @@ def tokenize_sentences_on_blank_space(text):
 
 def tokenize_sentences_on_punctuation(text):
     # Tokenize by punctuation
-    #sentences = re.split(r'([.,!?:;])', text_tools)# Result example: ['Esta é uma frase', '.', 'Esta é outra frase', ',']
-    sentences = re.split(r'([.;!?])', text)
-    for index, sentence in enumerate(sentences[:-1]):
-        sentence = sentence.strip()
-        sentences[index:index+2] = [''.join(sentences[index:index+2])] # Result example: ['Esta é uma frase.', 'Esta é outra frase,']
-    # Removing blank itens from list
-    nonempty_sentences = list(filter(None, sentences))
-    sentences = nonempty_sentences
-    return sentences
+    return join_delimiters(punctuation_re.split(text))
 
 def tokenize_sentences_on_special_words(text):
-    special_words = [' mas ', ' porém ', ' todavia ', ' contudo ', ' entretanto ', ' no entanto ', ' pois ',' logo ', ' porque ', ' bem como ', ' por isso ', ' isto é ', ' visto que ', ' quando ', ' logo que ', ' desde que']
-    # Tokenize by special words
-    for word in special_words:
-        sentences = re.split(r'({})'.format(word), text) 
-
-    for index, sentence in enumerate(sentences[:-1]):
-        sentence = sentence.strip()
-        sentences[index:index+2] = [''.join(sentences[index:index+2])]
-    # Removing blank itens from list
-    nonempty_sentences = list(filter(None, sentences))
-    sentences = nonempty_sentences
-    return sentences
+    # Tokenize by all special words at once
+    return join_delimiters(special_words_re.split(text))
 
 def get_size_of_biggest_sentence(sentences):
     max_length_sentence = 0
@@ -89,36 +98,67 @@ def get_size_of_biggest_sentence(sentences):
             max_length_sentence = length_sentence
     return max_length_sentence
 
+def split_long_sentence(sentence, max_words):
+    '''
+    Splits a sentence longer than max_words on special words and, if still needed, on blank spaces.
+    '''
+    if get_number_of_words(sentence) <= max_words:
+        yield sentence
+        return
+    for part in tokenize_sentences_on_special_words(sentence):
+        if get_number_of_words(part) <= max_words:
+            yield part
+            continue
+        words = tokenize_sentences_on_blank_space(part)
+        for index in range(0, len(words), max_words):
+            yield ' '.join(words[index:index + max_words])
+
+def stream_sentences(chunks, min_words, max_words):
+    '''
+    Streaming sentence segmenter. Consumes text chunks incrementally and yields sentences
+    split on punctuation, special words or blank spaces (max_words) and concatenated when short (min_words).
+    '''
+    carry = ''
+    current = ''
+
+    def segment(text):
+        for sentence in tokenize_sentences_on_punctuation(text):
+            for part in split_long_sentence(sentence, max_words):
+                yield part
+
+    def merge(sentences):
+        nonlocal current
+        for sentence in sentences:
+            if not current:
+                current = sentence
+            elif get_number_of_words(current) > min_words:
+                yield current
+                current = sentence
+            # Concatenates sentences
+            else:
+                current += ' ' + sentence
+
+    for chunk in chunks:
+        text = carry + chunk
+        # Keep the text after the last punctuation to the next chunk
+        last = max(text.rfind(p) for p in '.;!?') + 1
+        carry = text[last:]
+        for sentence in merge(segment(text[:last])):
+            yield sentence
+        # Avoid unbounded carry on texts without punctuation
+        if get_number_of_words(carry) > max_words:
+            *complete, carry = list(split_long_sentence(carry, max_words))
+            for sentence in merge(complete):
+                yield sentence
+
+    for sentence in merge(segment(carry)):
+        yield sentence
+    if current:
+        yield current
+
 def text_tokenization(text, min_words, max_words):
-    # First: tokenize on punctuation
-    sentences = tokenize_sentences_on_punctuation(text)
-
-    # Verify lenght of sentences
-    length_biggest_sentence = get_size_of_biggest_sentence(sentences)
-
-    # Second: tokenize on special words
-    if length_biggest_sentence > max_words: # very long sentence
-        sentences = tokenize_sentences_on_special_words(text)
-
-    # Verify lenght of sentences
-    length_biggest_sentence = get_size_of_biggest_sentence(sentences)
-    # Third: tokenize on blank space
-    if length_biggest_sentence > max_words: # very long sentence
-        sentences = tokenize_sentences_on_blank_space(text)
-
-    # Concatenates small sentences
-    sentences = iter(sentences)
-    lines, current = [], next(sentences)
-    for sentence in sentences:    
-        if  get_number_of_words(current) > min_words:
-            lines.append(current)
-            current = sentence # next
-        # Concatenates sentences
-        else:
-            current += " " + sentence # concatenate two sentences
-    lines.append(current)
-    nonempty_lines = list(filter(None, lines))
-    return nonempty_lines
+    sentences = stream_sentences([text], min_words, max_words)
+    return list(filter(None, sentences))
 
 def remove_html_tags(text):
     """Remove html tags from a string"""
@@ -189,24 +229,45 @@ def polish_text_normalize(text):
 
     return text.strip()
 
+def read_normalized_lines(file):
+    '''
+    Yields the text of a file normalized, without reading the whole file. The text is cut at the last space between two
+    letters of each line read (outside html tags), where the normalization of the parts joined by a space is the one of the
+    whole text: the rest (a hyphenated word, a punctuation, a tag) is carried to the next line.
+    '''
+    carry = ''
+    for line in file:
+        text = carry + line
+        end = len(text)
+        # Not inside an html tag
+        if text.rfind('<') > text.rfind('>'):
+            end = text.rfind('<')
+        cut = None
+        for match in safe_cut_pattern.finditer(text, 0, end):
+            cut = match.start()
+        if cut is None:
+            carry = text
+            continue
+        carry = text[cut + 1:]
+        text = portuguese_text_normalize(text[:cut])
+        if text:
+            yield text + ' '
+    text = portuguese_text_normalize(carry)
+    if text:
+        yield text + ' '
+
 def create_normalized_text_from_subtitles_file(subtitle_file, output_file, min_words, max_words):
 
     #text_tools = get_text_from_subtitle(subtitle_file)
 
-    # read all lines from file
+    # read lines from file incrementally
     try:
         file = open(subtitle_file, "r")
-        text = '\n'.join(file.readlines())
-        file.close()
     except IOError:
         print("Error: Reading subtitle file {}.".format(subtitle_file))
-        return False    
-
-    if not text:
         return False
 
-    text = text_normalize(text)
-    sentences = text_tokenization(text, int(min_words), int(max_words))
+    sentences = stream_sentences(read_normalized_lines(file), int(min_words), int(max_words))
     try:
         f = open(output_file, "w")
         for sentence in sentences:
@@ -215,23 +276,42 @@ def create_normalized_text_from_subtitles_file(subtitle_file, output_file, min_w
         #f.write(text_tools)
         f.close()
     except IOError:
-        print("Error: Writing audio_tools file {}.".format(filepath))
+        print("Error: Writing text file {}.".format(output_file))
         return False
+    finally:
+        file.close()
     return True
 
+def create_normalized_text_from_subtitles_files(input_files, output_folder, min_words, max_words, jobs=cpu_count()):
+    '''
+    Normalizes many files in parallel through a process pool.
+    '''
+    makedirs(output_folder, exist_ok=True)
+    args_list = [(input_file, join(output_folder, basename(input_file)), min_words, max_words) for input_file in input_files]
+    with Pool(int(jobs)) as pool:
+        results = pool.starmap(create_normalized_text_from_subtitles_file, args_list, chunksize=1)
+    return all(results)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--base_dir', default='./')
     parser.add_argument('--input_file', default='lv_text/portuguese/3702.txt', help='Subtitles filename (only text_tools)')
     parser.add_argument('--output_file', default='3702_pre.txt', help='Filename to save the normalize text_tools')
+    parser.add_argument('--input_folder', default=None, help='Folder of text files to normalize in parallel (ignores --input_file)')
+    parser.add_argument('--output_folder', default='./normalized', help='Folder to save the normalized files of --input_folder')
     parser.add_argument('--min_words', default=10, help='Minimal number of words on sentence')
     parser.add_argument('--max_words', default=30, help='Maximal number of words on sentence')
+    parser.add_argument('-j', '--jobs', default=cpu_count(), help='Number of processes used with --input_folder')
     args = parser.parse_args()
 
     min_words = int(args.min_words)
     max_words = int(args.max_words)
 
-    create_normalized_text_from_subtitles_file(args.input_file, args.output_file, min_words, max_words)
+    if args.input_folder:
+        input_files = sorted(glob(join(args.base_dir, args.input_folder, '*.txt')))
+        create_normalized_text_from_subtitles_files(input_files, join(args.base_dir, args.output_folder), min_words, max_words, int(args.jobs))
+    else:
+        create_normalized_text_from_subtitles_file(args.input_file, args.output_file, min_words, max_words)
 
 if __name__ == "__main__":
     main()
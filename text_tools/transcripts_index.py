@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Index of the lines of each book in a MLS transcripts.txt file.
+#
+import argparse
+import json
+from os.path import isfile, getsize, getmtime
+from tqdm import tqdm
+
+
+def get_index_filepath(transcripts_file):
+    return transcripts_file + '.index.json'
+
+
+def build_transcripts_index(transcripts_file, index_file=None):
+    '''
+    Creates a dict "speaker_book" => list of byte offsets from a transcripts file in one pass, and saves it to disk.
+    '''
+    if index_file is None:
+        index_file = get_index_filepath(transcripts_file)
+
+    books = {}
+    with open(transcripts_file, 'rb') as f:
+        offset = 0
+        for line in tqdm(f):
+            filename = line.split(b'\t', 1)[0].decode('utf-8')
+            speaker, book, _ = filename.split('_')
+            books.setdefault(speaker + '_' + book, []).append(offset)
+            offset += len(line)
+
+    index = {
+        'size': getsize(transcripts_file),
+        'mtime': getmtime(transcripts_file),
+        'books': books
+    }
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def load_transcripts_index(transcripts_file, index_file=None):
+    '''
+    Loads the index of a transcripts file, rebuilding it if it is missing or outdated.
+    '''
+    if index_file is None:
+        index_file = get_index_filepath(transcripts_file)
+
+    if isfile(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+        if index['size'] == getsize(transcripts_file) and index['mtime'] == getmtime(transcripts_file):
+            return index
+        print('Index {} is outdated.'.format(index_file))
+
+    return build_transcripts_index(transcripts_file, index_file)
+
+
+def iter_books_from_index(transcripts_file, index):
+    '''
+    Yields (speaker, book, lines) for each book, reading only the indexed lines.
+    '''
+    with open(transcripts_file, 'rb') as f:
+        for book_key in sorted(index['books']):
+            lines = []
+            for offset in index['books'][book_key]:
+                f.seek(offset)
+                lines.append(f.readline().decode('utf-8'))
+            speaker, book = book_key.split('_')
+            yield speaker, book, lines
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input_file', default='./mls_portuguese_opus/dev/transcripts.txt')
+    parser.add_argument('-o', '--index_file', default=None)
+    args = parser.parse_args()
+
+    index = build_transcripts_index(args.input_file, args.index_file)
+    print('{} books indexed.'.format(len(index['books'])))
+
+
+if __name__ == "__main__":
+    main()
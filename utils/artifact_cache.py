@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Local cache of downloaded artifacts (dataset archives and mp3 files), shared by working directories, runs and machines.
+#
+import hashlib
+import json
+import shutil
+import socket
+import threading
+import time
+from os import environ, getpid, link, listdir, makedirs, remove, rename, replace, stat, utime
+from os.path import isdir, isfile, join, samefile
+
+try:
+    # Reflinks (copy on write clones), Linux only
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl of Linux copy on write clones (btrfs, xfs)
+FICLONE = 0x40049409
+LINK_MODES = ['hardlink', 'reflink', 'copy']
+CACHE_DIR_VARIABLE = 'MLS_CACHE_DIR'
+
+
+def get_default_cache_dir():
+    '''
+    Get the cache folder set in the MLS_CACHE_DIR environment variable, or None.
+    '''
+    return environ.get(CACHE_DIR_VARIABLE) or None
+
+
+def get_hash(*values):
+    return hashlib.sha256('\0'.join(values).encode('utf-8')).hexdigest()
+
+
+def write_json(filepath, content):
+    tmp_filepath = '{}.{}.{}.tmp'.format(filepath, socket.gethostname(), getpid())
+    with open(tmp_filepath, 'w') as f:
+        json.dump(content, f)
+    replace(tmp_filepath, filepath)
+
+
+def read_json(filepath):
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def reflink(source, filepath):
+    '''
+    Creates filepath as a copy on write clone of source. Raises OSError if the filesystem does not support it.
+    '''
+    if fcntl is None:
+        raise OSError('Reflinks are not supported on this platform.')
+    with open(source, 'rb') as source_file, open(filepath, 'wb') as f:
+        try:
+            fcntl.ioctl(f.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            f.close()
+            remove(filepath)
+            raise
+
+
+def link_file(source, filepath, link_mode='auto'):
+    '''
+    Creates filepath with the content of source, as a hardlink, a reflink or a copy (auto tries them in this order).
+    An existing filepath is replaced.
+    '''
+    if isfile(filepath) and samefile(source, filepath):
+        return
+    tmp_filepath = '{}.{}.{}.tmp'.format(filepath, socket.gethostname(), getpid())
+    link_modes = LINK_MODES if link_mode == 'auto' else [link_mode]
+    for i, mode in enumerate(link_modes):
+        try:
+            if mode == 'hardlink':
+                link(source, tmp_filepath)
+            elif mode == 'reflink':
+                reflink(source, tmp_filepath)
+            else:
+                shutil.copyfile(source, tmp_filepath)
+            break
+        except OSError:
+            # Another filesystem, or no support: next mode
+            if i == len(link_modes) - 1:
+                raise
+    replace(tmp_filepath, filepath)
+
+
+class CacheLock:
+    '''
+    Lock file shared by processes of several machines (created with O_EXCL, which is atomic on NFS, unlike flock).
+    The holder touches the file every refresh_interval seconds. A lock whose modification time does not change during
+    stale_after seconds is left by a dead process and is broken. Times are only compared to times of the same clock,
+    so clock differences between machines do not matter.
+    '''
+    def __init__(self, lock_filepath, stale_after=120, refresh_interval=20, poll_interval=1.0):
+        self.lock_filepath = lock_filepath
+        self.stale_after = stale_after
+        self.refresh_interval = refresh_interval
+        self.poll_interval = poll_interval
+        self.owner = '{} {} {}'.format(socket.gethostname(), getpid(), threading.get_ident())
+        self.stop_event = None
+
+    def try_acquire(self):
+        try:
+            with open(self.lock_filepath, 'x') as f:
+                f.write(self.owner)
+        except FileExistsError:
+            return False
+        self.stop_event = threading.Event()
+        threading.Thread(target=self.refresh, args=(self.stop_event,), daemon=True).start()
+        return True
+
+    def refresh(self, stop_event):
+        while not stop_event.wait(self.refresh_interval):
+            try:
+                utime(self.lock_filepath)
+            except OSError:
+                return
+
+    def break_stale(self, mtime):
+        '''
+        Removes a stale lock. If it was replaced by a new lock in the meantime, the new lock is put back.
+        '''
+        stale_filepath = '{}.{}.{}.stale'.format(self.lock_filepath, socket.gethostname(), getpid())
+        try:
+            rename(self.lock_filepath, stale_filepath)
+        except OSError:
+            return
+        if stat(stale_filepath).st_mtime != mtime:
+            try:
+                link(stale_filepath, self.lock_filepath)
+            except OSError:
+                pass
+        remove(stale_filepath)
+
+    def get_stale_mtime(self):
+        '''
+        Get the modification time of the lock if it was not refreshed during stale_after seconds, otherwise None.
+        Does not wait: the lock is compared to a file touched now in the same folder, so both times come from the clock
+        of the file server.
+        '''
+        clock_filepath = '{}.{}.{}.clock'.format(self.lock_filepath, socket.gethostname(), getpid())
+        try:
+            open(clock_filepath, 'w').close()
+            now = stat(clock_filepath).st_mtime
+            remove(clock_filepath)
+            mtime = stat(self.lock_filepath).st_mtime
+        except OSError:
+            return None
+        return mtime if now - mtime > self.stale_after else None
+
+    def acquire(self):
+        last_mtime, last_change = None, time.monotonic()
+        while not self.try_acquire():
+            try:
+                mtime = stat(self.lock_filepath).st_mtime
+            except OSError:
+                # Released in the meantime
+                continue
+            if mtime != last_mtime:
+                last_mtime, last_change = mtime, time.monotonic()
+            elif time.monotonic() - last_change > self.stale_after:
+                print('Breaking stale lock {}.'.format(self.lock_filepath))
+                self.break_stale(mtime)
+                continue
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        self.stop_event.set()
+        try:
+            remove(self.lock_filepath)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class ArtifactCache:
+    '''
+    Downloaded files stored once by url and validator (the ETag, or the size when the server sends none), so a new validator
+    on the server means a new object. Files are materialized in working folders as hardlinks, reflinks or copies.
+    The folder can be on NFS and shared by runs on several machines: a download is done by one of them while the others wait
+    for it, with a lock file per url. When max_size_gb is set, evict() removes the least recently used objects beyond it.
+    Hardlinked files share the data of the cache, so they must never be modified in place (the pipelines only replace files).
+
+    Layout: objects/<key[:2]>/<key> and <key>.json (url, validator, size, etag, md5), urls/<url hash>.json (the last object
+    of each url, and the keys of all its objects), locks/, downloads/ (partial downloads, resumed by the next run if
+    interrupted), summary.json (url and size of every object, kept by evict()) and added/<key>.json (objects added since).
+    '''
+    def __init__(self, cache_dir, max_size_gb=None, link_mode='auto'):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3) if max_size_gb else None
+        self.link_mode = link_mode
+        for folder in ('objects', 'urls', 'locks', 'downloads', 'added'):
+            makedirs(join(cache_dir, folder), exist_ok=True)
+
+    def get_object_filepath(self, key):
+        return join(self.cache_dir, 'objects', key[:2], key)
+
+    def get_url_filepath(self, url):
+        return join(self.cache_dir, 'urls', get_hash(url) + '.json')
+
+    def get_summary_filepath(self):
+        return join(self.cache_dir, 'summary.json')
+
+    def get_lock_filepath(self, url):
+        return join(self.cache_dir, 'locks', get_hash(url) + '.lock')
+
+    def lookup(self, url, validator=None):
+        '''
+        Get the entry of url with this validator, or None if it is not in the cache. Without validator, the last object
+        downloaded from url is used (for files that never change, like LibriVox mp3 files, this saves a request per file).
+        '''
+        if validator is None:
+            entry = read_json(self.get_url_filepath(url))
+        else:
+            entry = read_json(self.get_object_filepath(get_hash(url, validator)) + '.json')
+        if entry is None:
+            return None
+        object_filepath = self.get_object_filepath(entry['key'])
+        try:
+            if stat(object_filepath).st_size != entry['size']:
+                return None
+            # Last access, for the eviction
+            utime(object_filepath + '.json')
+        except OSError:
+            # Evicted
+            return None
+        return entry
+
+    def add(self, url, filepath, info):
+        '''
+        Moves a downloaded file into the cache. info is {"size", "etag", "md5"}. Returns the entry.
+        '''
+        validator = info.get('etag') or str(info['size'])
+        key = get_hash(url, validator)
+        object_filepath = self.get_object_filepath(key)
+        makedirs(join(self.cache_dir, 'objects', key[:2]), exist_ok=True)
+        replace(filepath, object_filepath)
+        entry = {'key': key, 'url': url, 'validator': validator, 'size': info['size'], 'etag': info.get('etag'), 'md5': info.get('md5')}
+        write_json(object_filepath + '.json', entry)
+        keys = [k for k in self.get_url_keys(url) if k != key] + [key]
+        write_json(self.get_url_filepath(url), dict(entry, keys=keys))
+        # Merged into the summary by the next evict()
+        write_json(join(self.cache_dir, 'added', key + '.json'), entry)
+        return entry
+
+    def adopt(self, url, filepath, info):
+        '''
+        Adds a copy of a complete file of a working folder to the cache (a hardlink when possible). Returns the entry.
+        '''
+        with CacheLock(self.get_lock_filepath(url)):
+            entry = self.lookup(url, info.get('etag') or str(info['size']))
+            if entry is None:
+                download_filepath = join(self.cache_dir, 'downloads', get_hash(url))
+                link_file(filepath, download_filepath, self.link_mode)
+                entry = self.add(url, download_filepath, info)
+        return entry
+
+    def get_url_keys(self, url):
+        '''
+        Get the keys of the objects downloaded from url, the last one at the end (some of them may be evicted).
+        '''
+        entry = read_json(self.get_url_filepath(url))
+        if entry is None:
+            return []
+        return entry.get('keys', [entry['key']])
+
+    def is_cached(self, filepath, url):
+        '''
+        Verify if filepath is a hardlink to an object of the cache downloaded from url.
+        '''
+        file_stat = stat(filepath)
+        if file_stat.st_nlink < 2:
+            return False
+        for key in self.get_url_keys(url):
+            try:
+                object_stat = stat(self.get_object_filepath(key))
+            except OSError:
+                continue
+            if (object_stat.st_dev, object_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino):
+                return True
+        return False
+
+    def materialize(self, entry, filepath):
+        link_file(self.get_object_filepath(entry['key']), filepath, self.link_mode)
+
+    def fetch(self, url, filepath, download_function, validator=None, force=False):
+        '''
+        Materializes url at filepath, downloading it to the cache first if needed. download_function(url, filepath)
+        downloads to filepath and returns {"size", "etag", "md5"}. Concurrent fetches of the same url, in this or
+        other processes, wait for one download. Returns the entry.
+        '''
+        entry = None if force else self.lookup(url, validator)
+        if entry is not None:
+            try:
+                self.materialize(entry, filepath)
+                return entry
+            except FileNotFoundError:
+                # Evicted in the meantime
+                pass
+        with CacheLock(self.get_lock_filepath(url)):
+            # Downloaded by another run while waiting
+            entry = None if force else self.lookup(url, validator)
+            if entry is None:
+                download_filepath = join(self.cache_dir, 'downloads', get_hash(url))
+                info = download_function(url, download_filepath)
+                entry = self.add(url, download_filepath, info)
+            # Objects are not evicted while their url is locked
+            self.materialize(entry, filepath)
+        return entry
+
+    def get_entries(self):
+        '''
+        Get (last access, entry) of every object, reading all of them.
+        '''
+        entries = []
+        objects_dir = join(self.cache_dir, 'objects')
+        for folder in listdir(objects_dir):
+            if not isdir(join(objects_dir, folder)):
+                continue
+            for filename in listdir(join(objects_dir, folder)):
+                if not filename.endswith('.json'):
+                    continue
+                entry_filepath = join(objects_dir, folder, filename)
+                entry = read_json(entry_filepath)
+                try:
+                    entries.append((stat(entry_filepath).st_mtime, entry))
+                except OSError:
+                    continue
+        return entries
+
+    def load_summary(self):
+        '''
+        Get {key: [url, size]} of every object: the summary written by the last eviction, with the objects added since
+        (the added markers are removed once merged). Without summary, the whole cache is read once.
+        '''
+        summary = read_json(self.get_summary_filepath())
+        if summary is None:
+            summary = {entry['key']: [entry['url'], entry['size']] for _, entry in self.get_entries() if entry is not None}
+        added_dir = join(self.cache_dir, 'added')
+        for filename in listdir(added_dir):
+            if not filename.endswith('.json'):
+                continue
+            entry = read_json(join(added_dir, filename))
+            if entry is not None:
+                summary[entry['key']] = [entry['url'], entry['size']]
+            remove(join(added_dir, filename))
+        return summary
+
+    def evict(self):
+        '''
+        Removes the least recently used objects until the cache fits in max_size_gb. Objects being downloaded are kept,
+        and only one run evicts at a time. The sizes come from the summary, and the last accesses are only read when the
+        cache is over max_size_gb. Returns the number of removed objects.
+        '''
+        if self.max_size is None:
+            return 0
+        evict_lock = CacheLock(join(self.cache_dir, 'locks', 'evict.lock'))
+        if not evict_lock.try_acquire():
+            # Left by a run that died while evicting
+            mtime = evict_lock.get_stale_mtime()
+            if mtime is None:
+                return 0
+            print('Breaking stale lock {}.'.format(evict_lock.lock_filepath))
+            evict_lock.break_stale(mtime)
+            if not evict_lock.try_acquire():
+                return 0
+        removed = 0
+        try:
+            summary = self.load_summary()
+            total_size = sum(size for _, size in summary.values())
+            if total_size > self.max_size:
+                entries = []
+                for key, (url, size) in summary.items():
+                    try:
+                        entries.append((stat(self.get_object_filepath(key) + '.json').st_mtime, key, url, size))
+                    except OSError:
+                        # Removed by hand
+                        total_size -= size
+                entries.sort()
+                for _, key, url, size in entries:
+                    if total_size <= self.max_size:
+                        break
+                    if isfile(self.get_lock_filepath(url)):
+                        continue
+                    object_filepath = self.get_object_filepath(key)
+                    for filepath in (object_filepath + '.json', object_filepath):
+                        if isfile(filepath):
+                            remove(filepath)
+                    url_entry = read_json(self.get_url_filepath(url))
+                    if url_entry is not None and url_entry['key'] == key:
+                        remove(self.get_url_filepath(url))
+                    total_size -= size
+                    removed += 1
+                summary = {key: [url, size] for _, key, url, size in entries if isfile(self.get_object_filepath(key) + '.json')}
+            write_json(self.get_summary_filepath(), summary)
+        finally:
+            evict_lock.release()
+        if removed:
+            print('Removed {} objects from the cache {}.'.format(removed, self.cache_dir))
+        return removed
+
+
+def get_artifact_cache(cache_dir=None, max_size_gb=None):
+    '''
+    Get the ArtifactCache of cache_dir (by default, the MLS_CACHE_DIR environment variable), or None if there is none.
+    '''
+    cache_dir = cache_dir or get_default_cache_dir()
+    if not cache_dir:
+        return None
+    return ArtifactCache(cache_dir, max_size_gb)
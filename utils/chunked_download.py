@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Parallel download of big files in byte ranges, resumable from a chunk state file.
+#
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from os import replace, remove
+from os.path import isfile, getsize
+from tqdm import tqdm
+from utils.download_manager import DownloadManager, DownloadError, PART_EXTENSION
+
+
+def get_chunks_filepath(filepath):
+    return filepath + PART_EXTENSION + '.chunks.json'
+
+
+def get_chunk_ranges(size, chunk_bytes):
+    '''
+    Get the (first, last) bytes of each chunk.
+    '''
+    return [(first, min(first + chunk_bytes, size) - 1) for first in range(0, size, chunk_bytes)]
+
+
+class ChunksState:
+    '''
+    Completed chunks of a download, saved after each chunk so an interrupted download resumes without repeating them.
+    '''
+    def __init__(self, filepath, url, size, etag, chunk_bytes):
+        self.state_filepath = get_chunks_filepath(filepath)
+        self.state = {'url': url, 'size': size, 'etag': etag, 'chunk_bytes': chunk_bytes, 'done': []}
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''
+        Loads the previous state. Returns False if there is none, or if it does not match the file on the server.
+        '''
+        try:
+            with open(self.state_filepath) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        for key in ('size', 'etag', 'chunk_bytes'):
+            if state.get(key) != self.state[key]:
+                return False
+        self.state['done'] = state['done']
+        return True
+
+    def is_done(self, index):
+        return index in self.state['done']
+
+    def set_done(self, *indexes):
+        with self.lock:
+            self.state['done'].extend(indexes)
+            tmp_filepath = self.state_filepath + '.tmp'
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.state, f)
+            replace(tmp_filepath, self.state_filepath)
+
+    def remove(self):
+        if isfile(self.state_filepath):
+            remove(self.state_filepath)
+
+
+def download_chunked(url, filepath, connections=8, chunk_mb=64, download_manager=None):
+    '''
+    Downloads url to filepath with "connections" parallel Range requests of chunk_mb MB each.
+    Chunks are written in place to a preallocated filepath.part, and completed chunks are recorded in filepath.part.chunks.json,
+    so an interrupted download only fetches the missing chunks. The file is renamed when all chunks are done and its size
+    matches the size on the server. An existing filepath is kept if its size matches, otherwise its complete chunks are reused.
+    Servers without Range support get a single resumable stream. Returns the size of the file, or raises DownloadError.
+    '''
+    if download_manager is None:
+        download_manager = DownloadManager(connections_per_host=connections, requests_per_second=0)
+    size, etag, accepts_ranges = download_manager.get_remote_info(url)
+    if not accepts_ranges or not size:
+        print('Ranges are not supported by the server, downloading {} in one stream.'.format(url))
+        return download_manager.download(url, filepath)['size']
+
+    chunk_bytes = int(chunk_mb * 1024 * 1024)
+    chunk_ranges = get_chunk_ranges(size, chunk_bytes)
+    part_filepath = filepath + PART_EXTENSION
+    state = ChunksState(filepath, url, size, etag, chunk_bytes)
+    existing_size = getsize(filepath) if isfile(filepath) else None
+    if existing_size == size:
+        return size
+    if existing_size is not None and existing_size < size:
+        # Incomplete file of a previous single stream download: its complete chunks are kept
+        print('File {} is incomplete ({} of {} bytes), resuming.'.format(filepath, existing_size, size))
+        replace(filepath, part_filepath)
+        with open(part_filepath, 'r+b') as f:
+            f.truncate(size)
+        state.set_done(*[index for index, (first, last) in enumerate(chunk_ranges) if last < existing_size])
+    elif existing_size is not None or not isfile(part_filepath) or not state.load():
+        # The chunks of a previous state are not in the new part file
+        state.remove()
+        state.state['done'] = []
+        with open(part_filepath, 'wb') as f:
+            # Preallocates the file, so each chunk is written at its offset
+            f.truncate(size)
+
+    pending = [index for index in range(len(chunk_ranges)) if not state.is_done(index)]
+    pbar = tqdm(total=size, initial=size - sum(chunk_ranges[i][1] - chunk_ranges[i][0] + 1 for i in pending), unit='B', unit_scale=True)
+
+    def download_chunk(index):
+        first, last = chunk_ranges[index]
+        download_manager.download_range(url, part_filepath, first, last, etag)
+        state.set_done(index)
+        pbar.update(last - first + 1)
+
+    try:
+        with ThreadPoolExecutor(connections) as executor:
+            # Raises the first error, the completed chunks are kept
+            list(executor.map(download_chunk, pending))
+    finally:
+        pbar.close()
+
+    if len(state.state['done']) != len(chunk_ranges) or getsize(part_filepath) != size:
+        raise DownloadError('Incomplete download of {}: {} of {} bytes.'.format(url, getsize(part_filepath), size), retry=True)
+    replace(part_filepath, filepath)
+    state.remove()
+    return size
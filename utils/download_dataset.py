@@ -1,118 +1,196 @@
-from os.path import isfile, isdir, basename, join
-import urllib.request
-import progressbar
+from os.path import isfile, isdir, basename, join, getsize
+from utils.chunked_download import download_chunked
+from utils.download_manager import DownloadManager, DownloadError
+from utils.tar_index import extract_archive_members, load_tar_index, iter_member_readers, iter_scan_archive, is_known_missing
+import io
 import tarfile
 
+SPLITS = ['dev', 'test', 'train']
+# Members of each split extracted together
+SPLIT_FILES = ['transcripts.txt', 'segments.txt']
 
-class MyProgressBar():
+
+def download_archive(url, filename, connections=8, chunk_mb=64, artifact_cache=None):
     '''
-    Progress Bar for Download. Source: https://stackoverflow.com/questions/37748105/how-to-use-progressbar-module-with-urlretrieve
+    Downloads a dataset archive in parallel chunks, resuming interrupted downloads.
+    An existing file is only accepted if its size matches the file on the server.
+    With artifact_cache, the archive is downloaded once to the cache and linked to filename.
     '''
-    def __init__(self):
-        self.pbar = None
+    if artifact_cache is not None:
+        return download_cached_archive(url, filename, connections, chunk_mb, artifact_cache)
+    try:
+        download_chunked(url, filename, connections, chunk_mb)
+    except DownloadError as e:
+        if isfile(filename):
+            # Offline: the size could not be verified
+            print('File {} exists, but it could not be verified: {}'.format(filename, e))
+            return filename
+        print(e)
+        return False
+    return filename
 
-    def __call__(self, block_num, block_size, total_size):
-        if not self.pbar:
-            self.pbar=progressbar.ProgressBar(maxval=total_size)
-            self.pbar.start()
+def download_cached_archive(url, filename, connections=8, chunk_mb=64, artifact_cache=None):
+    '''
+    Links the cached archive of url, with the ETag of the server, to filename. A complete filename downloaded before is added
+    to the cache instead of being downloaded again. Offline, the last cached archive of url is used.
+    '''
+    download_manager = DownloadManager(connections_per_host=connections, requests_per_second=0)
+    try:
+        size, etag, _ = download_manager.get_remote_info(url)
+    except DownloadError as e:
+        entry = artifact_cache.lookup(url)
+        if entry is not None:
+            print('Server not available ({}), using the cached {}.'.format(e, url))
+            artifact_cache.materialize(entry, filename)
+            return filename
+        return download_archive(url, filename, connections, chunk_mb)
+    validator = etag or str(size)
+    # A link to an older cached version is not adopted
+    if artifact_cache.lookup(url, validator) is None and isfile(filename) and getsize(filename) == size and not artifact_cache.is_cached(filename, url):
+        artifact_cache.adopt(url, filename, {'size': size, 'etag': etag, 'md5': None})
+
+    def download(url, filepath):
+        return {'size': download_chunked(url, filepath, connections, chunk_mb, download_manager), 'etag': etag, 'md5': None}
 
-        downloaded = block_num * block_size
-        if downloaded < total_size:
-            self.pbar.update(downloaded)
-        else:
-            self.pbar.finish()
+    try:
+        artifact_cache.fetch(url, filename, download, validator)
+    except DownloadError as e:
+        print(e)
+        return False
+    finally:
+        download_manager.close()
+    artifact_cache.evict()
+    return filename
 
-def download_books_dataset(lang = 'pt'):
+def download_books_dataset(lang = 'pt', connections=8, chunk_mb=64, artifact_cache=None):
     '''
     Download Books information.
     '''
     url = 'https://dl.fbaipublicfiles.com/mls/lv_text.tar.gz'
 
     books_filename = url.split('/')[-1]
+    return download_archive(url, books_filename, connections, chunk_mb, artifact_cache)
 
-    if isfile(books_filename):
-        print('File {} exists!'.format(books_filename))
-        return books_filename
-
-    try:
-        urllib.request.urlretrieve(url, books_filename, MyProgressBar())
-    except Exception as e:
-        print(e)
-        return False
-
-    return books_filename
-
-def download_language_dataset(lang = 'pt'):
+def get_language_dataset_url(lang = 'pt'):
     '''
-    Download datasets
+    Get the url of the MLS tar.gz of a language, or None if the language is invalid.
     '''
-
     # Choose dataset
     if lang == 'pt':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_portuguese_opus.tar.gz'
+        return 'https://dl.fbaipublicfiles.com/mls/mls_portuguese_opus.tar.gz'
     elif lang == 'pl':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_polish_opus.tar.gz'
+        return 'https://dl.fbaipublicfiles.com/mls/mls_polish_opus.tar.gz'
     elif lang == 'it':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_italian_opus.tar.gz'        
+        return 'https://dl.fbaipublicfiles.com/mls/mls_italian_opus.tar.gz'
     elif lang == 'sp':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_spanish_opus.tar.gz'
+        return 'https://dl.fbaipublicfiles.com/mls/mls_spanish_opus.tar.gz'
     elif lang == 'fr':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_french_opus.tar.gz'
+        return 'https://dl.fbaipublicfiles.com/mls/mls_french_opus.tar.gz'
     elif lang == 'du':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_dutch_opus.tar.gz'
+        return 'https://dl.fbaipublicfiles.com/mls/mls_dutch_opus.tar.gz'
     elif lang == 'ge':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_german_opus.tar.gz'
+        return 'https://dl.fbaipublicfiles.com/mls/mls_german_opus.tar.gz'
     elif lang == 'en':
-        url = 'https://dl.fbaipublicfiles.com/mls/mls_english_opus.tar.gz'
-    else:
-        print('Error: invalid language {}.'.format(lang))        
+        return 'https://dl.fbaipublicfiles.com/mls/mls_english_opus.tar.gz'
+    return None
+
+def download_language_dataset(lang = 'pt', connections=8, chunk_mb=64, artifact_cache=None):
+    '''
+    Download datasets
+    '''
+    url = get_language_dataset_url(lang)
+    if url is None:
+        print('Error: invalid language {}.'.format(lang))
         return False
 
     transcripts_filename = url.split('/')[-1]
-    if isfile(transcripts_filename):
-        print('File {} exists!'.format(transcripts_filename))
+    # Download transcripts information
+    return download_archive(url, transcripts_filename, connections, chunk_mb, artifact_cache)
 
+def get_split_members(tar_filename, filename):
+    '''
+    Get the members dev/filename, test/filename and train/filename of a MLS tar.gz
+    '''
+    basefilename = basename(tar_filename).split('.')[0]
+    return [join(basefilename, split, filename) for split in SPLITS]
+
+
+def extract_split_files(tar_filename):
+    '''
+    Extract the transcripts.txt and segments.txt files of every split with one decompression of the tar.gz.
+    The audio and text pipelines both need them, so the second one finds them already extracted.
+    '''
+    members = [member for filename in SPLIT_FILES for member in get_split_members(tar_filename, filename)]
+    missing = [member for member in members if not isfile(member)]
+    if not missing:
+        return True
+    try:
+        not_found = extract_archive_members(tar_filename, missing, './')
+    except Exception as e:
+        print(e)
+        return False
+    if not_found:
+        print('Error: {} not found in {}.'.format(', '.join(not_found), tar_filename))
+        return False
+    return True
+
+
+def iter_archive_member_lines(tar_filename, name):
+    '''
+    Yields the lines of a member straight from the tar.gz, without extracting it. With the offset index, the stream starts
+    at the member, otherwise one streaming pass finds it (and records the index).
+    '''
+    index = load_tar_index(tar_filename)
+    if index is not None and name in index['members']:
+        members = iter_member_readers(tar_filename, [name], index)
+    elif is_known_missing(index, name):
+        raise IOError('{} not found in {}.'.format(name, tar_filename))
     else:
-        # Download transcripts information
-        try:
-            urllib.request.urlretrieve(url, transcripts_filename, MyProgressBar())
-        except Exception as e:
-            print(e)
-            return False
+        members = iter_scan_archive(tar_filename, [name])
 
-    return transcripts_filename
+    found = False
+    for _, member_file in members:
+        found = True
+        # Streamed tar members are not seekable, so lines are decoded one by one
+        for line in io.BufferedReader(member_file):
+            yield line.decode('utf-8')
+    if not found:
+        raise IOError('{} not found in {}.'.format(name, tar_filename))
 
-def extract_transcript_files(tar_filename_transcripts):
+
+class ArchiveMember:
     '''
-    Extract transcripts.txt file from MLS tar.gz
+    A text member of a tar.gz, used in place of an extracted file by the MLS readers. Each iteration streams its lines again.
     '''
+    def __init__(self, tar_filename, name):
+        self.tar_filename = tar_filename
+        self.name = name
+
+    def __iter__(self):
+        return iter_archive_member_lines(self.tar_filename, self.name)
+
+    def __str__(self):
+        return '{}:{}'.format(self.tar_filename, self.name)
 
-    # Extract transcripts
-    basefilename = basename(tar_filename_transcripts).split('.')[0]
-    dev_trans_file   = join(basefilename, 'dev/transcripts.txt')
-    test_trans_file  = join(basefilename, 'test/transcripts.txt')
-    train_trans_file = join(basefilename, 'train/transcripts.txt')
 
-    transcripts_files = [
-        dev_trans_file,
-        test_trans_file,
-        train_trans_file
-    ]
+def get_archive_members(tar_filename, filename):
+    '''
+    Get an ArchiveMember for dev/filename, test/filename and train/filename of a MLS tar.gz
+    '''
+    return [ArchiveMember(tar_filename, name) for name in get_split_members(tar_filename, filename)]
 
-    if isfile(dev_trans_file) and isfile(test_trans_file) and isfile(train_trans_file):
+
+def extract_transcript_files(tar_filename_transcripts):
+    '''
+    Extract transcripts.txt file from MLS tar.gz
+    '''
+    transcripts_files = get_split_members(tar_filename_transcripts, 'transcripts.txt')
+    if all(isfile(transcripts_file) for transcripts_file in transcripts_files):
         print('Transcripts already extracted!')
         return transcripts_files
 
-    try:
-        tar_file = tarfile.open(tar_filename_transcripts)
-        tar_file.extract(dev_trans_file,'./')
-        tar_file.extract(test_trans_file,'./')
-        tar_file.extract(train_trans_file,'./')
-        tar_file.close()
-    except Exception as e:
-        print(e)
+    if not extract_split_files(tar_filename_transcripts):
         return False
-
     return transcripts_files
 
 
@@ -133,35 +211,17 @@ def extract_book_files(tar_filename_books):
         print(e)
         return False
 
-    return basename
+    return basefilename
 
 def extract_segment_files(tar_filename_segments):
     '''
     Extract segments.txt file from tar.gz
     '''
-    basefilename   = basename(tar_filename_segments).split('.')[0]
-    dev_file   = join(basefilename, 'dev/segments.txt')
-    test_file  = join(basefilename, 'test/segments.txt')
-    train_file = join(basefilename, 'train/segments.txt')
-
-    segments_files = [
-        dev_file,
-        test_file,
-        train_file
-    ]
-
-    if isfile(dev_file) and isfile(test_file) and isfile(train_file):
+    segments_files = get_split_members(tar_filename_segments, 'segments.txt')
+    if all(isfile(segments_file) for segments_file in segments_files):
         print('Segments files exists!')
         return segments_files
 
-    try:
-        tar_file = tarfile.open(tar_filename_segments)
-        tar_file.extract(dev_file,'./')
-        tar_file.extract(test_file,'./')
-        tar_file.extract(train_file,'./')
-        tar_file.close()
-    except Exception as e:
-        print(e)
+    if not extract_split_files(tar_filename_segments):
         return False
-
-    return segments_files
\ No newline at end of file
+    return segments_files
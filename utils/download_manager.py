@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Concurrent HTTP downloads: keep-alive connections per host, token bucket rate limit, retries with backoff and host health.
+#
+import hashlib
+import http.client
+import json
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import replace, remove
+from os.path import isfile, getsize
+from urllib.parse import urlsplit, urljoin
+
+USER_AGENT = 'cml-tts-toolkit'
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+CHUNK_SIZE = 1024 * 1024
+PART_EXTENSION = '.part'
+
+
+class DownloadError(IOError):
+    '''
+    Failed request. retry is True for errors that may succeed later (connection problems, throttling and server errors).
+    '''
+    def __init__(self, message, status=None, retry=False, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry = retry
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''
+    Allows "rate" requests per second on average, with bursts of at most "capacity" requests. A rate <= 0 means no limit.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class HostHealth:
+    '''
+    Health of a host from the outcome of the real requests. After failure_threshold consecutive failures the host is
+    considered down, and new requests wait a cooldown that doubles with each new failure. Retry-After is always respected.
+    '''
+    def __init__(self, failure_threshold=3, cooldown=10.0, max_cooldown=300.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def record_success(self):
+        with self.lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+
+    def record_failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            now = time.monotonic()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif self.consecutive_failures >= self.failure_threshold:
+                cooldown = min(self.cooldown * 2 ** (self.consecutive_failures - self.failure_threshold), self.max_cooldown)
+                self.blocked_until = max(self.blocked_until, now + cooldown)
+
+    def is_healthy(self):
+        return self.consecutive_failures < self.failure_threshold
+
+    def wait(self):
+        '''
+        Waits while the host is blocked (throttled or down).
+        '''
+        while True:
+            with self.lock:
+                wait_time = self.blocked_until - time.monotonic()
+            if wait_time <= 0:
+                return
+            time.sleep(wait_time)
+
+
+class HostPool:
+    '''
+    Connections of one host: at most max_connections at once, idle keep-alive connections are reused.
+    '''
+    def __init__(self, scheme, netloc, max_connections=2, requests_per_second=1.0, burst=2, timeout=60):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.bucket = TokenBucket(requests_per_second, burst)
+        self.health = HostHealth()
+        self.idle_connections = []
+        self.opened_connections = 0
+        self.lock = threading.Lock()
+
+    def new_connection(self):
+        with self.lock:
+            self.opened_connections += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def get_connection(self):
+        '''
+        Get (connection, reused).
+        '''
+        with self.lock:
+            if self.idle_connections:
+                return self.idle_connections.pop(), True
+        return self.new_connection(), False
+
+    def release_connection(self, connection, reusable):
+        if not reusable:
+            connection.close()
+            return
+        with self.lock:
+            self.idle_connections.append(connection)
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle_connections:
+                connection.close()
+            self.idle_connections = []
+
+
+class DownloadManager:
+    '''
+    Downloads files with at most connections_per_host connections and requests_per_second requests per host.
+    Failed requests are retried max_retries times with exponential backoff and jitter.
+    '''
+    def __init__(self, connections_per_host=2, requests_per_second=1.0, burst=2, max_retries=5, backoff_base=1.0, backoff_max=60.0, timeout=60, max_redirects=5):
+        self.connections_per_host = connections_per_host
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def get_host(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = HostPool(parts.scheme, parts.netloc, self.connections_per_host, self.requests_per_second, self.burst, self.timeout)
+            return self.hosts[key]
+
+    def get_backoff(self, attempt):
+        # Full jitter: a random wait up to the exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def send_request(self, host, url, headers):
+        '''
+        Sends a GET request. Returns (connection, response).
+        '''
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict({'User-Agent': USER_AGENT, 'Connection': 'keep-alive'}, **(headers or {}))
+        connection, reused = host.get_connection()
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+        # The server closed the idle connection: one more try on a new connection
+        connection = host.new_connection()
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            raise
+
+    def fetch_once(self, url, headers, handle_response, redirects=0):
+        '''
+        One GET request, following redirects. 200 and 206 responses are passed to handle_response(response) while the
+        connection is held. Returns (response, result of handle_response), or raises DownloadError for other statuses.
+        '''
+        host = self.get_host(url)
+        host.health.wait()
+        host.bucket.acquire()
+        location = None
+        with host.semaphore:
+            connection = None
+            reusable = False
+            try:
+                connection, response = self.send_request(host, url, headers)
+                if response.status in REDIRECT_STATUSES:
+                    location = response.getheader('Location')
+                    response.read()
+                elif response.status in (200, 206):
+                    result = handle_response(response)
+                else:
+                    response.read()
+                # Bodies not read to the end leave the connection unusable
+                reusable = not response.will_close and response.isclosed()
+            except DownloadError:
+                host.health.record_failure()
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                host.health.record_failure()
+                raise DownloadError('Connection problem to access {}: {}'.format(url, e), retry=True)
+            finally:
+                if connection is not None:
+                    host.release_connection(connection, reusable)
+
+        if response.status in (200, 206):
+            host.health.record_success()
+            return response, result
+        if location is not None:
+            host.health.record_success()
+            if redirects >= self.max_redirects:
+                raise DownloadError('Too many redirects from {}'.format(url))
+            return self.fetch_once(urljoin(url, location), headers, handle_response, redirects + 1)
+
+        # Throttling and server errors can be retried, the other statuses are final
+        retry = response.status == 429 or response.status >= 500
+        retry_after = get_retry_after(response)
+        if retry:
+            host.health.record_failure(retry_after)
+        else:
+            host.health.record_success()
+        raise DownloadError('HTTP {} on {}'.format(response.status, url), response.status, retry, retry_after)
+
+    def with_retries(self, function, *args):
+        '''
+        Calls function(*args), retrying the errors that may succeed later with exponential backoff and jitter.
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                return function(*args)
+            except DownloadError as e:
+                if not e.retry or attempt == self.max_retries:
+                    raise
+                # Retry-After is waited by the host health
+                time.sleep(self.get_backoff(attempt))
+
+    def download_once(self, url, filepath):
+        '''
+        One attempt to download url to filepath. The body is written to filepath.part, resumed with a Range request
+        when the part file exists, and renamed when complete. Returns a dict with size, etag and md5.
+        '''
+        part_filepath = filepath + PART_EXTENSION
+        part_info = load_part_info(filepath)
+        offset = getsize(part_filepath) if part_info is not None and isfile(part_filepath) else 0
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if part_info.get('etag'):
+                # The server sends the whole file if it changed since
+                headers['If-Range'] = part_info['etag']
+
+        try:
+            response, total_bytes = self.fetch_once(url, headers, lambda response: self.write_response(response, filepath, offset, part_info))
+        except DownloadError as e:
+            if e.status != 416:
+                raise
+            # The part file does not match the file on the server anymore
+            remove_part(filepath)
+            raise DownloadError('Range not satisfiable on {}, downloading again.'.format(url), e.status, retry=True)
+
+        info = {'size': total_bytes, 'etag': response.getheader('ETag'), 'md5': get_md5(part_filepath)}
+        replace(part_filepath, filepath)
+        remove_part_info(filepath)
+        return info
+
+    def write_response(self, response, filepath, offset, part_info):
+        '''
+        Writes the body to filepath.part, appending a 206 response at offset. Returns the size of the complete file.
+        Incomplete part files are kept, so the next attempt resumes them.
+        '''
+        etag = response.getheader('ETag')
+        if response.status == 206:
+            first, total_bytes = parse_content_range(response.getheader('Content-Range'))
+            if first != offset or (etag and part_info.get('etag') and etag != part_info['etag']):
+                remove_part(filepath)
+                raise DownloadError('Unexpected range from the server, downloading again.', response.status, retry=True)
+        else:
+            offset = 0
+            length = response.getheader('Content-Length')
+            total_bytes = int(length) if length is not None else None
+        save_part_info(filepath, {'etag': etag, 'size': total_bytes})
+
+        part_filepath = filepath + PART_EXTENSION
+        with open(part_filepath, 'r+b' if offset > 0 else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            shutil.copyfileobj(response, f, CHUNK_SIZE)
+            size = f.tell()
+        if total_bytes is not None and size != total_bytes:
+            raise DownloadError('Incomplete download: {} of {} bytes.'.format(size, total_bytes), retry=True)
+        return size
+
+    def download(self, url, filepath):
+        '''
+        Downloads url to filepath, retrying errors that may succeed later. Returns a dict with size, etag and md5,
+        or raises DownloadError.
+        '''
+        return self.with_retries(self.download_once, url, filepath)
+
+    def get_remote_info(self, url):
+        '''
+        Get (size, etag, accepts ranges) of url with a one byte Range request. size is None when unknown.
+        '''
+        def handle_response(response):
+            if response.status == 206:
+                response.read()
+            # The whole file is not read: the connection is closed
+
+        response, _ = self.with_retries(self.fetch_once, url, {'Range': 'bytes=0-0'}, handle_response)
+        if response.status == 206:
+            _, size = parse_content_range(response.getheader('Content-Range'))
+            return size, response.getheader('ETag'), True
+        length = response.getheader('Content-Length')
+        return int(length) if length is not None else None, response.getheader('ETag'), False
+
+    def download_range_once(self, url, filepath, first, last, etag=None):
+        '''
+        One attempt to download the bytes first to last (inclusive) of url into filepath, at the same offsets.
+        With etag, fails (without retry) if the file changed on the server. Returns the number of bytes.
+        '''
+        headers = {'Range': 'bytes={}-{}'.format(first, last)}
+        if etag:
+            headers['If-Range'] = etag
+
+        def handle_response(response):
+            if response.status != 206:
+                raise DownloadError('The file changed on the server or ranges are not supported: {}'.format(url), response.status)
+            range_first, _ = parse_content_range(response.getheader('Content-Range'))
+            if range_first != first:
+                raise DownloadError('Unexpected range from the server on {}.'.format(url), response.status, retry=True)
+            with open(filepath, 'r+b') as f:
+                f.seek(first)
+                shutil.copyfileobj(response, f, CHUNK_SIZE)
+                size = f.tell() - first
+            if size != last - first + 1:
+                raise DownloadError('Incomplete range: {} of {} bytes.'.format(size, last - first + 1), retry=True)
+            return size
+
+        _, size = self.fetch_once(url, headers, handle_response)
+        return size
+
+    def download_range(self, url, filepath, first, last, etag=None):
+        return self.with_retries(self.download_range_once, url, filepath, first, last, etag)
+
+    def download_all(self, items, threads=None):
+        '''
+        Downloads many (url, filepath) items. Returns a list of (url, filepath, error), error is None on success.
+        '''
+        def download(item):
+            url, filepath = item
+            try:
+                self.download(url, filepath)
+            except DownloadError as e:
+                return url, filepath, str(e)
+            return url, filepath, None
+
+        with ThreadPoolExecutor(threads or self.connections_per_host) as executor:
+            return list(executor.map(download, items))
+
+    def print_stats(self):
+        for (scheme, netloc), host in sorted(self.hosts.items()):
+            print('{}: {} connections, {} ok, {} failed requests{}'.format(
+                netloc, host.opened_connections, host.health.successes, host.health.failures, '' if host.health.is_healthy() else ' (down)'))
+
+    def close(self):
+        with self.lock:
+            for host in self.hosts.values():
+                host.close()
+
+
+def get_retry_after(response):
+    value = response.getheader('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        # HTTP dates are not used by the servers we download from
+        return None
+
+
+def parse_content_range(value):
+    '''
+    Get (first byte, total size) from "bytes first-last/total". total is None when unknown.
+    '''
+    try:
+        unit, byte_range = value.split(' ', 1)
+        first_last, total = byte_range.split('/')
+        return int(first_last.split('-')[0]), None if total == '*' else int(total)
+    except (AttributeError, ValueError):
+        raise DownloadError('Invalid Content-Range: {}'.format(value), retry=True)
+
+
+def get_part_info_filepath(filepath):
+    return filepath + PART_EXTENSION + '.json'
+
+
+def load_part_info(filepath):
+    '''
+    Get the ETag and size of the file being downloaded to filepath.part, or None.
+    '''
+    try:
+        with open(get_part_info_filepath(filepath)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_part_info(filepath, part_info):
+    with open(get_part_info_filepath(filepath), 'w') as f:
+        json.dump(part_info, f)
+
+
+def remove_part_info(filepath):
+    if isfile(get_part_info_filepath(filepath)):
+        remove(get_part_info_filepath(filepath))
+
+
+def remove_part(filepath):
+    if isfile(filepath + PART_EXTENSION):
+        remove(filepath + PART_EXTENSION)
+    remove_part_info(filepath)
+
+
+def get_md5(filepath):
+    md5 = hashlib.md5()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Manifest of completed downloads (size and checksum), so resume decisions need no request to the server.
+#
+import json
+import threading
+from os import stat
+from os.path import isfile, join, relpath, dirname
+from utils.download_manager import get_md5
+
+
+def get_download_manifest_filepath(output_dir):
+    return join(output_dir, 'download_manifest.jsonl')
+
+
+class DownloadManifest:
+    '''
+    One json line per completed download: {"file", "url", "size", "etag", "md5"}, the file relative to the manifest folder.
+    The last line of a file wins.
+    '''
+    def __init__(self, manifest_filepath, verify_checksums=False):
+        self.manifest_filepath = manifest_filepath
+        self.base_dir = dirname(manifest_filepath)
+        self.verify_checksums = verify_checksums
+        self.entries = {}
+        self.lock = threading.Lock()
+        if isfile(manifest_filepath):
+            with open(manifest_filepath) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line partially written by an interrupted run
+                        continue
+                    self.entries[entry['file']] = entry
+
+    def get_key(self, filepath):
+        return relpath(filepath, self.base_dir)
+
+    def check(self, filepath):
+        '''
+        Get True if filepath matches its manifest entry, False if it does not (missing, truncated or corrupt),
+        or None if it is not in the manifest. Checksums are only computed with verify_checksums.
+        '''
+        entry = self.entries.get(self.get_key(filepath))
+        if entry is None:
+            return None
+        if not isfile(filepath) or stat(filepath).st_size != entry['size']:
+            return False
+        if self.verify_checksums and get_md5(filepath) != entry['md5']:
+            return False
+        return True
+
+    def add(self, filepath, url, info):
+        '''
+        Records a completed download. info is the dict returned by DownloadManager.download.
+        '''
+        entry = {'file': self.get_key(filepath), 'url': url, 'size': info['size'], 'etag': info['etag'], 'md5': info['md5']}
+        with self.lock:
+            self.entries[entry['file']] = entry
+            with open(self.manifest_filepath, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Local stand-in HTTP server to test the downloads: serves a folder with keep-alive and Range requests, and simulates throttling and failures.
+#
+import argparse
+import random
+import threading
+from functools import partial
+from os import stat
+from os.path import isfile
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StandInHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.total_connections += 1
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_failure(self, status, retry_after=None):
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.total_requests += 1
+            request_number = server.total_requests
+            draw = server.random.random()
+        if server.throttle_every and request_number % server.throttle_every == 0:
+            server.count('throttled')
+            self.send_failure(429, server.retry_after)
+        elif draw < server.failure_rate:
+            server.count('failed')
+            self.send_failure(503)
+        elif draw < server.failure_rate + server.drop_rate:
+            server.count('dropped')
+            self.send_file(drop=True)
+        else:
+            self.send_file()
+
+    def get_range(self, size, etag):
+        '''
+        Get the requested (first, last) bytes, None for the whole file or False if not satisfiable.
+        Only single "bytes=first-[last]" ranges are supported. If-Range with another ETag gets the whole file.
+        '''
+        value = self.headers.get('Range')
+        if value is None or not value.startswith('bytes=') or ',' in value:
+            return None
+        if self.headers.get('If-Range') not in (None, etag):
+            return None
+        first, last = value[len('bytes='):].split('-')
+        if not first:
+            # Suffix range: the last bytes
+            first, last = max(size - int(last), 0), size - 1
+        first, last = int(first), min(int(last) if last else size - 1, size - 1)
+        if first >= size or first > last:
+            return False
+        return first, last
+
+    def send_file(self, drop=False):
+        '''
+        Sends a file, or the requested range of it, with an ETag. With drop, sends half of the body and closes the connection.
+        '''
+        path = self.translate_path(self.path)
+        if not isfile(path):
+            self.send_failure(404)
+            return
+        file_stat = stat(path)
+        size = file_stat.st_size
+        etag = '"{:x}-{:x}"'.format(size, int(file_stat.st_mtime))
+        byte_range = self.get_range(size, etag)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(size))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        first, last = byte_range or (0, size - 1)
+        length = last - first + 1
+
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(first)
+            data = f.read(length)
+        if drop:
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    throttle_every: every n-th request gets 429 with Retry-After; failure_rate: fraction of 503 responses;
+    drop_rate: fraction of connections closed in the middle of the body.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, directory='./', throttle_every=0, retry_after=1, failure_rate=0.0, drop_rate=0.0, seed=0, verbose=False):
+        super().__init__(address, partial(StandInHandler, directory=directory))
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.verbose = verbose
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.total_connections = 0
+        self.total_requests = 0
+        self.counters = {'throttled': 0, 'failed': 0, 'dropped': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_url(self, path=''):
+        return 'http://{}:{}/{}'.format(self.server_address[0], self.server_address[1], path.lstrip('/'))
+
+    def print_stats(self):
+        print('{} connections, {} requests, {} throttled, {} failed, {} dropped'.format(
+            self.total_connections, self.total_requests, self.counters['throttled'], self.counters['failed'], self.counters['dropped']))
+
+
+def start_test_server(directory='./', port=0, **settings):
+    '''
+    Starts a stand-in server in a background thread (port 0 picks a free port). Returns the server, stop it with shutdown().
+    '''
+    server = StandInServer(('127.0.0.1', port), directory, **settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', default='./', help='Folder to serve')
+    parser.add_argument('-p', '--port', default=8000)
+    parser.add_argument('-t', '--throttle_every', default=0, help='Every n-th request gets 429 Too Many Requests')
+    parser.add_argument('-r', '--retry_after', default=1, help='Retry-After (seconds) of throttled requests')
+    parser.add_argument('-f', '--failure_rate', default=0.0, help='Fraction of 503 responses')
+    parser.add_argument('-x', '--drop_rate', default=0.0, help='Fraction of responses closed in the middle of the body')
+    parser.add_argument('-s', '--seed', default=0)
+    args = parser.parse_args()
+
+    server = StandInServer(('127.0.0.1', int(args.port)), args.directory, int(args.throttle_every), int(args.retry_after), float(args.failure_rate), float(args.drop_rate), int(args.seed), verbose=True)
+    print('Serving {} at {}'.format(args.directory, server.get_url()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.print_stats()
+
+
+if __name__ == "__main__":
+    main()
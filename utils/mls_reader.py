@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Streaming readers for MLS transcripts.txt and segments.txt files.
+#
+import heapq
+import tempfile
+from itertools import islice
+
+
+def iter_lines(source):
+    '''
+    Yields the lines of a file path or of an iterable of lines (like a member of a tar.gz), without reading everything into memory.
+    '''
+    if isinstance(source, str):
+        with open(source) as f:
+            for line in f:
+                yield line
+    else:
+        for line in source:
+            yield line
+
+
+def iter_tsv(source):
+    '''
+    Yields the fields of each non empty line of a tab separated file.
+    '''
+    for line in iter_lines(source):
+        line = line.rstrip('\n')
+        if line.strip():
+            yield line.split('\t')
+
+
+def iter_transcripts(source):
+    '''
+    Yields (filename, text) from a transcripts file.
+    '''
+    for filename, text in iter_tsv(source):
+        yield filename, text.strip()
+
+
+def iter_segments(source):
+    '''
+    Yields (filename, link, begin, end) from a segments file.
+    '''
+    for filename, link, begin, end in iter_tsv(source):
+        yield filename, link, begin, end
+
+
+def get_book_key(filename):
+    '''
+    Get (speaker, book) from a MLS filename like "speaker_book_id".
+    '''
+    speaker, book, _ = filename.split('_')
+    return speaker, book
+
+
+def write_sorted_chunk(lines, key):
+    chunk_file = tempfile.TemporaryFile('w+')
+    chunk_file.writelines(sorted(lines, key=key))
+    chunk_file.seek(0)
+    return chunk_file
+
+
+def sort_lines(lines, key=None, max_lines_in_memory=1000000):
+    '''
+    External merge sort: sorts chunks of max_lines_in_memory lines into temporary files and merges them lazily.
+    '''
+    lines = (line if line.endswith('\n') else line + '\n' for line in lines)
+    chunk = list(islice(lines, max_lines_in_memory))
+    next_chunk = list(islice(lines, max_lines_in_memory))
+    if not next_chunk:
+        # Fits in memory
+        for line in sorted(chunk, key=key):
+            yield line
+        return
+
+    chunk_files = [write_sorted_chunk(chunk, key), write_sorted_chunk(next_chunk, key)]
+    del chunk, next_chunk
+    while True:
+        chunk = list(islice(lines, max_lines_in_memory))
+        if not chunk:
+            break
+        chunk_files.append(write_sorted_chunk(chunk, key))
+    del chunk
+
+    try:
+        for line in heapq.merge(*chunk_files, key=key):
+            yield line
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+
+def iter_sorted_transcripts(source, max_lines_in_memory=1000000):
+    '''
+    Yields (filename, text) sorted by filename. For repeated filenames, the last text is kept.
+    '''
+    lines = (line for line in iter_lines(source) if line.strip())
+    sorted_lines = sort_lines(lines, key=lambda line: line.split('\t', 1)[0], max_lines_in_memory=max_lines_in_memory)
+
+    previous = None
+    for filename, text in iter_transcripts(sorted_lines):
+        if previous is not None and previous[0] != filename:
+            yield previous
+        previous = (filename, text)
+    if previous is not None:
+        yield previous
+
+
+def iter_book_groups(items, max_group_size=100000):
+    '''
+    Groups consecutive (filename, ...) items by (speaker, book). Yields (speaker, book, items), splitting groups bigger than max_group_size.
+    '''
+    group = []
+    group_key = None
+    for item in items:
+        key = get_book_key(item[0])
+        if group and (key != group_key or len(group) >= max_group_size):
+            yield group_key[0], group_key[1], group
+            group = []
+        group_key = key
+        group.append(item)
+    if group:
+        yield group_key[0], group_key[1], group
+
+
+def iter_sorted_books(source, max_lines_in_memory=1000000):
+    '''
+    Yields (speaker, book, lines) for each book of a transcripts file or iterable of lines, sorted by filename.
+    '''
+    for speaker, book, items in iter_book_groups(iter_sorted_transcripts(source, max_lines_in_memory), max_group_size=float('inf')):
+        yield speaker, book, ['{}\t{}\n'.format(filename, text) for filename, text in items]
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Deterministic split of the books of a language over several machines, and merge of the outputs of each shard.
+#
+import argparse
+import hashlib
+import heapq
+import json
+import collections
+from glob import glob
+from os import makedirs, remove, replace
+from os.path import basename, isfile, join, splitext
+from utils.mls_reader import iter_lines, iter_tsv, get_book_key
+from utils.download_dataset import get_language_dataset_url, SPLITS
+
+SHARDS_FOLDER = 'shards'
+KINDS = ['audio', 'text']
+
+
+def get_shard_name(shard_index, num_shards):
+    return 'shard-{}-of-{}'.format(shard_index, num_shards)
+
+
+def get_shard_filepath(filepath, shard=None):
+    '''
+    Get the file of a shard, like conversion_manifest.shard-0-of-4.jsonl for conversion_manifest.jsonl, or filepath without shard.
+    '''
+    if shard is None:
+        return filepath
+    root, extension = splitext(filepath)
+    return '{}.{}{}'.format(root, shard, extension)
+
+
+def get_book_hash(speaker, book):
+    return int(hashlib.sha1('{}_{}'.format(speaker, book).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def count_book_lines(source):
+    '''
+    Get (speaker, book) => number of lines of a segments or transcripts file.
+    '''
+    counts = collections.Counter()
+    for fields in iter_tsv(source):
+        counts[get_book_key(fields[0])] += 1
+    return counts
+
+
+def assign_books(book_counts, num_shards):
+    '''
+    Get (speaker, book) => shard index. Books are taken by decreasing number of segments (ties ordered by a stable hash of
+    (speaker, book)) and each one goes to the least loaded shard, so shards get balanced, disjoint work. The assignment only
+    depends on the counts, so every machine computes the same one from the same split file.
+    '''
+    loads = [(0, index) for index in range(num_shards)]
+    assignment = {}
+    for key in sorted(book_counts, key=lambda key: (-book_counts[key], get_book_hash(*key))):
+        load, index = heapq.heappop(loads)
+        assignment[key] = index
+        heapq.heappush(loads, (load + book_counts[key], index))
+    return assignment
+
+
+def get_shard_books(source, shard_index, num_shards):
+    '''
+    Get the (speaker, book) set of a shard and its number of segments.
+    '''
+    book_counts = count_book_lines(source)
+    assignment = assign_books(book_counts, num_shards)
+    books = set(key for key, index in assignment.items() if index == shard_index)
+    return books, sum(book_counts[key] for key in books)
+
+
+class ShardSource:
+    '''
+    The lines of a segments or transcripts file (path or iterable of lines) that belong to the books of a shard.
+    Used in place of the file by the MLS readers, each iteration reads the source again.
+    '''
+    def __init__(self, source, books, shard=None):
+        self.source = source
+        self.books = books
+        self.shard = shard
+
+    def __iter__(self):
+        for line in iter_lines(self.source):
+            if line.strip() and get_book_key(line.split('\t', 1)[0]) in self.books:
+                yield line
+
+    def __str__(self):
+        return '{} ({})'.format(self.source, self.shard)
+
+
+def get_marker_filepath(split_folder, kind, shard):
+    return join(split_folder, SHARDS_FOLDER, '{}.{}.json'.format(kind, shard))
+
+
+def write_shard_marker(split_folder, kind, shard_index, num_shards, books, total_segments, folders=(), results=()):
+    '''
+    Records that a shard of a split is done. folders have the manifests of the shard, results are the output_result.txt files of its books.
+    '''
+    makedirs(join(split_folder, SHARDS_FOLDER), exist_ok=True)
+    marker_filepath = get_marker_filepath(split_folder, kind, get_shard_name(shard_index, num_shards))
+    marker = {'kind': kind, 'shard_index': shard_index, 'num_shards': num_shards, 'segments': total_segments,
+              'books': sorted('_'.join(key) for key in books), 'folders': sorted(set(folders)), 'results': sorted(results)}
+    with open(marker_filepath + '.tmp', 'w') as f:
+        json.dump(marker, f)
+    replace(marker_filepath + '.tmp', marker_filepath)
+
+
+def load_shard_markers(split_folder, kind, num_shards):
+    '''
+    Get the markers of the num_shards shards of a split. Returns None if any shard is missing.
+    '''
+    markers = []
+    for shard_index in range(num_shards):
+        marker_filepath = get_marker_filepath(split_folder, kind, get_shard_name(shard_index, num_shards))
+        if not isfile(marker_filepath):
+            print('Shard {} of {} is not done for {} of {}.'.format(shard_index, num_shards, kind, split_folder))
+            return None
+        with open(marker_filepath) as f:
+            markers.append(json.load(f))
+    return markers
+
+
+def merge_shard_files(folder, shard):
+    '''
+    Merges the files of a shard in folder (like probe_cache.shard-0-of-4.json) into the files of the split:
+    json lines are appended, json dicts are updated. The files of the shard are removed.
+    '''
+    for shard_filepath in sorted(glob(join(folder, '*.{}.*'.format(shard)))):
+        filepath = shard_filepath.replace('.{}.'.format(shard), '.')
+        if shard_filepath.endswith('.jsonl'):
+            with open(shard_filepath) as f, open(filepath, 'a') as output_file:
+                for line in f:
+                    output_file.write(line)
+        elif shard_filepath.endswith('.json'):
+            entries = {}
+            if isfile(filepath):
+                with open(filepath) as f:
+                    entries = json.load(f)
+            with open(shard_filepath) as f:
+                entries.update(json.load(f))
+            with open(filepath + '.tmp', 'w') as f:
+                json.dump(entries, f)
+            replace(filepath + '.tmp', filepath)
+        else:
+            continue
+        remove(shard_filepath)
+
+
+def merge_results(markers, output_filepath):
+    '''
+    Concatenates the output_result.txt files of every book, ordered by book, into output_filepath.
+    '''
+    results = sorted(result for marker in markers for result in marker['results'])
+    with open(output_filepath + '.tmp', 'w') as output_file:
+        for result in results:
+            if not isfile(result):
+                continue
+            with open(result) as f:
+                for line in f:
+                    output_file.write(line)
+    replace(output_filepath + '.tmp', output_filepath)
+    return len(results)
+
+
+def merge_shards(split_folder, num_shards, kinds=KINDS):
+    '''
+    Combines the outputs of the shards of a split: manifests of the audio shards, and the output_result.txt of the books
+    of the text shards in <split>/output_result.txt. Every shard must be done, with disjoint books. Returns True if merged.
+    '''
+    merged = True
+    for kind in kinds:
+        if not glob(join(split_folder, SHARDS_FOLDER, '{}.*.json'.format(kind))):
+            continue
+        markers = load_shard_markers(split_folder, kind, num_shards)
+        if markers is None:
+            merged = False
+            continue
+        books = [book for marker in markers for book in marker['books']]
+        if len(books) != len(set(books)):
+            print('Error: shards of {} of {} have books in common, were they run with other options?'.format(kind, split_folder))
+            merged = False
+            continue
+        for marker in markers:
+            shard = get_shard_name(marker['shard_index'], num_shards)
+            for folder in marker['folders']:
+                merge_shard_files(folder, shard)
+        if kind == 'text':
+            total_results = merge_results(markers, join(split_folder, 'output_result.txt'))
+            print('Merged {} books of {} text shards into {}.'.format(total_results, num_shards, join(split_folder, 'output_result.txt')))
+        else:
+            print('Merged the manifests of {} audio shards of {} ({} segments).'.format(num_shards, split_folder, sum(marker['segments'] for marker in markers)))
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--language', default='pt', help='Options: pt (portuguese), pl (polish), it (italian), sp (spanish), fr (french), du (dutch), ge (german), en (english)')
+    parser.add_argument('-d', '--dataset_dir', default=None, help='Folder of the splits (default: the folder of the language archive)')
+    parser.add_argument('-n', '--num_shards', '--num-shards', default=2)
+    args = parser.parse_args()
+
+    dataset_dir = args.dataset_dir or basename(get_language_dataset_url(args.language)).split('.')[0]
+    for split in SPLITS:
+        merge_shards(join(dataset_dir, split), int(args.num_shards))
+
+
+if __name__ == "__main__":
+    main()
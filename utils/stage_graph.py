@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Pipeline of declared stages, run in dependency order and only when the content of their inputs or their config changed.
+#
+import fnmatch
+import glob
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from os import replace, stat, walk
+from os.path import isdir, isfile, join
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def expand_path(path):
+    '''
+    Get the sorted files of a path: a file, every file of a folder, or the files matching a glob pattern.
+    '''
+    if any(character in path for character in '*?['):
+        return sorted(filepath for filepath in glob.glob(path, recursive=True) if isfile(filepath))
+    if isdir(path):
+        return sorted(join(root, filename) for root, _, filenames in walk(path) for filename in filenames)
+    if isfile(path):
+        return [path]
+    return []
+
+
+def get_file_hash(filepath):
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class HashCache:
+    '''
+    Content hashes of files, keyed by path, size and mtime, so each file is read again only when it changed.
+    '''
+    def __init__(self, cache_filepath, workers=8):
+        self.cache_filepath = cache_filepath
+        self.workers = workers
+        self.entries = {}
+        self.lock = threading.Lock()
+        if isfile(cache_filepath):
+            try:
+                with open(cache_filepath) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print('Ignoring invalid hash cache {}.'.format(cache_filepath))
+
+    def get_hash(self, filepath):
+        file_stat = stat(filepath)
+        entry = self.entries.get(filepath)
+        if entry is not None and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime_ns:
+            return entry['hash']
+        file_hash = get_file_hash(filepath)
+        with self.lock:
+            self.entries[filepath] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime_ns, 'hash': file_hash}
+        return file_hash
+
+    def get_path_hash(self, path):
+        '''
+        Get the content hash of a path (file, folder or glob pattern), or None if it has no files.
+        '''
+        filepaths = expand_path(path)
+        if not filepaths:
+            return None
+        with ThreadPoolExecutor(self.workers) as executor:
+            file_hashes = list(executor.map(self.get_hash, filepaths))
+        path_hash = hashlib.sha256()
+        for filepath, file_hash in zip(filepaths, file_hashes):
+            path_hash.update('{}\0{}\n'.format(filepath, file_hash).encode('utf-8'))
+        return path_hash.hexdigest()
+
+    def save(self):
+        with self.lock:
+            tmp_filepath = self.cache_filepath + '.tmp'
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.entries, f)
+            replace(tmp_filepath, self.cache_filepath)
+
+
+def get_path_fingerprint(path):
+    '''
+    Get a hash of the names, sizes and mtimes of the files of a path, or None if it has no files.
+    Outputs are only checked for changes (or removal) since the stage wrote them, so their content is not read.
+    '''
+    filepaths = expand_path(path)
+    if not filepaths:
+        return None
+    fingerprint = hashlib.sha256()
+    for filepath in filepaths:
+        file_stat = stat(filepath)
+        fingerprint.update('{}\0{}\0{}\n'.format(filepath, file_stat.st_size, file_stat.st_mtime_ns).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+class Stage:
+    '''
+    A step of a pipeline: function() is called without arguments and fails by returning False or raising an exception.
+    inputs and outputs are files, folders or glob patterns. A stage depends on the stages whose outputs contain one of its
+    inputs, and on the stages named in after.
+    '''
+    def __init__(self, name, function, inputs=(), outputs=(), config=None, after=()):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config = config or {}
+        self.after = list(after)
+
+    def __repr__(self):
+        return 'Stage({})'.format(self.name)
+
+
+def is_inside(path, output):
+    '''
+    Verify if an input path is, or is inside, an output path. Either of them can be a glob pattern.
+    '''
+    if path == output or path.startswith(output.rstrip('/') + '/'):
+        return True
+    return fnmatch.fnmatch(path, output) or fnmatch.fnmatch(output, path)
+
+
+class StageGraph:
+    '''
+    Runs stages in dependency order, at most "jobs" at once, so independent branches run concurrently.
+    A stage is skipped when the key of its last successful run (content hashes of its inputs and its config) is unchanged
+    and its outputs were not modified since. Stages whose upstream stage failed are not run.
+    The state of each stage is saved in state_filepath, the hashes of the input files in state_filepath.hashes.json.
+    '''
+    def __init__(self, state_filepath='pipeline_state.json', jobs=2):
+        self.state_filepath = state_filepath
+        self.jobs = jobs
+        self.stages = {}
+        self.state = {}
+        self.lock = threading.Lock()
+        self.hash_cache = HashCache(state_filepath + '.hashes.json')
+        if isfile(state_filepath):
+            try:
+                with open(state_filepath) as f:
+                    self.state = json.load(f)
+            except ValueError:
+                print('Ignoring invalid pipeline state {}.'.format(state_filepath))
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError('Stage {} already exists.'.format(stage.name))
+        self.stages[stage.name] = stage
+        return stage
+
+    def get_dependencies(self, stage):
+        dependencies = set(stage.after)
+        for other in self.stages.values():
+            if other is not stage and any(is_inside(path, output) for path in stage.inputs for output in other.outputs):
+                dependencies.add(other.name)
+        unknown = dependencies - set(self.stages)
+        if unknown:
+            raise ValueError('Stage {} depends on unknown stages: {}'.format(stage.name, ', '.join(sorted(unknown))))
+        return dependencies
+
+    def get_order(self):
+        '''
+        Get the stage names in dependency order. Raises ValueError on cycles.
+        '''
+        dependencies = {name: self.get_dependencies(stage) for name, stage in self.stages.items()}
+        order, done = [], set()
+        while len(order) < len(dependencies):
+            ready = [name for name in dependencies if name not in done and dependencies[name] <= done]
+            if not ready:
+                raise ValueError('Cycle between stages: {}'.format(', '.join(sorted(set(dependencies) - done))))
+            order.extend(ready)
+            done.update(ready)
+        return order
+
+    def get_key(self, stage):
+        key = hashlib.sha256()
+        key.update(json.dumps([stage.name, stage.config], sort_keys=True).encode('utf-8'))
+        for path in stage.inputs:
+            key.update('{}\0{}\n'.format(path, self.hash_cache.get_path_hash(path)).encode('utf-8'))
+        return key.hexdigest()
+
+    def is_up_to_date(self, stage, key):
+        entry = self.state.get(stage.name)
+        if entry is None or entry['key'] != key:
+            return False
+        return all(entry['outputs'].get(path) == get_path_fingerprint(path) for path in stage.outputs)
+
+    def set_state(self, name, entry):
+        with self.lock:
+            if entry is None:
+                self.state.pop(name, None)
+            else:
+                self.state[name] = entry
+            tmp_filepath = self.state_filepath + '.tmp'
+            with open(tmp_filepath, 'w') as f:
+                json.dump(self.state, f, indent=1)
+            replace(tmp_filepath, self.state_filepath)
+
+    def run_stage(self, stage, force=False, dry_run=False):
+        '''
+        Runs a stage if it is not up to date. Returns "skipped", "done" (or "pending" with dry_run) or "failed".
+        '''
+        key = self.get_key(stage)
+        self.hash_cache.save()
+        if not force and self.is_up_to_date(stage, key):
+            return 'skipped'
+        if dry_run:
+            return 'pending'
+        print('Running stage {}...'.format(stage.name))
+        # An interrupted stage is run again
+        self.set_state(stage.name, None)
+        try:
+            result = stage.function()
+        except Exception as e:
+            print('Error: stage {} failed: {}'.format(stage.name, e))
+            return 'failed'
+        if result is False:
+            print('Error: stage {} failed.'.format(stage.name))
+            return 'failed'
+        self.set_state(stage.name, {'key': key, 'outputs': {path: get_path_fingerprint(path) for path in stage.outputs}})
+        return 'done'
+
+    def run(self, force=(), dry_run=False):
+        '''
+        Runs the pipeline. Stages whose name or any part of it ("search" in "dev/search") is in force are run again.
+        With dry_run, only reports the stages that would run (the stages after them are reported with their current inputs).
+        Returns name => status ("skipped", "done", "pending", "failed" or "blocked").
+        '''
+        order = self.get_order()
+        dependencies = {name: self.get_dependencies(self.stages[name]) for name in order}
+        status = {}
+        running = {}
+        with ThreadPoolExecutor(self.jobs) as executor:
+            while len(status) < len(order):
+                for name in order:
+                    if name in status or name in running.values() or not dependencies[name] <= set(status):
+                        continue
+                    if any(status[dependency] in ('failed', 'blocked') for dependency in dependencies[name]):
+                        status[name] = 'blocked'
+                        continue
+                    stage_force = name in force or any(part in force for part in name.split('/'))
+                    running[executor.submit(self.run_stage, self.stages[name], stage_force, dry_run)] = name
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    status[running.pop(future)] = future.result()
+        self.hash_cache.save()
+        for name in order:
+            print('{:<24} {}'.format(name, status[name]))
+        return status
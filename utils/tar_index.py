@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Single pass extraction of tar.gz members, with an index of member offsets for later targeted reads.
+#
+import bisect
+import gzip
+import io
+import json
+import shutil
+import tarfile
+from os import makedirs, replace, stat
+from os.path import dirname, isfile, join
+
+try:
+    # Seek points inside gzip streams (optional)
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# Uncompressed bytes between two gzip seek points
+SEEK_POINT_SPACING = 32 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+# Audio members are only recorded in the index when asked for, the MLS archives have millions of them
+UNINDEXED_EXTENSIONS = ('.opus', '.flac', '.wav', '.mp3')
+
+
+def get_tar_index_filepath(tar_filename):
+    return tar_filename + '.index.json'
+
+
+def get_gzip_index_filepath(tar_filename):
+    return tar_filename + '.gzidx'
+
+
+def load_tar_index(tar_filename):
+    '''
+    Get the member index of an archive, or None if there is none or the archive changed since.
+    The index is {"size", "mtime", "complete", "members": {name: {"header", "data", "size", "compressed"}}}:
+    uncompressed offsets of the member header and data, and the compressed offset of the closest gzip seek point before it
+    (None without indexed_gzip).
+    '''
+    index_filepath = get_tar_index_filepath(tar_filename)
+    if not isfile(index_filepath):
+        return None
+    try:
+        with open(index_filepath) as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+    tar_stat = stat(tar_filename)
+    if index['size'] != tar_stat.st_size or index['mtime'] != tar_stat.st_mtime:
+        return None
+    return index
+
+
+def save_tar_index(tar_filename, members, complete):
+    tar_stat = stat(tar_filename)
+    index = {'size': tar_stat.st_size, 'mtime': tar_stat.st_mtime, 'complete': complete, 'members': members}
+    tmp_filepath = get_tar_index_filepath(tar_filename) + '.tmp'
+    with open(tmp_filepath, 'w') as f:
+        json.dump(index, f)
+    replace(tmp_filepath, get_tar_index_filepath(tar_filename))
+
+
+def is_gzip(tar_filename):
+    return tar_filename.endswith('.gz') or tar_filename.endswith('.tgz')
+
+
+def open_uncompressed(tar_filename, use_seek_points=True):
+    '''
+    Opens the uncompressed stream of an archive. Returns (stream, compressed file).
+    With indexed_gzip, seek points are recorded while reading, and the ones of previous passes are imported.
+    '''
+    compressed_file = open(tar_filename, 'rb')
+    if not is_gzip(tar_filename):
+        return compressed_file, compressed_file
+    if indexed_gzip is not None and use_seek_points:
+        gzip_index_filepath = get_gzip_index_filepath(tar_filename)
+        stream = indexed_gzip.IndexedGzipFile(fileobj=compressed_file, spacing=SEEK_POINT_SPACING,
+                                             index_file=gzip_index_filepath if isfile(gzip_index_filepath) else None)
+        return stream, compressed_file
+    return gzip.GzipFile(fileobj=compressed_file), compressed_file
+
+
+def get_seek_points(stream):
+    if indexed_gzip is not None and isinstance(stream, indexed_gzip.IndexedGzipFile):
+        return list(stream.seek_points())
+    return []
+
+
+def get_checkpoint(seek_points, uncompressed_offsets, offset):
+    '''
+    Get the compressed offset of the last seek point before an uncompressed offset, or None.
+    uncompressed_offsets are the sorted uncompressed offsets of seek_points.
+    '''
+    position = bisect.bisect_right(uncompressed_offsets, offset)
+    return seek_points[position - 1][1] if position else None
+
+
+def is_indexed_member(name):
+    return not name.lower().endswith(UNINDEXED_EXTENSIONS)
+
+
+def is_known_missing(index, name):
+    '''
+    Verify if a member is known not to be in an archive: a complete index has every member that is not audio.
+    '''
+    return index is not None and index['complete'] and is_indexed_member(name) and name not in index['members']
+
+
+def write_member(source, name, output_dir):
+    '''
+    Writes the data of a member to output_dir. The file is renamed when complete.
+    '''
+    filepath = join(output_dir, name)
+    makedirs(dirname(filepath) or './', exist_ok=True)
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        shutil.copyfileobj(source, f, CHUNK_SIZE)
+    replace(tmp_filepath, filepath)
+
+
+def iter_scan_archive(tar_filename, wanted_names=(), stop_when_found=True):
+    '''
+    One streaming pass over an archive, recording the offsets of the members seen in the index (audio members only if wanted).
+    Yields (member, file object) for the wanted members, each file object must be read before the next iteration.
+    With stop_when_found, the pass ends after the last wanted member (the index is then partial).
+    '''
+    wanted_names = set(wanted_names)
+    missing = set(wanted_names)
+    members = {}
+    stream, compressed_file = open_uncompressed(tar_filename)
+    complete = False
+    try:
+        tar_file = tarfile.open(fileobj=stream, mode='r|')
+        while True:
+            member = tar_file.next()
+            if member is None:
+                complete = True
+                break
+            if member.name in wanted_names or is_indexed_member(member.name):
+                # The seek point is set at the end of the pass, if there are seek points
+                members[member.name] = {'header': member.offset, 'data': member.offset_data, 'size': member.size, 'compressed': None}
+            if member.name in missing and member.isfile():
+                missing.discard(member.name)
+                yield member, tar_file.extractfile(member)
+                if not missing and stop_when_found:
+                    break
+            # Streamed members are not kept in memory
+            tar_file.members = []
+
+        seek_points = get_seek_points(stream)
+        if seek_points:
+            uncompressed_offsets = [uncompressed_offset for uncompressed_offset, _ in seek_points]
+            for entry in members.values():
+                entry['compressed'] = get_checkpoint(seek_points, uncompressed_offsets, entry['header'])
+            stream.export_index(get_gzip_index_filepath(tar_filename))
+    finally:
+        stream.close()
+        compressed_file.close()
+        previous_index = load_tar_index(tar_filename)
+        if previous_index is not None:
+            # Keeps members found by a previous pass that went further
+            members = dict(previous_index['members'], **members)
+            complete = complete or previous_index['complete']
+        save_tar_index(tar_filename, members, complete)
+
+
+def scan_archive(tar_filename, wanted_names=(), output_dir='./', stop_when_found=True):
+    '''
+    One streaming pass over an archive: extracts the wanted members to output_dir and records the offsets of every member
+    seen in the index. Returns the names of the wanted members that were not found.
+    '''
+    missing = set(wanted_names)
+    for member, source in iter_scan_archive(tar_filename, wanted_names, stop_when_found):
+        write_member(source, member.name, output_dir)
+        missing.discard(member.name)
+    return sorted(missing)
+
+
+def seek_forward(stream, position, offset, use_seek_points):
+    '''
+    Moves an uncompressed stream from position to offset. Without seek points, the data in between is decompressed and skipped.
+    '''
+    if use_seek_points and stream.seekable():
+        stream.seek(offset)
+        return
+    while position < offset:
+        skipped = stream.read(min(CHUNK_SIZE, offset - position))
+        if not skipped:
+            raise IOError('Unexpected end of archive.')
+        position += len(skipped)
+
+
+def iter_member_readers(tar_filename, names, index=None):
+    '''
+    Yields (name, reader) for the members of names found in the index, in the order of the archive, all read from one stream.
+    Each reader must be consumed (or discarded) before the next one is used.
+    '''
+    index = index or load_tar_index(tar_filename)
+    if index is None:
+        return
+    entries = sorted((index['members'][name]['data'], name) for name in set(names) if name in index['members'])
+    if not entries:
+        return
+    use_seek_points = not is_gzip(tar_filename) or (indexed_gzip is not None and isfile(get_gzip_index_filepath(tar_filename)))
+    stream, compressed_file = open_uncompressed(tar_filename, use_seek_points)
+    try:
+        position = 0
+        for offset, name in entries:
+            seek_forward(stream, position, offset, use_seek_points)
+            reader = MemberReader(stream, index['members'][name]['size'])
+            yield name, reader
+            # Skips what was not read
+            position = offset + reader.size - reader.remaining
+    finally:
+        stream.close()
+        compressed_file.close()
+
+
+def open_member(tar_filename, name, index=None):
+    '''
+    Get the data of a member as bytes, using the index to skip the tar parsing (and, with seek points, the decompression)
+    of everything before it. Returns None if the member is not in the index.
+    '''
+    for _, reader in iter_member_readers(tar_filename, [name], index):
+        return reader.read()
+    return None
+
+
+class MemberReader(io.RawIOBase):
+    '''
+    Reads the size bytes of a member from an uncompressed stream positioned at its data.
+    '''
+    def __init__(self, stream, size):
+        super().__init__()
+        self.stream = stream
+        self.size = size
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+
+def extract_archive_members(tar_filename, names, output_dir='./'):
+    '''
+    Extracts members of an archive in one decompression. Members in the index are read directly,
+    the others are extracted by one streaming pass. Returns the names that were not found.
+    '''
+    index = load_tar_index(tar_filename)
+    remaining = set(names)
+    for name, reader in iter_member_readers(tar_filename, names, index):
+        write_member(reader, name, output_dir)
+        remaining.discard(name)
+
+    if not remaining:
+        return []
+    not_found = [name for name in remaining if is_known_missing(index, name)]
+    remaining.difference_update(not_found)
+    if remaining:
+        not_found += scan_archive(tar_filename, remaining, output_dir)
+    return sorted(not_found)
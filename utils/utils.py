@@ -30,10 +30,13 @@ def get_filepath_from_link(link, output_path):
     return filepath
 
 
-def remove_mp3_files(segment_filepath):
+def remove_mp3_files(segment_filepath, books=None):
     '''
-    Remove mp3 files.
+    Remove mp3 files. With books, only the mp3 files of these (speaker, book) are removed.
     '''
-    mp3_filelist = glob(dirname(segment_filepath) + '/audio/**/**/*.mp3')
+    if books is None:
+        mp3_filelist = glob(dirname(segment_filepath) + '/audio/**/**/*.mp3')
+    else:
+        mp3_filelist = [mp3_file for speaker, book in sorted(books) for mp3_file in glob(join(dirname(segment_filepath), 'audio', speaker, book, '*.mp3'))]
     for mp3_file in mp3_filelist:
         remove(mp3_file)